@@ -35,6 +35,9 @@ def initialize():
     if not op.exists(DATASET_DIR):
         os.makedirs(DATASET_DIR)
 
+    if not op.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+
 
 def get_surfaces():
     return sorted(list(cortex.db.subjects.keys()))
@@ -116,6 +119,7 @@ SCANNER_DIR = op.join(DATA_DIR, 'scanner')
 DATASTORE_DIR = op.join(DATA_DIR, 'datastore')
 RECORDING_DIR = op.join(DATA_DIR, 'recordings')
 DATASET_DIR = op.join(DATA_DIR, 'datasets')
+CACHE_DIR = op.join(DATA_DIR, 'cache')
 initialize()
 
 config = ConfigParser()
@@ -126,6 +130,16 @@ REDIS_HOST = config.get('addresses', 'redis_host')
 
 # web
 STATIC_PATH = config.get('web', 'static')
+# maximum total size of models cached by the web interface, in bytes
+MODEL_CACHE_SIZE = config.getint('web', 'model_cache_mb', fallback=2048) * 2 ** 20
+# number of worker processes that run background jobs (model fitting, decoding)
+JOB_WORKERS = config.getint('web', 'job_workers', fallback=2)
+# number of recent samples of each dashboard time series kept in the database
+DASHBOARD_BUFFER_LENGTH = config.getint('web', 'dashboard_buffer_length', fallback=10000)
+# number of points per trace that dashboard time series are downsampled to
+DASHBOARD_PLOT_POINTS = config.getint('web', 'dashboard_plot_points', fallback=1000)
+# maximum number of points per trace of dashboard time series that are extended in the browser
+DASHBOARD_WINDOW_POINTS = config.getint('web', 'dashboard_window_points', fallback=2000)
 
 # TTL
 TTL_KEYBOARD_DEV = config.get('sync', 'keyboard')
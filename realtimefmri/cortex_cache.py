@@ -0,0 +1,204 @@
+"""Persistent cache of data derived from the pycortex database
+
+Masks, ROI index sets and reference volumes are computed from the pycortex store the first time
+they are requested and saved as ``.npy`` files in ``config.CACHE_DIR``. Later requests, including
+those from new sessions, memory-map the saved arrays.
+
+Cache entries are keyed by the request parameters and by the modification times and sizes of the
+pycortex files they were computed from, so an entry is no longer used once those files change.
+"""
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import tempfile
+
+import nibabel
+import numpy as np
+
+import cortex
+from realtimefmri import config, image_utils
+from realtimefmri.utils import get_logger
+
+logger = get_logger('cortex_cache', to_console=True)
+
+
+def get_transform_directory(surface, transform):
+    return op.join(cortex.database.default_filestore, surface, 'transforms', transform)
+
+
+def _file_signatures(paths):
+    """Modification time and size of each file in ``paths``, descending into directories
+    """
+    signatures = []
+    for path in paths:
+        if op.isdir(path):
+            children = sorted(op.join(path, name) for name in os.listdir(path))
+            signatures.extend(_file_signatures(children))
+        elif op.exists(path):
+            stat = os.stat(path)
+            signatures.append([path, stat.st_mtime_ns, stat.st_size])
+
+    return signatures
+
+
+def _hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def cached_arrays(kind, parameters, sources, compute):
+    """Load arrays from the cache, computing and storing them if needed
+
+    Parameters
+    ----------
+    kind : str
+        Name of the type of cached data, e.g., ``mask``
+    parameters : dict
+        JSON-serializable parameters that ``compute`` depends on
+    sources : list of str
+        Files and directories that ``compute`` reads from. The entry is invalidated when any of
+        them change
+    compute : callable
+        Function with no arguments that returns a dict of arrays
+
+    Returns
+    -------
+    A dict of read-only memory-mapped arrays
+    """
+    prefix = f'{kind}-{_hash(parameters)}'
+    path = op.join(config.CACHE_DIR, f'{prefix}-{_hash(_file_signatures(sources))}')
+
+    if not op.isdir(path):
+        logger.info('Computing %s %s', kind, parameters)
+        arrays = compute()
+
+        # computing can write new files to the pycortex store (e.g. pycortex caches masks), so
+        # key the entry by the state of the sources afterwards
+        path = op.join(config.CACHE_DIR, f'{prefix}-{_hash(_file_signatures(sources))}')
+        for name in os.listdir(config.CACHE_DIR):
+            if name.startswith(prefix + '-'):
+                shutil.rmtree(op.join(config.CACHE_DIR, name), ignore_errors=True)
+
+        temporary_path = tempfile.mkdtemp(prefix='.' + prefix, dir=config.CACHE_DIR)
+        for name, array in arrays.items():
+            np.save(op.join(temporary_path, name + '.npy'), array)
+        try:
+            os.rename(temporary_path, path)
+        except OSError:  # another process stored the same entry first
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+    arrays = {}
+    for name in os.listdir(path):
+        arrays[op.splitext(name)[0]] = np.load(op.join(path, name), mmap_mode='r')
+
+    return arrays
+
+
+def get_mask_indices(surface, transform, mask_type):
+    """Flat indices of the voxels in a pycortex mask
+
+    Parameters
+    ----------
+    surface : str
+    transform : str
+    mask_type : str
+
+    Returns
+    -------
+    An array of indices into the raveled (z, y, x) volume, in the order of ``volume[mask]``, and
+    the shape of the mask
+    """
+    def compute():
+        mask = cortex.db.get_mask(surface, transform, mask_type)
+        return {'indices': np.flatnonzero(mask), 'shape': np.array(mask.shape)}
+
+    parameters = {'surface': surface, 'transform': transform, 'mask_type': mask_type}
+    arrays = cached_arrays('mask', parameters, [get_transform_directory(surface, transform)],
+                           compute)
+    return arrays['indices'], tuple(int(n) for n in arrays['shape'])
+
+
+def get_secondary_mask_indices(surface, transform, mask_type_1, mask_type_2):
+    """Indices into a vector of ``mask_type_1`` voxels that are also in ``mask_type_2``
+
+    See ``realtimefmri.image_utils.secondary_mask``
+
+    Returns
+    -------
+    An array of indices
+    """
+    def compute():
+        mask1 = cortex.db.get_mask(surface, transform, mask_type_1).T  # in xyz
+        mask2 = cortex.db.get_mask(surface, transform, mask_type_2).T  # in xyz
+        mask = image_utils.secondary_mask(mask1, mask2, order='F')
+        return {'indices': np.flatnonzero(mask)}
+
+    parameters = {'surface': surface, 'transform': transform,
+                  'mask_type_1': mask_type_1, 'mask_type_2': mask_type_2}
+    arrays = cached_arrays('secondary_mask', parameters,
+                           [get_transform_directory(surface, transform)], compute)
+    return arrays['indices']
+
+
+def get_roi_indices(surface, transform, pre_mask_path, roi_names):
+    """Indices of each ROI into a vector of voxels selected by a pre-mask
+
+    Parameters
+    ----------
+    surface : str
+    transform : str
+    pre_mask_path : str
+        Path to a nifti file containing the mask applied to produce the activity vector
+    roi_names : list of str
+
+    Returns
+    -------
+    A dict from ROI name to an array of indices, and the number of voxels in the pre-mask
+    """
+    def compute():
+        # mask in zyx
+        pre_mask = nibabel.load(pre_mask_path).get_data().T.astype(bool)
+
+        # returns masks in zyx
+        roi_masks, roi_dict = cortex.get_roi_masks(surface, transform, roi_names)
+
+        names = sorted(roi_dict.keys())
+        indices = [np.flatnonzero(image_utils.secondary_mask(pre_mask, roi_masks == roi_dict[n]))
+                   for n in names]
+        # none of the ROIs may be in the overlay
+        return {'names': np.array(names, dtype=str),
+                'indices': np.concatenate(indices) if indices else np.array([], dtype='int64'),
+                'offsets': np.cumsum([0] + [len(i) for i in indices]),
+                'n_voxels': np.array(pre_mask.sum())}
+
+    parameters = {'surface': surface, 'transform': transform, 'pre_mask_path': pre_mask_path,
+                  'roi_names': list(roi_names)}
+    sources = [get_transform_directory(surface, transform), pre_mask_path,
+               op.join(cortex.database.default_filestore, surface, 'overlays.svg'),
+               op.join(cortex.database.default_filestore, surface, 'surfaces')]
+    arrays = cached_arrays('roi', parameters, sources, compute)
+
+    offsets = arrays['offsets']
+    roi_indices = {str(name): arrays['indices'][offsets[i]:offsets[i + 1]]
+                   for i, name in enumerate(arrays['names'])}
+    return roi_indices, int(arrays['n_voxels'])
+
+
+def get_reference(surface, transform):
+    """Reference volume of a pycortex transform
+
+    Returns
+    -------
+    The reference data (in nifti voxel order), its affine and the path to the reference file
+    """
+    reference_path = op.join(get_transform_directory(surface, transform), 'reference.nii.gz')
+
+    def compute():
+        reference = cortex.db.get_xfm(surface, transform).reference
+        return {'data': np.asanyarray(reference.dataobj), 'affine': reference.affine}
+
+    parameters = {'surface': surface, 'transform': transform}
+    arrays = cached_arrays('reference', parameters, [get_transform_directory(surface, transform)],
+                           compute)
+    return arrays['data'], np.array(arrays['affine']), reference_path
@@ -0,0 +1,271 @@
+"""Stimulus features for fitting encoding and decoding models
+
+Features of each stimulus are precomputed and saved as ``<feature_name>/<stimulus_name>.npy``
+arrays with one row per second of stimulus. They are memory-mapped the first time they are used
+and aligned to the response times with a single ``searchsorted`` per delay. A library of candidate
+stimuli can be scored with a fitted model to choose stimuli for closed-loop experiments.
+"""
+import os
+import os.path as op
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class FeatureStore():
+    """Memory-mapped cache of stimulus feature arrays
+
+    Every memory-mapped array keeps its file open, so only the ``max_arrays`` most recently used
+    arrays are cached.
+
+    Parameters
+    ----------
+    directory : str
+        Directory containing a subdirectory of ``.npy`` files for each feature space
+    max_arrays : int
+        Upper limit on the number of cached arrays. Least recently used arrays are evicted above
+        this limit
+
+    Attributes
+    ----------
+    arrays : OrderedDict
+        Maps the path of each loaded feature file to its modification time and its read-only
+        memory-mapped array, least recently used first
+    """
+    def __init__(self, directory, max_arrays=256):
+        self.directory = directory
+        self.max_arrays = max_arrays
+        self.arrays = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_path(self, feature_name, stimulus_name):
+        stem = op.splitext(stimulus_name)[0]
+        return op.join(self.directory, feature_name, stem + '.npy')
+
+    def load(self, feature_name, stimulus_name):
+        """Features of a stimulus, memory-mapped once and reloaded only if the file changes
+
+        Returns
+        -------
+        A read-only array with shape (n_samples, n_features)
+        """
+        path = self.get_path(feature_name, stimulus_name)
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            cached = self.arrays.get(path)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, np.load(path, mmap_mode='r'))
+                self.arrays[path] = cached
+
+            self.arrays.move_to_end(path)
+            while len(self.arrays) > self.max_arrays:
+                self.arrays.popitem(last=False)
+
+        return cached[1]
+
+    def mean(self, feature_name, stimulus_name):
+        """Features of a stimulus averaged over time
+
+        The file is read and closed without being added to the cache, so summarizing many
+        stimuli does not keep their files open.
+
+        Returns
+        -------
+        An array with shape (n_features,)
+        """
+        return np.load(self.get_path(feature_name, stimulus_name)).mean(0)
+
+
+def align_features_and_responses(feature_times, features, response_times, responses,
+                                 delays=(0.,), method='previous', max_gap=None, dtype='float32'):
+    """Build the design matrix of features, delayed, at each response time
+
+    For each response time ``t`` and delay ``d`` the features at time ``t - d`` are copied to the
+    design matrix. Times that are not within ``max_gap`` of a feature sample, e.g., between
+    stimuli, get zero features.
+
+    Parameters
+    ----------
+    feature_times : list of numpy.ndarray
+        Time of each feature sample, one array per stimulus
+    features : list of numpy.ndarray
+        Features with shape (n_samples, n_features), one array per stimulus
+    response_times : numpy.ndarray
+    responses : numpy.ndarray
+    delays : sequence of float
+        Delays (seconds) of the features relative to the responses, e.g., (2, 4, 6) for a finite
+        impulse response model of the hemodynamic lag
+    method : str
+        ``previous`` uses the most recent feature sample, ``linear`` interpolates between the
+        samples around each time
+    max_gap : float or None
+        Largest time (seconds) between feature samples of the same stimulus. None uses the
+        median interval between samples
+    dtype : str
+
+    Returns
+    -------
+    A design matrix with shape (n_responses, n_delays * n_features), with the features for each
+    delay in consecutive blocks of columns, and the responses
+    """
+    times = np.concatenate(feature_times).astype('float64')
+    order = None
+    if np.any(np.diff(times) < 0):
+        order = np.argsort(times, kind='mergesort')
+        times = times[order]
+
+    values = np.concatenate(features)
+    if order is not None:
+        values = values[order]
+
+    intervals = np.diff(times)
+    if max_gap is None:
+        max_gap = np.median(intervals) if len(intervals) > 0 else 0.
+    # samples followed by another sample of the same stimulus
+    continuous = np.r_[intervals <= max_gap, False]
+
+    response_times = np.asarray(response_times, dtype='float64').ravel()
+    n_features = values.shape[1]
+    design = np.zeros((len(response_times), len(delays) * n_features), dtype=dtype)
+
+    for i, delay in enumerate(delays):
+        block = design[:, i * n_features:(i + 1) * n_features]
+        sample_times = response_times - delay
+        index = np.searchsorted(times, sample_times, side='right') - 1
+        valid = index >= 0
+        index[~valid] = 0
+        valid &= sample_times - times[index] <= max_gap
+
+        if method == 'previous':
+            block[valid] = values[index[valid]]
+
+        elif method == 'linear':
+            interpolate = valid & continuous[index]
+            hold = valid & ~interpolate
+            block[hold] = values[index[hold]]
+
+            previous = index[interpolate]
+            weights = ((sample_times[interpolate] - times[previous]) /
+                       (times[previous + 1] - times[previous]))[:, None]
+            block[interpolate] = ((1 - weights) * values[previous] +
+                                  weights * values[previous + 1])
+
+        else:
+            raise NotImplementedError(f'Alignment method {method} not implemented')
+
+    return design, responses
+
+
+class StimulusLibrary():
+    """Features of every candidate stimulus, for choosing stimuli with a model
+
+    Each stimulus is summarized by its features averaged over time, and all stimuli are kept in
+    one in-memory matrix so that the whole library is scored with a single prediction. Only the
+    averages are kept, the feature files are closed once they are read.
+
+    Parameters
+    ----------
+    feature_store : FeatureStore
+    feature_name : str
+    stimulus_names : list of str or None
+        Stimuli in the library. None uses every stimulus with saved features
+    dtype : str
+
+    Attributes
+    ----------
+    features : numpy.ndarray
+        Mean features with shape (n_stimuli, n_features)
+    scores : dict
+        Maps model names to the model version and the scores of every stimulus for that version
+    """
+    def __init__(self, feature_store, feature_name, stimulus_names=None, dtype='float32'):
+        if stimulus_names is None:
+            directory = op.join(feature_store.directory, feature_name)
+            stimulus_names = sorted(op.splitext(name)[0] for name in os.listdir(directory)
+                                    if name.endswith('.npy'))
+
+        self.feature_name = feature_name
+        self.stimulus_names = list(stimulus_names)
+        if len(self.stimulus_names) == 0:
+            raise ValueError(f'No stimuli with {feature_name} features in '
+                             f'{feature_store.directory}')
+
+        self.features = None
+        for i, stimulus_name in enumerate(self.stimulus_names):
+            mean = feature_store.mean(feature_name, stimulus_name)
+            if self.features is None:
+                self.features = np.empty((len(self.stimulus_names), len(mean)), dtype=dtype)
+            self.features[i] = mean
+
+        self.scores = {}
+
+    def score(self, model, model_name=None, version=None, chunk_size=10000):
+        """Predicted response to each stimulus, averaged over the model's targets
+
+        Models fit on delayed features (see ``align_features_and_responses``) are given the
+        stimulus features at every delay, i.e., the steady-state response. Linear models with a
+        ``coef_`` are first reduced to one weight vector, so scoring is a single matrix-vector
+        product. Other models predict the library in chunks of ``chunk_size`` stimuli.
+
+        Parameters
+        ----------
+        model : object
+            A fitted model with a ``predict`` method
+        model_name : str or None
+            Name of the model, used with ``version`` to cache the scores
+        version : int or None
+
+        Returns
+        -------
+        An array of scores with one value per stimulus
+        """
+        cached = self.scores.get(model_name)
+        if model_name is not None and cached is not None and cached[0] == version:
+            return cached[1]
+
+        n_features = self.features.shape[1]
+        coef = getattr(model, 'coef_', None)
+        if isinstance(coef, np.ndarray):
+            coef = coef.reshape(-1, coef.shape[-1])
+            n_delays = coef.shape[1] // n_features
+            weights = coef.reshape(len(coef), n_delays, n_features).sum(1).mean(0)
+            intercept = np.mean(getattr(model, 'intercept_', 0.))
+            scores = self.features.dot(weights.astype(self.features.dtype)) + intercept
+
+        else:
+            n_delays = max(getattr(model, 'n_features_in_', n_features) // n_features, 1)
+            scores = np.empty(len(self.features))
+            for start in range(0, len(self.features), chunk_size):
+                chunk = self.features[start:start + chunk_size]
+                predictions = model.predict(np.tile(chunk, n_delays))
+                scores[start:start + chunk_size] = predictions.reshape(len(chunk), -1).mean(1)
+
+        if model_name is not None:
+            self.scores[model_name] = (version, scores)
+
+        return scores
+
+    @staticmethod
+    def select(scores, n_optimal, n_minimal):
+        """Indices of the highest and lowest scoring stimuli
+
+        Returns
+        -------
+        Indices of the ``n_optimal`` highest scores, highest first, and of the ``n_minimal``
+        lowest scores, lowest first
+        """
+        n_optimal = min(n_optimal, len(scores))
+        n_minimal = min(n_minimal, len(scores))
+
+        optimal = np.array([], dtype=int)
+        if n_optimal > 0:
+            optimal = np.argpartition(scores, len(scores) - n_optimal)[-n_optimal:]
+            optimal = optimal[np.argsort(scores[optimal])[::-1]]
+
+        minimal = np.array([], dtype=int)
+        if n_minimal > 0:
+            minimal = np.argpartition(scores, n_minimal - 1)[:n_minimal]
+            minimal = minimal[np.argsort(scores[minimal])]
+
+        return optimal, minimal
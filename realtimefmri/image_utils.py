@@ -1,10 +1,14 @@
+import base64
+import io
 import os
 import os.path as op
 import shlex
 import tempfile
+import time
 
 import nibabel
 import numpy as np
+from PIL import Image
 
 import cortex
 from realtimefmri import utils
@@ -60,39 +64,114 @@ def secondary_mask(mask1, mask2, order='C'):
     return masks[:, 1].astype(bool)
 
 
-def register(volume, reference, twopass=False, output_transform=False):
+class RegistrationWorkspace():
+    """A reusable scratch directory for running external registration tools
+
+    Volumes are written as uncompressed nifti to a RAM-backed directory (``/dev/shm`` when it is
+    available). The reference is staged once and the same file names are reused for every
+    volume, so the per-volume cost outside of the registration itself is one uncompressed write
+    and one read.
+
+    Parameters
+    ----------
+    directory : str or None
+        Parent directory for the workspace. None uses ``/dev/shm`` if it exists, otherwise the
+        default temporary directory
+
+    Attributes
+    ----------
+    path : str
+        The workspace directory
+    reference_path : str
+        Path to the staged reference
+    timings : dict
+        Seconds spent staging inputs (``stage``), running the external tool (``register``) and
+        loading its outputs (``load``) for the most recent volume
+    """
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = '/dev/shm' if op.isdir('/dev/shm') else tempfile.gettempdir()
+
+        self._directory = tempfile.TemporaryDirectory(prefix='realtimefmri-', dir=directory)
+        self.path = self._directory.name
+        self.reference_path = None
+        self.volume_path = op.join(self.path, 'volume.nii')
+        self.registered_volume_path = op.join(self.path, 'registered.nii')
+        self.transform_path = op.join(self.path, 'transform.aff12.1D')
+        self.timings = {}
+
+    def stage_reference(self, reference):
+        """Link or write the reference image into the workspace
+
+        Parameters
+        ----------
+        reference : str or nibabel.nifti1.Nifti1Image
+        """
+        if isinstance(reference, str):
+            extension = '.nii.gz' if reference.endswith('.gz') else '.nii'
+            reference_path = op.join(self.path, 'reference' + extension)
+            if op.lexists(reference_path):
+                os.remove(reference_path)
+            os.symlink(op.abspath(reference), reference_path)
+        else:
+            reference_path = op.join(self.path, 'reference.nii')
+            nibabel.save(reference, reference_path)
+
+        self.reference_path = reference_path
+
+    def stage_volume(self, volume):
+        """Write the input volume into the workspace and clear outputs from the previous volume
+
+        Parameters
+        ----------
+        volume : str or nibabel.nifti1.Nifti1Image
+
+        Returns
+        -------
+        Path to the staged volume
+        """
+        for path in (self.registered_volume_path, self.transform_path):
+            if op.exists(path):
+                os.remove(path)
+
+        if isinstance(volume, str):
+            return volume
+
+        nibabel.save(volume, self.volume_path)
+        return self.volume_path
+
+    def cleanup(self):
+        self._directory.cleanup()
+
+
+def register(volume, reference, twopass=False, output_transform=False, workspace=None):
     """Register the input image to the reference image
 
     Parameters
     ----------
     volume : str or nibabel.nifti1.Nifti1Image
-    reference : str or nibabel.nifti1.Nifti1Image
+    reference : str or nibabel.nifti1.Nifti1Image or None
+        None uses the reference already staged in ``workspace``
     output_transform : bool
     twopass : bool
+    workspace : RegistrationWorkspace or None
+        Workspace to reuse across calls. None creates a temporary one for this call
 
     """
-    temp_directory = tempfile.TemporaryDirectory()
+    t0 = time.time()
+    temporary_workspace = workspace is None
+    if temporary_workspace:
+        workspace = RegistrationWorkspace()
 
-    if isinstance(reference, str):
-        reference_path = reference
-    else:
-        reference_path = utils.get_temporary_path(directory=temp_directory.name,
-                                                  extension='.nii.gz')
-        nibabel.save(reference, reference_path)
+    if reference is not None:
+        workspace.stage_reference(reference)
 
-    if isinstance(volume, str):
-        volume_path = volume
-    else:
-        volume_path = utils.get_temporary_path(directory=temp_directory.name, extension='.nii.gz')
-        nibabel.save(volume, volume_path)
+    volume_path = workspace.stage_volume(volume)
 
-    registered_volume_path = utils.get_temporary_path(directory=temp_directory.name,
-                                                      extension='.nii')
-    cmd = shlex.split('3dvolreg -base {} -prefix {}'.format(reference_path,
-                                                            registered_volume_path))
+    cmd = shlex.split('3dvolreg -base {} -prefix {}'.format(workspace.reference_path,
+                                                            workspace.registered_volume_path))
     if output_transform:
-        transform_path = utils.get_temporary_path(temp_directory.name, extension='.aff12.1D')
-        cmd.extend(['-1Dmatrix_save', transform_path])
+        cmd.extend(['-1Dmatrix_save', workspace.transform_path])
     if twopass:
         cmd.append('-twopass')
 
@@ -100,15 +179,25 @@ def register(volume, reference, twopass=False, output_transform=False):
 
     env = os.environ.copy()
     env['AFNI_NIFTI_TYPE_WARN'] = 'NO'
+    t1 = time.time()
     error_message = utils.run_command(cmd, raise_errors=False, env=env)
     if error_message is not None:
         logger.debug(error_message)
+    t2 = time.time()
+
+    registered_volume = nibabel.load(workspace.registered_volume_path, mmap=False)
+    registered_volume = nibabel.Nifti1Image(np.asanyarray(registered_volume.dataobj),
+                                            registered_volume.affine, registered_volume.header)
+
+    if output_transform:
+        xfm = load_afni_xfm(workspace.transform_path)
 
-    registered_volume = nibabel.load(registered_volume_path)
-    registered_volume.get_data()
+    t3 = time.time()
+    workspace.timings = {'stage': t1 - t0, 'register': t2 - t1, 'load': t3 - t2}
+    if temporary_workspace:
+        workspace.cleanup()
 
     if output_transform:
-        xfm = load_afni_xfm(transform_path)
         return registered_volume, xfm
 
     else:
@@ -123,6 +212,43 @@ def mosaic_to_volume(mosaic, nrows=6, ncols=6):
     return volume
 
 
+def encode_array_image(array, image_format='png'):
+    """Encode a 2D array as an image
+
+    Arrays that are not uint8 are scaled to the range of uint8, with missing values drawn in gray.
+    Arrays that are wider than they are tall (fewer rows than columns) are transposed, so that
+    images are drawn in portrait orientation.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+    image_format : str
+        ``png`` or ``jpeg``
+
+    Returns
+    -------
+    The image as a base64 data URI, which can be used as the source of a plotly image
+    """
+    if array.dtype != np.dtype('uint8'):
+        array = np.array(array, dtype='float32')
+        missing = np.isnan(array)
+        if missing.all():
+            array[:] = 0.5
+        else:
+            low, high = np.nanmin(array), np.nanmax(array)
+            array = (array - low) / (high - low if high > low else 1.)
+            array[missing] = 0.5
+        array = (array * 255).astype('uint8')
+
+    if array.shape[0] < array.shape[1]:
+        array = array.T
+
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format=image_format.upper())
+    encoded = base64.b64encode(buffer.getvalue()).decode('ascii')
+    return f'data:image/{image_format};base64,{encoded}'
+
+
 def decompose_affine(affine):
     """Decompose a affine matrix into pitch, roll, and yaw, x, y, z displacement components
 
@@ -1,21 +1,22 @@
 #!/usr/bin/env python3
-import os
 import os.path as op
 import pickle
+import threading
 import time
 import warnings
 from uuid import uuid4
 
 import dash_core_components as dcc
 import dash_html_components as html
-import nibabel as nib
 import numpy as np
 import redis
 import yaml
-from sklearn import linear_model
+from scipy import sparse
+from sklearn import discriminant_analysis, linear_model, svm
 
 import cortex
-from realtimefmri import buffered_array, config, image_utils, pipeline_utils
+from realtimefmri import (buffered_array, config, cortex_cache, image_utils, pipeline_utils,
+                          recording, registration, utils)
 from realtimefmri.utils import get_logger
 
 logger = get_logger('preprocess', to_console=True, to_network=True)
@@ -249,13 +250,19 @@ class Pipeline():
 
     @staticmethod
     def create_interface(key):
+        # read the parameters of all steps at once and group them by step
+        steps = {}
+        for parameter_key, value in utils.scan_and_get(key + b':*').items():
+            step_key, parameter_name = parameter_key.rsplit(b':', maxsplit=1)
+            steps.setdefault(step_key, {})[parameter_name] = pickle.loads(value)
+
         contents = []
-        for class_name_key in r.scan_iter(key + b':*:class_name'):
-            class_name = pickle.loads(r.get(class_name_key))
-            step_index = int(class_name_key.split(b':')[2].decode('utf-8'))
-            step_class = pipeline_utils.load_class(class_name)
-            step_key = class_name_key.rsplit(b':', maxsplit=1)[0]
-            interface = step_class.interface(step_key)
+        for step_key, parameters in steps.items():
+            if b'class_name' not in parameters:
+                continue
+            step_index = int(step_key.split(b':')[2].decode('utf-8'))
+            step_class = pipeline_utils.load_class(parameters[b'class_name'])
+            interface = step_class.interface(step_key, parameters)
             contents.append([step_index, interface])
 
         contents = sorted(contents, key=lambda x: x[0])
@@ -265,9 +272,18 @@ class Pipeline():
 
     def register(self):
         """Register the pipeline to the redis database
+
+        The key of the most recently registered pipeline is stored at ``pipelines:latest``, and
+        the steps that send data to the dashboard add themselves to the hash
+        ``dashboard:sources:<pipeline_key>``, so that the web interface finds them without
+        scanning the database.
         """
         pipeline_key = f'pipeline:{id(self)}'
         logger.debug('Registering pipeline %s', pipeline_key)
+        pipe = r.pipeline()
+        pipe.delete(f'dashboard:sources:{pipeline_key}')
+        pipe.set('pipelines:latest', pipeline_key)
+        pipe.execute()
         for step_index, step in enumerate(self.pipeline):
             step_key = f'{pipeline_key}:{step_index}'
             step['instance'].register(step_key)
@@ -298,17 +314,25 @@ class PreprocessingStep():
         self._key = key
 
     @staticmethod
-    def interface(step_key):
+    def interface(step_key, parameters=None):
         """Define an interface element for the control panel
+
+        Parameters
+        ----------
+        step_key : bytes
+        parameters : dict or None
+            The unpickled parameters of the step, keyed by name. If None, they are loaded from
+            the database
         """
         step_id = step_key.decode('utf-8').replace(':', '-')
 
-        step = {}
-        for key in r.scan_iter(step_key + b':*'):
-            param_name = key.rsplit(b':', maxsplit=1)[1]
-            val = r.get(key)
-            step[param_name] = pickle.loads(val)
+        if parameters is None:
+            parameters = {}
+            for key, val in utils.scan_and_get(step_key + b':*').items():
+                param_name = key.rsplit(b':', maxsplit=1)[1]
+                parameters[param_name] = pickle.loads(val)
 
+        step = dict(parameters)
         name = step.pop(b'class_name')
         contents = [html.H3(step_key.decode('utf-8')), html.H3(name)]
         for k, v in step.items():
@@ -324,8 +348,9 @@ class PreprocessingStep():
         pass
 
     def update_state(self):
-        for k in self._parameters.keys():
-            v = r.get(self._key + f':{k}')
+        names = list(self._parameters.keys())
+        values = utils.get_many([self._key + f':{k}' for k in names])
+        for k, v in zip(names, values):
             v = pickle.loads(v)
             logger.debug(f'Setting {k} to {v}')
             setattr(self, k, v)
@@ -340,61 +365,66 @@ class Debug(PreprocessingStep):
 
 
 class SaveNifti(PreprocessingStep):
-    """Saves nifti images to files
+    """Writes incoming images to a 4D recording
+
+    Appends each incoming image to a single 4D recording in the ``volumes`` subfolder of the
+    recording directory (see :mod:`realtimefmri.recording`), not to one nifti file per image.
+    Volumes are written and synced to disk by a background thread, so saving does not delay the
+    pipeline. Use ``recording.Recording(directory).export_nifti(path)`` to save the recording as a
+    4D nifti file.
 
-    Creates a subfolder in the recording directory and saves each incoming
-    image as a nifti file.
+    If the pipeline is restarted with the ``recording_id`` of an existing recording, the
+    recording is resumed: volumes that were written but not yet synced to the index when the
+    previous pipeline stopped are discarded, and new volumes are appended after the last indexed
+    volume.
 
     Parameters
     ----------
     recording_id : str
         Unique identifier for the run
-    path_format : str
-        Filename formatting string that is compatible with "%" string
-        formatting. Must be able to format an integer containing the TR number.
+    fsync_interval : float
+        Seconds between syncs of the recording to disk
+    path_format : str or None
+        Ignored. Images used to be saved to one file per image named with this format
 
     Attributes
     ----------
-    recording_id : str
-        Unique identifier for the run
-    path_format : str
-        Filename formatting string that is compatible with "%" string
-        formatting. Must be able to format an integer containing the TR number.
+    recording_dir : str
+        Directory of the recording
+    writer : recording.RecordingWriter
 
     Methods
     --------
-    run(inp)
-        Saves the input image to a file and iterates the counter.
+    run(inp, image_number)
+        Queues the input image to be appended to the recording.
     """
 
-    def __init__(self, *args, recording_id=None, path_format='volume_{:04}.nii', **kwargs):
-        parameters = {'recording_id': recording_id, 'path_format': path_format}
+    def __init__(self, *args, recording_id=None, fsync_interval=1., path_format=None, **kwargs):
+        parameters = {'recording_id': recording_id, 'fsync_interval': fsync_interval}
         parameters.update(kwargs)
         super(SaveNifti, self).__init__(**parameters)
 
+        if path_format is not None:
+            warnings.warn('SaveNifti writes a single 4D recording, path_format is ignored')
+
         if recording_id is None:
             recording_id = str(uuid4())
-        recording_dir = op.join(config.RECORDING_DIR, recording_id, 'nifti')
-        try:
-            os.makedirs(recording_dir)
-        except OSError:
-            pass
+        recording_dir = op.join(config.RECORDING_DIR, recording_id, 'volumes')
 
-        print(recording_dir)
+        logger.info('Saving volumes to %s', recording_dir)
         self.recording_dir = recording_dir
-        self.path_format = path_format
+        self.writer = recording.RecordingWriter(recording_dir, fsync_interval=fsync_interval)
 
     def run(self, inp, image_number):
-        path = self.path_format.format(image_number)
-        nib.save(inp, op.join(self.recording_dir, path))
-        print('saving to {}'.format(op.join(self.recording_dir, path)))
+        self.writer.append(int(image_number), inp)
 
 
 class MotionCorrect(PreprocessingStep):
     """Motion corrects images to a reference image
 
-    Uses AFNI ``3dvolreg`` to motion correct the incoming images to a reference
-    image stored in the pycortex database.
+    Motion corrects the incoming images to a reference image stored in the pycortex database,
+    either with AFNI ``3dvolreg`` or with the in-process rigid-body registration in
+    :mod:`realtimefmri.registration`.
 
     Parameters
     ----------
@@ -402,6 +432,20 @@ class MotionCorrect(PreprocessingStep):
         surface name in pycortex filestore
     transform : str
         Transform name for the surface in pycortex filestore
+    engine : str
+        ``afni`` to run ``3dvolreg`` on each image, ``native`` to register in-process. The native
+        engine keeps the reference in memory and starts from the previous image's transform. Both
+        engines output the transform from input to reference DICOM coordinates, as saved by
+        ``3dvolreg -1Dmatrix_save``
+    max_iterations : int
+        Maximum number of iterations per image (native engine only)
+    tolerance : float
+        Convergence tolerance in mm (native engine only)
+    levels : int
+        Number of coarse-to-fine pyramid levels (native engine only)
+    refine_tolerance : float
+        Skip finer pyramid levels when the coarser levels moved the transform by less than this
+        many mm. Larger values trade accuracy for latency (native engine only)
 
     Attributes
     ----------
@@ -409,6 +453,10 @@ class MotionCorrect(PreprocessingStep):
         Affine transform for the reference image
     reference_path : str
         Path to the reference image
+    registration : realtimefmri.registration.RigidRegistration
+        The in-process registration, if ``engine`` is ``native``
+    workspace : realtimefmri.image_utils.RegistrationWorkspace
+        RAM-backed staging directory for ``3dvolreg``, if ``engine`` is ``afni``
 
     Methods
     -------
@@ -416,18 +464,41 @@ class MotionCorrect(PreprocessingStep):
         Motion corrects the incoming image to the provided reference image and
         returns the motion corrected volume
     """
-    def __init__(self, surface, transform, *args, twopass=False, output_transform=False, **kwargs):
+    def __init__(self, surface, transform, *args, twopass=False, output_transform=False,
+                 engine='afni', max_iterations=10, tolerance=0.01, levels=1, refine_tolerance=0.,
+                 **kwargs):
         parameters = {'surface': surface, 'transform': transform, 'twopass': twopass,
-                      'output_transform': output_transform}
+                      'output_transform': output_transform, 'engine': engine,
+                      'max_iterations': max_iterations, 'tolerance': tolerance,
+                      'levels': levels, 'refine_tolerance': refine_tolerance}
         parameters.update(kwargs)
         super(MotionCorrect, self).__init__(**parameters)
 
-        reference = cortex.db.get_xfm(surface, transform).reference
+        if engine not in ('afni', 'native'):
+            raise ValueError(f'Unknown motion correction engine {engine}')
+
+        reference, reference_affine, reference_path = cortex_cache.get_reference(surface,
+                                                                                 transform)
 
-        self.reference_affine = reference.affine
-        self.reference_path = reference.get_filename()
+        self.reference_affine = reference_affine
+        self.reference_path = reference_path
         self.twopass = twopass
         self.output_transform = output_transform
+        self.engine = engine
+
+        if engine == 'native':
+            self.registration = registration.RigidRegistration(reference, reference_affine,
+                                                               max_iterations=max_iterations,
+                                                               tolerance=tolerance,
+                                                               levels=levels,
+                                                               refine_tolerance=refine_tolerance)
+        else:
+            self.workspace = image_utils.RegistrationWorkspace()
+            self.workspace.stage_reference(self.reference_path)
+
+    def reset(self):
+        if self.engine == 'native':
+            self.registration.reset()
 
     def run(self, input_volume):
         same_affine = np.allclose(input_volume.affine[:3, :3],
@@ -437,8 +508,91 @@ class MotionCorrect(PreprocessingStep):
             logger.info(self.reference_affine)
             warnings.warn('Input and reference volumes have different affines.')
 
-        return image_utils.register(input_volume, self.reference_path,
-                                    twopass=self.twopass, output_transform=self.output_transform)
+        if self.engine == 'native':
+            registered_volume, xfm = self.registration.register(input_volume)
+            logger.info('Registered in %s iterations, reached pyramid level %d',
+                        self.registration.n_iterations, self.registration.level)
+            if self.output_transform:
+                return registered_volume, xfm
+            else:
+                return registered_volume
+
+        outp = image_utils.register(input_volume, None, twopass=self.twopass,
+                                    output_transform=self.output_transform,
+                                    workspace=self.workspace)
+        timings = self.workspace.timings
+        logger.debug('3dvolreg ran in %.4f seconds (staging %.4f, loading %.4f)',
+                     timings['register'], timings['stage'], timings['load'])
+        return outp
+
+
+class MotionCorrectAndMask(PreprocessingStep):
+    """Motion correct an image and extract the voxels in a pycortex mask
+
+    Equivalent to ``MotionCorrect`` (with the native engine), ``NiftiToVolume`` and ``ApplyMask``
+    in sequence, but the motion corrected image is only interpolated at the voxels in the mask.
+    The output is ordered like ``volume[mask]``.
+
+    Parameters
+    ----------
+    surface : str
+        surface name in pycortex filestore
+    transform : str
+        Transform name for the surface in pycortex filestore
+    mask_type : str
+        Type of mask
+    output_transform : bool
+        Also return the affine transform, as ``MotionCorrect`` does
+    max_iterations, tolerance, levels, refine_tolerance
+        See ``MotionCorrect``
+    order : int
+        Spline interpolation order used to resample the masked voxels
+    dtype : str
+        Data type of the output vector
+
+    Attributes
+    ----------
+    registration : realtimefmri.registration.RigidRegistration
+    mask_voxels : numpy.ndarray
+        3 x n array of the reference voxel indices (in nifti order) of the mask
+    """
+    def __init__(self, surface, transform, *args, mask_type=None, output_transform=False,
+                 max_iterations=10, tolerance=0.01, levels=1, refine_tolerance=0., order=1,
+                 dtype='float32', **kwargs):
+        parameters = {'surface': surface, 'transform': transform, 'mask_type': mask_type,
+                      'output_transform': output_transform, 'max_iterations': max_iterations,
+                      'tolerance': tolerance, 'levels': levels,
+                      'refine_tolerance': refine_tolerance, 'order': order, 'dtype': dtype}
+        parameters.update(kwargs)
+        super(MotionCorrectAndMask, self).__init__(**parameters)
+
+        reference, reference_affine, _ = cortex_cache.get_reference(surface, transform)
+        self.registration = registration.RigidRegistration(reference, reference_affine,
+                                                           max_iterations=max_iterations,
+                                                           tolerance=tolerance, order=order,
+                                                           levels=levels,
+                                                           refine_tolerance=refine_tolerance)
+
+        # mask is in zyx, voxel indices are in xyz
+        mask_indices, mask_shape = cortex_cache.get_mask_indices(surface, transform, mask_type)
+        self.mask_voxels = np.array(np.unravel_index(mask_indices, mask_shape)[::-1],
+                                    dtype='float32')
+        self.output_transform = output_transform
+        self.dtype = dtype
+
+    def reset(self):
+        self.registration.reset()
+
+    def run(self, input_volume):
+        responses, xfm = self.registration.register_voxels(input_volume, self.mask_voxels)
+        logger.info('Registered in %s iterations, reached pyramid level %d',
+                    self.registration.n_iterations, self.registration.level)
+        responses = responses.astype(self.dtype, copy=False)
+
+        if self.output_transform:
+            return responses, xfm
+        else:
+            return responses
 
 
 class Function(PreprocessingStep):
@@ -455,9 +609,23 @@ class Function(PreprocessingStep):
 class NiftiToVolume(PreprocessingStep):
     """Extract data volume from Nifti image. Translates image dimensions to be consistent with
     pycortex convention, e.g., volume shape is (30, 100, 100)
+
+    This is where incoming data are cast to the pipeline ``dtype``. Steps downstream preserve the
+    dtype of their input, so the cast happens once per volume.
+
+    Parameters
+    ----------
+    dtype : str
+        Data type of the output volume
     """
+    def __init__(self, *args, dtype='float32', **kwargs):
+        parameters = {'dtype': dtype}
+        parameters.update(kwargs)
+        super(NiftiToVolume, self).__init__(**parameters)
+        self.dtype = dtype
+
     def run(self, nii):
-        return nii.get_data().T
+        return np.asanyarray(nii.dataobj).astype(self.dtype, copy=False).T
 
 
 class VolumeToMosaic(PreprocessingStep):
@@ -485,15 +653,14 @@ class ApplyMask(PreprocessingStep):
 
     Attributes
     ----------
-    mask : numpy.ndarray
-        Boolean voxel mask
+    mask_indices : numpy.ndarray
+        Flat indices of the voxels in the mask, in the order of ``volume[mask]``
     """
     def __init__(self, surface, transform, *args, mask_type=None, **kwargs):
         parameters = {'surface': surface, 'transform': transform, 'mask_type': mask_type}
         parameters.update(kwargs)
         super(ApplyMask, self).__init__(**parameters)
-        mask = cortex.db.get_mask(surface, transform, mask_type)
-        self.mask = mask
+        self.mask_indices, _ = cortex_cache.get_mask_indices(surface, transform, mask_type)
 
     def run(self, volume):
         """Apply the mask to a volume
@@ -502,7 +669,7 @@ class ApplyMask(PreprocessingStep):
         -----------
         volume : array
         """
-        return volume[self.mask]
+        return np.take(volume, self.mask_indices)
 
 
 class ArrayMean(PreprocessingStep):
@@ -512,12 +679,15 @@ class ArrayMean(PreprocessingStep):
     ----------
     dimensions : tuple of int
         Dimensions along which to take the mean. None takes the mean of all values in the array
+    dtype : str
+        Data type of the mean. The sum is accumulated in float64
     """
-    def __init__(self, dimensions, *args, **kwargs):
-        parameters = {'dimensions': dimensions}
+    def __init__(self, dimensions, *args, dtype='float32', **kwargs):
+        parameters = {'dimensions': dimensions, 'dtype': dtype}
         parameters.update(kwargs)
         super(ArrayMean, self).__init__(**parameters)
         self.dimensions = tuple(dimensions)
+        self.dtype = dtype
 
     def run(self, array):
         """Take the mean of the array along the specified dimensions
@@ -527,9 +697,9 @@ class ArrayMean(PreprocessingStep):
         array : array
         """
         if self.dimensions is None:
-            return np.mean(array)
+            return np.mean(array, dtype='float64').astype(self.dtype)
         else:
-            return np.mean(array, axis=self.dimensions)
+            return np.mean(array, axis=self.dimensions, dtype='float64').astype(self.dtype)
 
 
 class ApplySecondaryMask(PreprocessingStep):
@@ -555,8 +725,8 @@ class ApplySecondaryMask(PreprocessingStep):
     Attributes
     ----------
     mask : numpy.ndarray
-       A boolean vector that selects elements from the vector output of primary
-       mask applied to a volume that are also in secondary mask.
+       Indices of the elements of the vector output of primary mask applied to
+       a volume that are also in secondary mask.
 
     Methods
     -------
@@ -569,9 +739,8 @@ class ApplySecondaryMask(PreprocessingStep):
                       'mask_type_1': mask_type_1, 'mask_type_2': mask_type_2}
         parameters.update(kwargs)
         super(ApplySecondaryMask, self).__init__(**parameters)
-        mask1 = cortex.db.get_mask(surface, transform, mask_type_1).T  # in xyz
-        mask2 = cortex.db.get_mask(surface, transform, mask_type_2).T  # in xyz
-        self.mask = image_utils.secondary_mask(mask1, mask2, order='F')
+        self.mask = cortex_cache.get_secondary_mask_indices(surface, transform,
+                                                            mask_type_1, mask_type_2)
 
     def run(self, x):
         if x.ndim > 1:
@@ -580,8 +749,18 @@ class ApplySecondaryMask(PreprocessingStep):
 
 
 class ActivityRatio(PreprocessingStep):
-    def __init__(self, *args, **kwargs):
-        super(ActivityRatio, self).__init__(**kwargs)
+    """Ratio of the activity in one region to the total activity in two regions
+
+    Parameters
+    ----------
+    dtype : str
+        Data type of the ratio
+    """
+    def __init__(self, *args, dtype='float32', **kwargs):
+        parameters = {'dtype': dtype}
+        parameters.update(kwargs)
+        super(ActivityRatio, self).__init__(**parameters)
+        self.dtype = dtype
 
     def run(self, x1, x2):
         if isinstance(x1, np.ndarray):
@@ -589,13 +768,17 @@ class ActivityRatio(PreprocessingStep):
         if isinstance(x2, np.ndarray):
             x2 = np.nanmean(x2)
 
-        return x1 / (x1 + x2)
+        return np.dtype(self.dtype).type(x1 / (x1 + x2))
 
 
 class RoiActivity(PreprocessingStep):
     """Extract activity from an ROI.
 
-    Placeholder
+    The ROIs are compiled into a sparse (ROIs x voxels) indicator matrix when the step is
+    initialized, so the means of all ROIs are computed with one sparse matrix-vector product.
+    NaN voxels are excluded from the mean of their ROI. ROIs that are not in the pycortex overlay
+    are left out with a warning, and the names of the output columns are stored in the database
+    at ``<key>:columns`` when the step is registered.
 
     Parameters
     ----------
@@ -610,44 +793,62 @@ class RoiActivity(PreprocessingStep):
         the gray matter activity vector.
     roi_names : list of str
         names of the ROIs to extract
+    dtype : str
+        Data type of the output array
 
     Attributes
     ----------
     masks : dict
-        A dictionary containing the voxel masks for each named ROI
+        A dictionary containing the voxel indices for each named ROI
+    roi_names : list of str
+        Names of the ROIs found in pycortex, in the order of the output array
+    roi_matrix : scipy.sparse.csr_matrix
+        Sparse (ROIs x voxels) indicator matrix
 
     Methods
     -------
     run():
-        Returns a list of floats of mean activity in the requested ROIs
+        Returns an array of mean activity in each ROI, ordered like ``roi_names``
     """
-    def __init__(self, surface, transform, pre_mask_name, roi_names, *args, **kwargs):
+    def __init__(self, surface, transform, pre_mask_name, roi_names, *args, dtype='float32',
+                 **kwargs):
         parameters = {'surface': surface, 'transform': transform,
-                      'pre_mask_name': pre_mask_name, 'roi_names': roi_names}
+                      'pre_mask_name': pre_mask_name, 'roi_names': roi_names, 'dtype': dtype}
         parameters.update(kwargs)
         super(RoiActivity, self).__init__(**parameters)
 
         subj_dir = config.get_subject_directory(surface)
         pre_mask_path = op.join(subj_dir, pre_mask_name + '.nii')
 
-        # mask in zyx
-        pre_mask = nib.load(pre_mask_path).get_data().T.astype(bool)
+        masks, n_voxels = cortex_cache.get_roi_indices(surface, transform, pre_mask_path,
+                                                       roi_names)
+        self.masks = masks
+        self.roi_names = [name for name in roi_names if name in masks]
+        self.dtype = dtype
+
+        missing = [name for name in roi_names if name not in masks]
+        if len(missing) > 0:
+            warnings.warn(f'ROIs {missing} are not in the {surface} overlay. Omitting them.')
 
-        # returns masks in zyx
-        roi_masks, roi_dict = cortex.get_roi_masks(surface, transform, roi_names)
+        indices = [masks[name] for name in self.roi_names]
+        rows = np.repeat(np.arange(len(indices)), [len(i) for i in indices])
+        columns = np.concatenate(indices) if indices else np.array([], dtype=int)
+        self.roi_matrix = sparse.csr_matrix((np.ones(len(columns), 'float32'), (rows, columns)),
+                                            shape=(len(indices), n_voxels))
 
-        self.masks = dict()
-        for name, mask_value in roi_dict.items():
-            roi_mask = roi_masks == mask_value
-            self.masks[name] = image_utils.secondary_mask(pre_mask, roi_mask)
+    def register(self, key):
+        """Register the step, and store the ROI name of each output column at ``<key>:columns``
+        """
+        super(RoiActivity, self).register(key)
+        r.set(key + ':columns', pickle.dumps(self.roi_names))
 
     def run(self, activity):
-        if activity.ndim > 1:
-            activity = activity.reshape(-1, 1)
-        roi_activities = dict()
-        for name, mask in self.masks.items():
-            roi_activities[name] = float(activity[mask].mean())
-        return roi_activities
+        activity = activity.ravel()
+        finite = np.isfinite(activity)
+        sums = self.roi_matrix.dot(np.where(finite, activity, 0))
+        counts = self.roi_matrix.dot(finite.astype('float32'))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums / counts).astype(self.dtype)
 
 
 class WMDetrend(PreprocessingStep):
@@ -662,6 +863,8 @@ class WMDetrend(PreprocessingStep):
         Subject identifier
     model_name : str
         Name of the pre-trained white matter detrending model
+    dtype : str
+        Data type of the detrended activity
 
     Attributes
     ----------
@@ -676,10 +879,11 @@ class WMDetrend(PreprocessingStep):
         Returns detrended grey matter activity given raw gray and white matter
         activity
     """
-    def __init__(self, subject, *args, model_name=None, **kwargs):
-        parameters = {'subject': subject, 'model_name': model_name}
+    def __init__(self, subject, *args, model_name=None, dtype='float32', **kwargs):
+        parameters = {'subject': subject, 'model_name': model_name, 'dtype': dtype}
         parameters.update(kwargs)
         super(WMDetrend, self).__init__(**parameters)
+        self.dtype = dtype
         subj_dir = config.get_subject_directory(subject)
 
         model_path = op.join(subj_dir, 'model-%s.pkl' % model_name)
@@ -697,12 +901,26 @@ class WMDetrend(PreprocessingStep):
     def run(self, wm_activity, gm_activity):
         wm_activity_pcs = self.pca.transform(wm_activity.reshape(1, -1)).reshape(1, -1)
         gm_trend = self.model.predict(wm_activity_pcs)
-        return gm_activity - gm_trend
+        return (gm_activity - gm_trend).astype(self.dtype, copy=False)
 
 
 class IncrementalMeanStd(PreprocessingStep):
     """Preprocessing module that z-scores data using running mean and variance
+
+    Samples are stored in the dtype of the incoming array. Sums are accumulated in float64 and
+    the mean and standard deviation are returned as ``dtype``.
+
+    Parameters
+    ----------
+    dtype : str
+        Data type of the returned mean and standard deviation
     """
+    def __init__(self, *args, dtype='float32', **kwargs):
+        parameters = {'dtype': dtype}
+        parameters.update(kwargs)
+        super(IncrementalMeanStd, self).__init__(**parameters)
+        self.dtype = dtype
+
     def run(self, array):
         """Run the z-scoring on one time point and update the prior
 
@@ -724,8 +942,8 @@ class IncrementalMeanStd(PreprocessingStep):
 
         self.data.append(array.ravel())
 
-        std = np.std(self.data.get_array(), 0)
-        mean = np.mean(self.data.get_array(), 0)
+        std = np.std(self.data.get_array(), 0, dtype='float64').astype(self.dtype)
+        mean = np.mean(self.data.get_array(), 0, dtype='float64').astype(self.dtype)
 
         return mean.reshape(self.array_shape), std.reshape(self.array_shape)
 
@@ -744,6 +962,9 @@ class RunningMeanStd(PreprocessingStep):
     n : int
         The number of past samples over which to compute mean and standard
         deviation
+    dtype : str
+        Data type of the stored samples and of the returned mean and standard
+        deviation. Sums are accumulated in float64.
 
     Attributes
     ----------
@@ -763,55 +984,68 @@ class RunningMeanStd(PreprocessingStep):
         Adds the input vector to the stored samples (discard the oldest sample)
         and compute and return the mean and standard deviation.
     """
-    def __init__(self, *args, n=20, n_skip=5, **kwargs):
-        parameters = {'n': n, 'n_skip': n_skip}
+    def __init__(self, *args, n=20, n_skip=5, dtype='float32', **kwargs):
+        parameters = {'n': n, 'n_skip': n_skip, 'dtype': dtype}
         parameters.update(kwargs)
         super(RunningMeanStd, self).__init__(**parameters)
         self.n = n
         self.mean = None
         self.samples = None
         self.n_skip = n_skip
+        self.dtype = dtype
 
     def run(self, inp, image_number=None):
         if image_number < self.n_skip:
-            return np.zeros(inp.size), np.ones(inp.size)
+            return np.zeros(inp.size, self.dtype), np.ones(inp.size, self.dtype)
 
         if self.mean is None:
-            self.samples = np.empty((self.n, inp.size)) * np.nan
+            self.samples = np.full((self.n, inp.size), np.nan, self.dtype)
         else:
             self.samples[:-1, :] = self.samples[1:, :]
 
         self.samples[-1, :] = inp
-        self.mean = np.nanmean(self.samples, 0)
-        self.std = np.nanstd(self.samples, 0)
+        self.mean = np.nanmean(self.samples, 0, dtype='float64').astype(self.dtype)
+        self.std = np.nanstd(self.samples, 0, dtype='float64').astype(self.dtype)
         return self.mean, self.std
 
 
 class ZScore(PreprocessingStep):
     """Compute a z-scored version of an input array given precomputed means and standard deviations
 
+    Parameters
+    ----------
+    dtype : str
+        Data type of the z-scored array
+
     Methods
     -------
     run(inp, mean, std)
         Return the z-scored version of the data
     """
+    def __init__(self, *args, dtype='float32', **kwargs):
+        parameters = {'dtype': dtype}
+        parameters.update(kwargs)
+        super(ZScore, self).__init__(**parameters)
+        self.dtype = dtype
+
     def run(self, array, mean, std):
         if mean is None:
-            zscored_array = np.zeros_like(array)
+            zscored_array = np.zeros_like(array, dtype=self.dtype)
         else:
-            zscored_array = (array - mean) / std
+            zscored_array = ((array - mean) / std).astype(self.dtype, copy=False)
 
         return zscored_array
 
 
 class AggregateTimestampedVolumes(PreprocessingStep):
-    def __init__(self, *args, active=True, buffer_size=1000, **kwargs):
-        parameters = {'active': active, 'buffer_size': buffer_size}
+    def __init__(self, *args, active=True, buffer_size=1000, dtype='float32', **kwargs):
+        parameters = {'active': active, 'buffer_size': buffer_size, 'dtype': dtype}
         parameters.update(kwargs)
         super(AggregateTimestampedVolumes, self).__init__(**parameters)
 
         self.active = active
         self.buffer_size = buffer_size
+        self.dtype = dtype
 
     def reset(self):
         pass
@@ -821,8 +1055,11 @@ class AggregateTimestampedVolumes(PreprocessingStep):
 
         if not hasattr(self, 'array'):
             n_samples = array.size
-            self.times = buffered_array.BufferedArray(size=1, buffer_size=self.buffer_size)
-            self.array = buffered_array.BufferedArray(size=n_samples, buffer_size=self.buffer_size)
+            # timestamps are seconds since the epoch and need float64 precision
+            self.times = buffered_array.BufferedArray(size=1, dtype='float64',
+                                                      buffer_size=self.buffer_size)
+            self.array = buffered_array.BufferedArray(size=n_samples, dtype=self.dtype,
+                                                      buffer_size=self.buffer_size)
             self.n_samples = n_samples
 
         if self.active:
@@ -842,74 +1079,253 @@ class SklearnPredictor(PreprocessingStep):
     """Run the `.predict` method of a scikit-learn predictor on incoming
     activity. Returns the predicted output.
 
+    For linear predictors (see ``linear_predictors``) the coefficients are extracted when the
+    predictor is loaded and each prediction is a single matrix-vector product followed by a
+    threshold or argmax, skipping the input validation done by ``predict``. The fast path is
+    checked against ``predict`` on random activity when it is loaded, and ``predict`` is used for
+    other predictors or if the check fails.
+
     Parameters
     ----------
     surface : str
         subject/surface ID
     pickled_predictor : str
         filename of the pickle file containing the trained classifier
+    nan_to_num : bool
+        Replace non-finite values in the activity with finite values before predicting
+    exact : bool
+        If True, compute predictions with the dtype of the predictor's coefficients, which gives
+        exactly the same output as ``predict``. If False, cast the coefficients to ``dtype``,
+        which is faster but can change predictions for activity close to a decision boundary
+    dtype : str
+        Data type used for the linear fast path when ``exact`` is False
 
     Attributes
     ----------
     predictor : sklearn fitted learner
+    coef : numpy.ndarray or None
+        Coefficients of a linear predictor, None if ``predict`` is used
+    intercept : numpy.ndarray or None
+    classes : numpy.ndarray or None
+        Class labels of a linear classifier, None for regressors
 
     Methods
     -------
     run():
         Returns the prediction
     """
+    linear_predictors = (linear_model.LinearRegression, linear_model.Ridge,
+                         linear_model.RidgeClassifier, linear_model.LogisticRegression,
+                         svm.LinearSVC, discriminant_analysis.LinearDiscriminantAnalysis)
 
-    def __init__(self, surface, pickled_predictor, *args, nan_to_num=True, **kwargs):
+    def __init__(self, surface, pickled_predictor, *args, nan_to_num=True, exact=True,
+                 dtype='float32', **kwargs):
         parameters = {'surface': surface, 'pickled_predictor': pickled_predictor,
-                      'nan_to_num': nan_to_num}
+                      'nan_to_num': nan_to_num, 'exact': exact, 'dtype': dtype}
         parameters.update(kwargs)
         super(SklearnPredictor, self).__init__(**parameters)
         subj_dir = config.get_subject_directory(surface)
         pickled_path = op.join(subj_dir, pickled_predictor)
         self.predictor = pickle.load(open(pickled_path, 'rb'))
         self.nan_to_num = nan_to_num
+        self.exact = exact
+        self.dtype = dtype
+
+        self.coef = None
+        self.intercept = None
+        self.classes = None
+        if isinstance(self.predictor, self.linear_predictors):
+            self.extract_linear_parameters()
+
+    def extract_linear_parameters(self, n_checks=3):
+        """Extract the coefficients of a linear predictor for the fast prediction path
+
+        Parameters
+        ----------
+        n_checks : int
+            Number of random activity vectors on which the fast path must reproduce
+            ``predict``. The check is skipped when ``exact`` is False
+        """
+        coef = getattr(self.predictor, 'coef_', None)
+        if not isinstance(coef, np.ndarray):  # not fitted or sparsified
+            return
+
+        if self.exact:
+            # keep the dtypes and memory layout of the predictor, which determine the rounding of
+            # the matrix product
+            self.coef = coef
+            self.intercept = np.asarray(self.predictor.intercept_)
+        else:
+            self.coef = np.ascontiguousarray(coef, dtype=self.dtype)
+            self.intercept = np.asarray(self.predictor.intercept_, dtype=self.dtype)
+        self.classes = getattr(self.predictor, 'classes_', None)
+
+        if self.exact:
+            n_features = self.coef.shape[-1]
+            random_state = np.random.RandomState(0)
+            for _ in range(n_checks):
+                activity = random_state.randn(1, n_features).astype(self.dtype)
+                expected = self.predictor.predict(activity)[0]
+                if not np.array_equal(self.predict_linear(activity), expected):
+                    logger.warning('Fast path does not match %s.predict, using predict',
+                                   type(self.predictor).__name__)
+                    self.coef = None
+                    return
+
+    def predict_linear(self, activity):
+        """Predict from a (1, n_features) array with the extracted linear parameters
+        """
+        if not self.exact:
+            activity = activity.astype(self.coef.dtype, copy=False)
+
+        scores = (activity @ self.coef.T + self.intercept)[0]
+        if self.classes is None:
+            return scores
+
+        if scores.ndim == 0 or scores.shape == (1,):
+            return self.classes[int(scores.ravel()[0] > 0)]
+        return self.classes[scores.argmax()]
 
     def run(self, activity):
         activity = activity.ravel()[None]
-        if self.nan_to_num:
+        if not np.isfinite(activity).all():
+            if not self.nan_to_num:  # let predict raise its usual error
+                return self.predictor.predict(activity)[0]
             activity = np.nan_to_num(activity)
 
-        prediction = self.predictor.predict(activity)[0]
-        return prediction
+        if self.coef is None:
+            return self.predictor.predict(activity)[0]
+
+        return self.predict_linear(activity)
 
 
 class SendToDashboard(PreprocessingStep):
     """Send data to the dashboard
 
+    The data are stored in the hash ``dashboard:data:<name>``, with the fields ``type`` (the plot
+    type), ``data`` (the pickled payload) and ``version``, which is incremented with each payload
+    so that the dashboard can skip data that have not changed. Each payload is published on the
+    ``dashboard`` channel, so that the dashboard redraws as soon as new data arrive instead of
+    waiting for its next polling interval. Samples of ``timeseries`` plots are also appended to a
+    bounded buffer at ``dashboard:data:<name>:timeseries`` (see
+    ``utils.append_to_timeseries_buffer``).
+
+    Frames of ``array_image`` plots are encoded as images by a background thread, off the
+    preprocessing critical path. Each encoded frame is stored in the ``image`` field with the
+    version of its payload in the ``image_version`` field. If frames arrive faster than they are
+    encoded, only the newest frame is encoded.
+
     Parameters
     ----------
     name : str
     plot_type : str
         Type of plot
+    image_format : str
+        Format of ``array_image`` frames, ``png`` or ``jpeg``
 
     Attributes
     ----------
     redis : redis connection
     key_name : str
         Name of the key in the redis database
+    n_samples : int
+        Number of samples sent
+    frames_encoded : int
+    frames_dropped : int
+        Number of ``array_image`` frames replaced by a newer frame before they were encoded
     """
-    def __init__(self, name, plot_type='marker', **kwargs):
-        parameters = {'name': name, 'plot_type': plot_type}
+    def __init__(self, name, plot_type='marker', image_format='png', **kwargs):
+        parameters = {'name': name, 'plot_type': plot_type, 'image_format': image_format}
         parameters.update(kwargs)
         super(SendToDashboard, self).__init__(**parameters)
         key_name = 'dashboard:data:' + name
-        r.set(key_name, b'')
-        r.set(key_name + ':type', plot_type)
-        r.set(key_name + ':update', b'true')
+        pipe = r.pipeline()
+        pipe.delete(key_name, key_name + ':timeseries', key_name + ':timeseries:length')
+        pipe.hset(key_name, 'type', plot_type)
+        pipe.execute()
 
         self.redis = r
+        self.name = name
+        self.plot_type = plot_type
+        self.image_format = image_format
         self.key_name = key_name
+        self.n_samples = 0
+
+        self.frames_encoded = 0
+        self.frames_dropped = 0
+        self._pending = None
+        self._lock = threading.Lock()
+        self._frame_available = threading.Event()
+        self._encoder = None
+
+    def register(self, key):
+        """Register the step, and add its data to the dashboard sources of its pipeline
+
+        The sources are stored in the hash ``dashboard:sources:<pipeline_key>``, mapping each data
+        name to the key of the step that sends it.
+        """
+        super(SendToDashboard, self).register(key)
+        pipeline_key = key.rsplit(':', maxsplit=1)[0]
+        r.hset(f'dashboard:sources:{pipeline_key}', self.name, key)
 
     def run(self, *args):
         data = pickle.dumps(args)
         logger.debug('SendToDashboard key_name=%s len(data)=%d', self.key_name, len(data))
-        self.redis.set(self.key_name, data)
-        self.redis.set(self.key_name + ':update', b'true')
+        pipe = self.redis.pipeline()
+        pipe.hset(self.key_name, 'data', data)
+        pipe.hincrby(self.key_name, 'version', 1)
+        if self.plot_type == 'timeseries':
+            values = np.concatenate([np.ravel(arg) for arg in args])
+            utils.append_to_timeseries_buffer(self.key_name + ':timeseries', self.n_samples,
+                                              values, config.DASHBOARD_BUFFER_LENGTH, pipe=pipe)
+        if self.plot_type != 'array_image':
+            # array images are published when they are encoded
+            pipe.publish('dashboard', self.name)
+        version = pipe.execute()[1]
+        self.n_samples += 1
+
+        if self.plot_type == 'array_image':
+            self.queue_frame(version, args[0])
+
+    def queue_frame(self, version, array):
+        """Hand a frame to the encoder thread, replacing any frame that is waiting
+        """
+        if self._encoder is None:
+            self._encoder = threading.Thread(target=self.encode_frames, daemon=True)
+            self._encoder.start()
+
+        with self._lock:
+            if self._pending is not None:
+                self.frames_dropped += 1
+            self._pending = (version, array)
+        self._frame_available.set()
+
+    def encode_frames(self):
+        """Encode and store the newest frame whenever one is available
+        """
+        while True:
+            self._frame_available.wait()
+            with self._lock:
+                pending = self._pending
+                self._pending = None
+                self._frame_available.clear()
+
+            if pending is None:
+                continue
+
+            version, array = pending
+            try:
+                image = image_utils.encode_array_image(np.asarray(array), self.image_format)
+            except Exception:
+                logger.exception('Could not encode %s frame %d', self.name, version)
+                continue
+
+            pipe = self.redis.pipeline()
+            pipe.hset(self.key_name, 'image', image)
+            pipe.hset(self.key_name, 'image_version', version)
+            pipe.publish('dashboard', self.name)
+            pipe.execute()
+            self.frames_encoded += 1
 
 
 class SendToPycortexViewer(PreprocessingStep):
@@ -933,20 +1349,22 @@ class SendToPycortexViewer(PreprocessingStep):
 
 
 class StoreToRedis(PreprocessingStep):
-    """Store to redis database
+    """Store timestamped samples to redis database
 
     Parameters
     ----------
     key_prefix : str
-        Prefix to redis key. Individual samples will be stored to the database with keys that
-        append the current trial index and sample index to this prefix,
-        e.g., responses:trial0000:0000
+        Prefix to redis key. Samples are appended to a list per trial, with keys that append the
+        current trial index to this prefix, e.g., responses:trial0000. See
+        ``realtimefmri.utils.store_timestamped_array_to_redis``
 
     Attributes
     ----------
     index : int
         Incrementing index
     active : bool
+    trial_index : int or None
+        Index of the current trial, None before the first trial
     """
     def __init__(self, key_prefix, *args, active=True, **kwargs):
         parameters = {'key_prefix': key_prefix, 'active': active}
@@ -955,31 +1373,28 @@ class StoreToRedis(PreprocessingStep):
         self.key_prefix = key_prefix
         self.index = 0
         self.active = active
+        self.trial_index = None
 
     def update_state(self):
         super(StoreToRedis, self).update_state()
 
         trial = r.get('experiment:trial:current')
         if trial is None:
-            key = f'{self.key_prefix}:pretrial'
+            self.trial_index = None
 
         else:
             trial = pickle.loads(trial)
-            trial_index = trial['index']
+            self.trial_index = trial['index']
 
-            if trial_index > 9999:
+            if self.trial_index > 9999:
                 warnings.warn('Trial index overflow (max 9999 trials). Sorting trials as strings will fail.')
 
-            key = f'{self.key_prefix}:trial{trial_index:04}'
-
-        self.key = key
-
-    def run(self, *args):
+    def run(self, t, array):
         self.update_state()
 
         if self.active:
-            key = f'{self.key}:{self.index:04}'
-            r.set(key, pickle.dumps(args))
+            key = utils.store_timestamped_array_to_redis(self.key_prefix, t, array,
+                                                         trial_index=self.trial_index)
             self.index += 1
 
             return key
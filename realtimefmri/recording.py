@@ -0,0 +1,443 @@
+"""Append-only storage of 4D recordings
+
+A recording is a directory with three files:
+
+- ``volumes.dat``: the raw volumes, appended one after another in C order
+- ``header.json``: the ``dtype`` and ``shape`` of each volume and the ``affine``
+- ``index.dat``: one record per complete volume, its image number and its position in
+  ``volumes.dat``, as two little-endian int64
+
+Volumes are written by a background thread and synced to disk periodically. A volume is only
+added to the index after its data are synced, and the index is synced after it, so after a crash
+the index lists exactly the volumes that are complete on disk. A partially written index record
+is ignored when the recording is read.
+
+``load_run`` opens a recorded run, or a run saved as one nifti file per volume, as a ``LazyRun``
+that only reads the volumes and voxels that are indexed.
+"""
+import atexit
+import json
+import os
+import os.path as op
+import queue
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+import nibabel
+import numpy as np
+from nibabel import Nifti1Image
+
+from realtimefmri import config
+from realtimefmri.utils import get_logger
+
+logger = get_logger('recording', to_console=True)
+
+INDEX_RECORD = struct.Struct('<qq')
+
+
+def fsync_directory(directory):
+    """Make the creation of files in a directory durable
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # e.g., on Windows
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class RecordingWriter():
+    """Write volumes to a recording without blocking the caller
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the recording. It is created if it does not exist, and volumes are appended
+        to any recording already in it
+    fsync_interval : float
+        Seconds between syncs of the written volumes to disk
+
+    Attributes
+    ----------
+    n_written : int
+        Number of volumes written to ``volumes.dat``
+    n_complete : int
+        Number of volumes synced to disk and added to the index
+    """
+    def __init__(self, directory, fsync_interval=1.):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+
+        self.header = None
+        self.n_written = 0
+        self.n_complete = 0
+        header_path = op.join(directory, 'header.json')
+        if op.exists(header_path):
+            with open(header_path) as f:
+                self.header = json.load(f)
+            self.n_written = self.n_complete = len(read_index(directory))
+
+        self.volumes_file = None
+        self.index_file = None
+        self.queue = queue.Queue()
+        self.thread = None
+        self.error = None
+        atexit.register(self.close)
+
+    def append(self, image_number, volume, affine=None):
+        """Queue a volume to be written
+
+        Parameters
+        ----------
+        image_number : int
+        volume : numpy.ndarray or nibabel.Nifti1Image
+            A 3D volume. All volumes of a recording must have the same shape and dtype
+        affine : numpy.ndarray or None
+            Affine of the recording, taken from the first volume if it is a nifti image
+        """
+        if self.error is not None:
+            raise self.error
+
+        if isinstance(volume, Nifti1Image):
+            if affine is None:
+                affine = volume.affine
+            volume = np.asanyarray(volume.dataobj)
+
+        volume = np.ascontiguousarray(volume)
+        if self.header is None:
+            self.write_header(volume, affine)
+
+        elif (list(volume.shape) != self.header['shape'] or
+              volume.dtype.str != self.header['dtype']):
+            raise ValueError(f'Volume {image_number} with shape {volume.shape} and dtype '
+                             f'{volume.dtype} does not match the recording')
+
+        if self.thread is None:
+            self.open()
+
+        # copy, since the caller may reuse the array before it is written
+        self.queue.put((image_number, volume.copy()))
+
+    def write_header(self, volume, affine):
+        self.header = {'dtype': volume.dtype.str,
+                       'shape': list(volume.shape),
+                       'affine': None if affine is None else np.asarray(affine).tolist()}
+
+        # write and rename, so that the header is never partially written
+        path = op.join(self.directory, 'header.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.header, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        fsync_directory(self.directory)
+
+    def open(self):
+        volume_size = np.dtype(self.header['dtype']).itemsize * int(np.prod(self.header['shape']))
+        self.volumes_file = open(op.join(self.directory, 'volumes.dat'), 'ab')
+        # drop volumes written after the last sync of a previous writer
+        self.volumes_file.truncate(self.n_written * volume_size)
+
+        index_path = op.join(self.directory, 'index.dat')
+        self.index_file = open(index_path, 'ab')
+        self.index_file.truncate(self.n_complete * INDEX_RECORD.size)
+        fsync_directory(self.directory)
+
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def write(self):
+        """Write queued volumes, syncing them to disk every ``fsync_interval`` seconds
+        """
+        pending = []
+        last_sync = time.time()
+        while True:
+            timeout = max(self.fsync_interval - (time.time() - last_sync), 0.)
+            try:
+                item = self.queue.get(timeout=timeout if len(pending) > 0 else None)
+            except queue.Empty:
+                item = ()
+
+            try:
+                if item:
+                    image_number, volume = item
+                    self.volumes_file.write(volume.data)
+                    pending.append(INDEX_RECORD.pack(image_number, self.n_written))
+                    self.n_written += 1
+
+                if len(pending) > 0 and (item is None or
+                                         time.time() - last_sync >= self.fsync_interval):
+                    self.sync(pending)
+                    pending = []
+                    last_sync = time.time()
+
+            except Exception as e:
+                logger.exception('Could not write to recording %s', self.directory)
+                self.error = e
+                return
+
+            if item is None:
+                return
+
+    def sync(self, records):
+        """Sync the written volumes, then add them to the index and sync it
+        """
+        self.volumes_file.flush()
+        os.fsync(self.volumes_file.fileno())
+        self.index_file.write(b''.join(records))
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+        self.n_complete += len(records)
+
+    def close(self):
+        """Write and sync all queued volumes
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.volumes_file.close()
+            self.index_file.close()
+
+        if self.error is not None:
+            raise self.error
+
+
+def read_index(directory):
+    """Complete volumes of a recording
+
+    Returns
+    -------
+    A structured array of the ``image_number`` and ``position`` of each complete volume
+    """
+    dtype = np.dtype([('image_number', '<i8'), ('position', '<i8')])
+    path = op.join(directory, 'index.dat')
+    if not op.exists(path):
+        return np.empty(0, dtype=dtype)
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    # ignore a partially written record
+    n_records = len(data) // INDEX_RECORD.size
+    return np.frombuffer(data[:n_records * INDEX_RECORD.size], dtype=dtype)
+
+
+class Recording():
+    """Read a recording written by ``RecordingWriter``
+
+    Only volumes in the index are read, so a recording can be read while it is being written or
+    after a crash.
+
+    Parameters
+    ----------
+    directory : str
+
+    Attributes
+    ----------
+    image_numbers : numpy.ndarray
+        Image number of each complete volume, in the order they were written
+    volumes : numpy.memmap
+        Read-only memory-mapped array of the complete volumes, with shape (n_volumes, x, y, z)
+    affine : numpy.ndarray or None
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(op.join(directory, 'header.json')) as f:
+            header = json.load(f)
+
+        index = read_index(directory)
+        self.image_numbers = index['image_number'].copy()
+        self.affine = None if header['affine'] is None else np.array(header['affine'])
+
+        shape = tuple(header['shape'])
+        n_volumes = int(index['position'].max()) + 1 if len(index) > 0 else 0
+        if n_volumes == 0:
+            self.volumes = np.empty((0,) + shape, dtype=header['dtype'])
+        else:
+            volumes = np.memmap(op.join(directory, 'volumes.dat'), dtype=header['dtype'],
+                                mode='r', shape=(n_volumes,) + shape)
+            positions = index['position']
+            contiguous = np.array_equal(positions, np.arange(len(positions)))
+            self.volumes = volumes if contiguous else volumes[positions]
+
+    def __len__(self):
+        return len(self.image_numbers)
+
+    def to_nifti(self):
+        """The recording as a 4D nifti image, with time as the last dimension
+        """
+        return Nifti1Image(np.moveaxis(np.asarray(self.volumes), 0, -1), self.affine)
+
+    def export_nifti(self, path):
+        """Save the recording as a 4D nifti file
+        """
+        self.to_nifti().to_filename(path)
+
+
+class NiftiFiles():
+    """Volumes of a run saved as one nifti file per volume
+
+    Only the headers are read when the files are opened. Uncompressed files are memory-mapped
+    when their volumes are accessed.
+
+    Parameters
+    ----------
+    paths : list of str
+        Paths of the files, in the order of the volumes
+    max_workers : int
+        Number of threads that open the files
+
+    Attributes
+    ----------
+    shape : tuple
+        (n_volumes, x, y, z)
+    dtype : numpy.dtype
+        Data type of the volumes (as scaled by nibabel, otherwise as stored)
+    affine : numpy.ndarray
+    """
+    def __init__(self, paths, max_workers=8):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            self.images = list(executor.map(nibabel.load, paths))
+
+        self.affine = self.images[0].affine
+        for path, image in zip(paths, self.images):
+            if image.shape[:3] != self.images[0].shape[:3]:
+                raise ValueError(f'{path} has shape {image.shape}, not {self.images[0].shape}')
+            if not np.allclose(image.affine, self.affine):
+                raise ValueError(f'{path} has a different affine than {paths[0]}')
+
+        self.shape = (len(self.images),) + tuple(self.images[0].shape[:3])
+        self.dtype = self[0].dtype
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return np.asanyarray(self.images[index].dataobj).reshape(self.shape[1:])
+
+
+class LazyRun():
+    """Lazily indexed 4D view of a run, with shape (n_volumes, x, y, z)
+
+    Indexing reads only the requested volumes, with a pool of threads, and returns them with the
+    dtype they are stored with, e.g., ``run[-10:]``, ``run[100:200, :, :, 20]`` or
+    ``run.masked(mask, slice(10, None))``.
+
+    Parameters
+    ----------
+    volumes : numpy.memmap or NiftiFiles
+        Sequence of 3D volumes with ``shape`` and ``dtype`` attributes
+    affine : numpy.ndarray or None
+    max_workers : int
+        Number of threads that read volumes
+    """
+    def __init__(self, volumes, affine=None, max_workers=8):
+        self.volumes = volumes
+        self.affine = affine
+        self.max_workers = max_workers
+        self.shape = tuple(volumes.shape)
+        self.dtype = np.dtype(volumes.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        return self.read(index[0], index[1:])
+
+    def read(self, times, spatial_index=()):
+        """Read part of each of the given volumes
+
+        Parameters
+        ----------
+        times : int, slice or array-like
+            Index of the volumes
+        spatial_index : tuple or numpy.ndarray
+            Index into each volume, e.g., a tuple of slices or a boolean mask
+
+        Returns
+        -------
+        An array with the time dimension first, unless ``times`` is an integer
+        """
+        times = np.arange(len(self))[times]
+        single = times.ndim == 0
+        times = np.atleast_1d(times)
+
+        # shape of the indexed part of a volume, without allocating a volume
+        part_shape = np.broadcast_to(np.empty((), dtype=bool), self.shape[1:])[spatial_index].shape
+        out = np.empty((len(times),) + part_shape, dtype=self.dtype)
+
+        def read_volume(i):
+            out[i] = self.volumes[times[i]][spatial_index]
+
+        if len(times) == 1 or self.max_workers == 1:
+            for i in range(len(times)):
+                read_volume(i)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(read_volume, range(len(times))))
+
+        return out[0] if single else out
+
+    def masked(self, mask, times=slice(None)):
+        """Read the voxels in a mask, e.g., the voxels a model was fit on
+
+        Parameters
+        ----------
+        mask : numpy.ndarray
+            Boolean array with the shape of a volume
+        times : int, slice or array-like
+            Index of the volumes
+
+        Returns
+        -------
+        An array with shape (n_times, n_voxels)
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != self.shape[1:]:
+            raise ValueError(f'Mask shape {mask.shape} does not match volume shape '
+                             f'{self.shape[1:]}')
+
+        return self.read(times, mask)
+
+    def to_nifti(self):
+        """Read the whole run as a 4D nifti image, with time as the last dimension
+        """
+        return Nifti1Image(np.moveaxis(self[:], 0, -1), self.affine)
+
+
+def load_run(recording_id, max_workers=8):
+    """Open a recorded run
+
+    Parameters
+    ----------
+    recording_id : str
+    max_workers : int
+        Number of threads that read volumes
+
+    Returns
+    -------
+    A ``LazyRun``. Volumes are only read when they are indexed
+    """
+    directory = op.join(config.RECORDING_DIR, recording_id)
+    if op.exists(op.join(directory, 'volumes', 'header.json')):
+        run = Recording(op.join(directory, 'volumes'))
+        return LazyRun(run.volumes, run.affine, max_workers=max_workers)
+
+    # runs saved as one nifti file per volume
+    paths = sorted(glob(op.join(directory, 'nifti', '*.nii*')))
+    if len(paths) == 0:
+        paths = sorted(glob(op.join(directory, '*.nii*')))
+    if len(paths) == 0:
+        raise ValueError(f'No volumes recorded for {recording_id}')
+
+    files = NiftiFiles(paths, max_workers=max_workers)
+    return LazyRun(files, files.affine, max_workers=max_workers)
@@ -0,0 +1,316 @@
+"""In-process rigid-body registration
+
+A NumPy/SciPy replacement for calling AFNI ``3dvolreg`` once per volume. The reference volume,
+its gradients and the coordinate grid are computed once and kept in memory, and each new volume
+is registered with an inverse compositional Gauss-Newton solver that starts from the transform
+estimated for the previous volume.
+"""
+import nibabel
+import numpy as np
+from scipy import ndimage
+
+# converts between RAS (nifti) and RAI (DICOM, used by AFNI) world coordinates
+RAS_TO_DICOM = np.diag([-1., -1., 1., 1.])
+
+
+def rotation_matrix(rotation):
+    """Rotation matrix for a rotation vector (Rodrigues' formula)
+
+    Parameters
+    ----------
+    rotation : numpy.ndarray
+        Rotation vector of length 3. Its direction is the axis of rotation and its norm is the
+        angle in radians
+
+    Returns
+    -------
+    A 3 x 3 rotation matrix
+    """
+    angle = np.linalg.norm(rotation)
+    if angle < 1e-12:
+        return np.eye(3)
+
+    kx, ky, kz = rotation / angle
+    k = np.array([[0, -kz, ky],
+                  [kz, 0, -kx],
+                  [-ky, kx, 0]])
+    return np.eye(3) + np.sin(angle) * k + (1 - np.cos(angle)) * k.dot(k)
+
+
+def rigid_transform(parameters, center):
+    """Affine matrix for a rigid-body transformation about a center point
+
+    Parameters
+    ----------
+    parameters : numpy.ndarray
+        Rotation vector (radians) followed by translation (mm), length 6
+    center : numpy.ndarray
+        Center of rotation in world coordinates
+
+    Returns
+    -------
+    A 4 x 4 affine matrix in world coordinates
+    """
+    rotation = rotation_matrix(parameters[:3])
+    transform = np.eye(4)
+    transform[:3, :3] = rotation
+    transform[:3, 3] = center - rotation.dot(center) + parameters[3:]
+    return transform
+
+
+def smooth(volume, smoothing):
+    """Gaussian smoothing with a kernel width given in voxels. 0 returns the volume unchanged
+    """
+    if smoothing > 0:
+        volume = ndimage.gaussian_filter(volume, smoothing)
+    return volume
+
+
+def displacement(transform, center, radius):
+    """Upper bound on the displacement (mm) of points within ``radius`` of ``center``
+    """
+    rotation = transform[:3, :3]
+    angle = np.arccos(np.clip((np.trace(rotation) - 1) / 2., -1., 1.))
+    translation = transform[:3, :3].dot(center) + transform[:3, 3] - center
+    return np.linalg.norm(translation) + angle * radius
+
+
+class RigidRegistration():
+    """Rigid-body (6 degrees of freedom) registration to a fixed reference volume
+
+    Minimizes the sum of squared differences between the reference and the resampled input with
+    an inverse compositional Gauss-Newton solver [1]_. The steepest descent images and Hessian
+    only depend on the reference, so they are computed once. Each call to ``register`` starts
+    from the previous solution.
+
+    With more than one pyramid level the transform is first estimated on subsampled volumes.
+    Finer levels are only visited if the coarse levels moved the transform by more than
+    ``refine_tolerance``, so small movements cost a few iterations on a small grid. Volumes are
+    smoothed once at full resolution and every level subsamples the smoothed volume.
+
+    Parameters
+    ----------
+    reference : numpy.ndarray
+        Reference volume, in the voxel order of its nifti image
+    reference_affine : numpy.ndarray
+        Voxel to world affine of the reference volume
+    max_iterations : int
+        Maximum number of Gauss-Newton iterations per volume and pyramid level
+    tolerance : float
+        Stop iterating when the largest displacement of any reference voxel caused by an update
+        is below this value (mm)
+    order : int
+        Spline interpolation order used to produce the registered volume. Linear interpolation is
+        always used while estimating the transform
+    threshold : float or None
+        Only reference voxels above this intensity are used to estimate the transform. None uses
+        the mean of the reference
+    levels : int
+        Number of pyramid levels. Level ``l`` is downsampled by ``2 ** l``; 1 registers at full
+        resolution only
+    refine_tolerance : float
+        Skip the finer levels when the coarser levels changed the transform by less than this
+        value (mm). 0 always refines down to full resolution
+    smoothing : float
+        Width of the gaussian kernel (voxels) applied to the reference and the input before
+        estimating the transform. Smoothing reduces the bias that linear interpolation
+        introduces for sub-voxel movements
+
+    Attributes
+    ----------
+    transform : numpy.ndarray
+        Current estimate of the 4 x 4 transform from reference world coordinates to input world
+        coordinates (RAS)
+    n_iterations : list of int
+        Number of iterations used at each visited level (coarsest first) for the most recent
+        volume
+    level : int
+        Finest level reached for the most recent volume, 0 being full resolution
+
+    References
+    ----------
+    .. [1] Baker, S. and Matthews, I. Lucas-Kanade 20 years on: a unifying framework.
+           International Journal of Computer Vision 56 (2004)
+    """
+    def __init__(self, reference, reference_affine, max_iterations=10, tolerance=0.01, order=1,
+                 threshold=None, levels=1, refine_tolerance=0., smoothing=1.):
+        reference = np.asarray(reference, dtype='float32')
+        if threshold is None:
+            threshold = reference.mean()
+
+        self.shape = reference.shape
+        self.reference_affine = np.asarray(reference_affine, dtype='float64')
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.order = order
+        self.refine_tolerance = refine_tolerance
+        self.smoothing = smoothing
+
+        # voxel and world coordinates of the reference grid
+        self.grid = np.indices(self.shape, dtype='float32').reshape(3, -1)
+        mask = reference > threshold
+        world = self.reference_affine[:3, :3].dot(self.grid[:, mask.ravel()]) + \
+            self.reference_affine[:3, 3:]
+        self.center = world.mean(1)
+        self.radius = np.sqrt(((world - self.center[:, None]) ** 2).sum(0).max())
+
+        smoothed = smooth(reference, smoothing)
+        self.levels = [self._build_level(smoothed, mask, 2 ** level) for level in range(levels)]
+
+        self.transform = np.eye(4)
+        self.n_iterations = []
+        self.level = 0
+
+    def _build_level(self, reference, mask, factor):
+        """Precompute everything a pyramid level needs that only depends on the reference
+        """
+        reference = reference[::factor, ::factor, ::factor]
+        mask = mask[::factor, ::factor, ::factor].ravel()
+        affine = self.reference_affine.dot(np.diag([factor, factor, factor, 1.]))
+
+        voxels = np.indices(reference.shape, dtype='float32').reshape(3, -1)[:, mask]
+        world_centered = (affine[:3, :3].dot(voxels) + affine[:3, 3:] - self.center[:, None]).T
+
+        # reference gradients in world coordinates
+        gradients = np.stack([g.ravel()[mask] for g in np.gradient(reference)])
+        gradients = np.linalg.inv(affine[:3, :3]).T.dot(gradients).T
+
+        steepest_descent = np.c_[np.cross(world_centered, gradients), gradients].astype('float32')
+        hessian = steepest_descent.T.dot(steepest_descent).astype('float64')
+
+        return {'factor': factor,
+                'affine': affine,
+                'voxels': voxels,
+                'reference': reference.ravel()[mask],
+                'steepest_descent': steepest_descent,
+                'inverse_hessian': np.linalg.inv(hessian)}
+
+    def reset(self):
+        """Forget the previous solution and start the next volume from the identity
+        """
+        self.transform = np.eye(4)
+
+    def voxel_transform(self, volume_affine, transform=None, reference_affine=None):
+        """Affine from reference voxel indices to input voxel indices
+        """
+        if transform is None:
+            transform = self.transform
+        if reference_affine is None:
+            reference_affine = self.reference_affine
+        return np.linalg.inv(volume_affine).dot(transform).dot(reference_affine)
+
+    def sample(self, volume, volume_affine, voxels, transform=None, order=1,
+               reference_affine=None):
+        """Sample the input volume at reference voxel coordinates
+
+        Parameters
+        ----------
+        volume : numpy.ndarray
+        volume_affine : numpy.ndarray
+        voxels : numpy.ndarray
+            3 x n array of voxel indices in the reference grid
+        transform : numpy.ndarray or None
+            Reference-to-input world transform. None uses the current estimate
+        order : int
+            Spline interpolation order
+        reference_affine : numpy.ndarray or None
+            Affine of the grid ``voxels`` index into. None uses the full resolution reference
+
+        Returns
+        -------
+        A vector of length n
+        """
+        matrix = self.voxel_transform(volume_affine, transform, reference_affine)
+        coordinates = matrix[:3, :3].astype('float32').dot(voxels) + \
+            matrix[:3, 3:].astype('float32')
+        return ndimage.map_coordinates(volume, coordinates, order=order, mode='nearest')
+
+    def _iterate(self, level, volume, volume_affine, transform):
+        """Run Gauss-Newton iterations at one pyramid level
+        """
+        for iteration in range(1, self.max_iterations + 1):
+            error = self.sample(volume, volume_affine, level['voxels'], transform,
+                                reference_affine=level['affine']) - level['reference']
+            update = level['inverse_hessian'].dot(level['steepest_descent'].T.dot(error))
+            transform = transform.dot(np.linalg.inv(rigid_transform(update, self.center)))
+
+            change = np.linalg.norm(update[3:]) + np.linalg.norm(update[:3]) * self.radius
+            if change < self.tolerance * level['factor']:
+                break
+
+        return transform, iteration
+
+    def estimate(self, volume, volume_affine):
+        """Estimate the transform that aligns the input volume to the reference
+
+        Parameters
+        ----------
+        volume : numpy.ndarray
+        volume_affine : numpy.ndarray
+
+        Returns
+        -------
+        The 4 x 4 transform from reference world coordinates to input world coordinates (RAS)
+        """
+        volume = smooth(np.asarray(volume, dtype='float32'), self.smoothing)
+        initial_transform = self.transform
+        transform = initial_transform
+        n_iterations = []
+        for level_index in range(len(self.levels) - 1, -1, -1):
+            level = self.levels[level_index]
+            factor = level['factor']
+            level_volume = volume[::factor, ::factor, ::factor]
+            level_volume_affine = volume_affine.dot(np.diag([factor, factor, factor, 1.]))
+            transform, iterations = self._iterate(level, level_volume, level_volume_affine,
+                                                  transform)
+            n_iterations.append(iterations)
+
+            if level_index > 0:
+                change = displacement(np.linalg.inv(initial_transform).dot(transform),
+                                      self.center, self.radius)
+                if change < self.refine_tolerance:
+                    break
+
+        self.transform = transform
+        self.n_iterations = n_iterations
+        self.level = level_index
+        return transform
+
+    def register_voxels(self, volume, voxels):
+        """Register a nifti image to the reference and resample it only at the given voxels
+
+        Parameters
+        ----------
+        volume : nibabel.nifti1.Nifti1Image
+        voxels : numpy.ndarray
+            3 x n array of voxel indices in the reference grid
+
+        Returns
+        -------
+        A vector of the registered values at ``voxels`` and the 4 x 4 transform from input to
+        reference in DICOM coordinates, as saved by ``3dvolreg -1Dmatrix_save``. This is the
+        inverse of ``transform``
+        """
+        data = np.asanyarray(volume.dataobj)
+        transform = self.estimate(data, volume.affine)
+        registered = self.sample(data.astype('float32', copy=False), volume.affine, voxels,
+                                 transform, order=self.order)
+
+        return registered, RAS_TO_DICOM.dot(np.linalg.inv(transform)).dot(RAS_TO_DICOM)
+
+    def register(self, volume):
+        """Register a nifti image to the reference
+
+        Parameters
+        ----------
+        volume : nibabel.nifti1.Nifti1Image
+
+        Returns
+        -------
+        The registered nibabel.nifti1.Nifti1Image on the reference grid and the 4 x 4 transform
+        from input to reference in DICOM coordinates, as saved by ``3dvolreg -1Dmatrix_save``
+        """
+        registered, transform = self.register_voxels(volume, self.grid)
+        registered = nibabel.Nifti1Image(registered.reshape(self.shape), self.reference_affine)
+
+        return registered, transform
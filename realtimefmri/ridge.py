@@ -0,0 +1,196 @@
+"""Incremental ridge regression
+
+Ridge regression only depends on the data through ``X.T @ X`` and ``X.T @ Y``, so those (and a few
+sums for the intercept) are accumulated as samples arrive and the model is refit from them without
+revisiting earlier samples. The ridge penalty is chosen by generalized cross-validation from one
+eigendecomposition of ``X.T @ X``, which is cached until more samples are added.
+"""
+import numpy as np
+
+
+class IncrementalRidge():
+    """Ridge regression fit from accumulated sufficient statistics
+
+    Parameters
+    ----------
+    alphas : array-like
+        Grid of ridge penalties
+    fit_intercept : bool
+    alpha_per_target : bool
+        If True, choose a penalty for each target (e.g., each voxel). If False, choose the
+        penalty that minimizes the generalized cross-validation error summed over targets
+    chunk_size : int
+        Number of targets solved at a time, which bounds the memory used while fitting
+    dtype : str
+        Data type of the fitted coefficients. Statistics are accumulated in float64
+
+    Attributes
+    ----------
+    n_samples_ : int
+        Number of samples accumulated
+    coef_ : numpy.ndarray
+        Coefficients with shape (n_targets, n_features), or (n_features,) for a single target
+    intercept_ : numpy.ndarray or float
+    alpha_ : float or numpy.ndarray
+        Selected penalty, one per target if ``alpha_per_target``
+    """
+    def __init__(self, alphas=np.logspace(0, 4, 9), fit_intercept=True, alpha_per_target=False,
+                 chunk_size=1000, dtype='float32'):
+        self.alphas = np.asarray(alphas, dtype='float64')
+        self.fit_intercept = fit_intercept
+        self.alpha_per_target = alpha_per_target
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        """Discard all accumulated samples
+        """
+        self.n_samples_ = 0
+        self.xtx_ = None
+        self.xty_ = None
+        self.x_sum_ = None
+        self.y_sum_ = None
+        self.yty_ = None
+        self.single_target_ = False
+        self._decomposition = None
+
+    def partial_fit(self, X, Y):
+        """Accumulate samples
+
+        Parameters
+        ----------
+        X : numpy.ndarray
+            Features with shape (n_samples, n_features)
+        Y : numpy.ndarray
+            Targets with shape (n_samples, n_targets) or (n_samples,)
+
+        Returns
+        -------
+        self
+        """
+        X = np.asarray(X, dtype='float64')
+        Y = np.asarray(Y, dtype='float64')
+        if Y.ndim == 1:
+            Y = Y[:, None]
+            self.single_target_ = True
+
+        if self.xtx_ is None:
+            n_features, n_targets = X.shape[1], Y.shape[1]
+            self.xtx_ = np.zeros((n_features, n_features))
+            self.xty_ = np.zeros((n_features, n_targets))
+            self.x_sum_ = np.zeros(n_features)
+            self.y_sum_ = np.zeros(n_targets)
+            self.yty_ = np.zeros(n_targets)
+
+        self.xtx_ += X.T.dot(X)
+        self.xty_ += X.T.dot(Y)
+        self.x_sum_ += X.sum(0)
+        self.y_sum_ += Y.sum(0)
+        self.yty_ += np.einsum('ij,ij->j', Y, Y)
+        self.n_samples_ += len(X)
+        self._decomposition = None
+
+        return self
+
+    def fit(self, X, Y):
+        """Fit from scratch on the given samples
+        """
+        self.reset()
+        return self.partial_fit(X, Y).solve()
+
+    def centered_statistics(self):
+        """Cross products of the accumulated samples, centered if fitting an intercept
+
+        Returns
+        -------
+        ``X.T @ X``, ``X.T @ Y``, the squared norm of each target, the feature means and the
+        target means
+        """
+        n = self.n_samples_
+        if not self.fit_intercept:
+            return (self.xtx_, self.xty_, self.yty_,
+                    np.zeros_like(self.x_sum_), np.zeros_like(self.y_sum_))
+
+        x_mean = self.x_sum_ / n
+        y_mean = self.y_sum_ / n
+        xtx = self.xtx_ - n * np.outer(x_mean, x_mean)
+        xty = self.xty_ - n * np.outer(x_mean, y_mean)
+        yty = self.yty_ - n * y_mean ** 2
+        return xtx, xty, yty, x_mean, y_mean
+
+    def decomposition(self, xtx):
+        """Cached eigendecomposition of ``X.T @ X``
+        """
+        if self._decomposition is None:
+            eigenvalues, eigenvectors = np.linalg.eigh(xtx)
+            self._decomposition = np.clip(eigenvalues, 0, None), eigenvectors
+        return self._decomposition
+
+    def solve(self):
+        """Choose the penalty and compute the coefficients from the accumulated samples
+
+        Costs O(n_features ** 2 * n_targets) and does not depend on the number of samples.
+
+        Returns
+        -------
+        self
+        """
+        n = self.n_samples_
+        xtx, xty, yty, x_mean, y_mean = self.centered_statistics()
+        eigenvalues, eigenvectors = self.decomposition(xtx)
+        n_features, n_targets = xty.shape
+
+        # generalized cross-validation error, n * RSS / (n - df) ** 2, for each penalty and target
+        denominators = eigenvalues[None] + self.alphas[:, None]
+        shrinkage = (eigenvalues[None] + 2 * self.alphas[:, None]) / denominators ** 2
+        degrees_of_freedom = (eigenvalues[None] / denominators).sum(1)
+        gcv_scale = n / np.maximum(n - degrees_of_freedom, 1) ** 2
+
+        gcv = np.empty((len(self.alphas), n_targets))
+        for chunk in self._chunks(n_targets):
+            rotated = eigenvectors.T.dot(xty[:, chunk])
+            rss = yty[chunk] - shrinkage.dot(rotated ** 2)
+            gcv[:, chunk] = gcv_scale[:, None] * rss
+
+        if self.alpha_per_target:
+            alpha_indices = gcv.argmin(0)
+        else:
+            alpha_indices = np.full(n_targets, gcv.sum(1).argmin())
+
+        coef = np.empty((n_targets, n_features), dtype=self.dtype)
+        for chunk in self._chunks(n_targets):
+            rotated = eigenvectors.T.dot(xty[:, chunk])
+            rotated /= denominators[alpha_indices[chunk]].T
+            coef[chunk] = eigenvectors.dot(rotated).T
+
+        intercept = (y_mean - coef.dot(x_mean)).astype(self.dtype)
+        alpha = self.alphas[alpha_indices]
+
+        if self.single_target_:
+            coef, intercept, alpha = coef[0], intercept[0], alpha[0]
+        elif not self.alpha_per_target:
+            alpha = alpha[0]
+
+        self.coef_ = coef
+        self.intercept_ = intercept
+        self.alpha_ = alpha
+        return self
+
+    def _chunks(self, n_targets):
+        for start in range(0, n_targets, self.chunk_size):
+            yield slice(start, min(start + self.chunk_size, n_targets))
+
+    def predict(self, X):
+        """Predict targets
+
+        Parameters
+        ----------
+        X : numpy.ndarray
+            Features with shape (n_samples, n_features)
+
+        Returns
+        -------
+        Predictions with shape (n_samples, n_targets), or (n_samples,) for a single target
+        """
+        return np.asarray(X).dot(self.coef_.T) + self.intercept_
@@ -4,6 +4,7 @@ Utility functions and configuration
 '''
 from __future__ import print_function
 
+import json
 import logging
 import logging.handlers
 import os.path as op
@@ -12,11 +13,8 @@ import redis
 import struct
 import subprocess
 import tempfile
-from glob import glob
 
 import numpy as np
-from nibabel import Nifti1Image
-from nibabel import load as nibload
 
 from realtimefmri import config
 
@@ -24,29 +22,286 @@ from realtimefmri import config
 r = redis.StrictRedis(config.REDIS_HOST)
 
 
-def load_timestamped_array_from_redis(key_prefix):
+def scan_keys(pattern, chunk_size=1000):
+    """List the keys in the redis database that match a pattern
+
+    Parameters
+    ----------
+    pattern : str or bytes
+    chunk_size : int
+        Number of keys requested from each SCAN call
+
+    Returns
+    -------
+    A list of keys
+    """
+    return list(r.scan_iter(pattern, count=chunk_size))
+
+
+def get_many(keys, chunk_size=1000):
+    """Get the values of many keys from the redis database in a single round trip
+
+    Keys are split into MGET commands of at most ``chunk_size`` keys, which are sent together in
+    one pipeline.
+
+    Parameters
+    ----------
+    keys : list of str or bytes
+    chunk_size : int
+
+    Returns
+    -------
+    A list of values, None for keys that do not exist
+    """
+    if len(keys) == 0:
+        return []
+
+    pipe = r.pipeline(transaction=False)
+    for start in range(0, len(keys), chunk_size):
+        pipe.mget(keys[start:start + chunk_size])
+
+    return [value for values in pipe.execute() for value in values]
+
+
+def scan_and_get(pattern, chunk_size=1000):
+    """Get the keys that match a pattern and their values from the redis database
+
+    Parameters
+    ----------
+    pattern : str or bytes
+    chunk_size : int
+        Number of keys per SCAN and MGET call
+
+    Returns
+    -------
+    A dict from key to value
+    """
+    keys = scan_keys(pattern, chunk_size=chunk_size)
+    values = get_many(keys, chunk_size=chunk_size)
+    return {key: value for key, value in zip(keys, values) if value is not None}
+
+
+def get_timestamped_array_segment(trial_index=None):
+    """Name of the segment of a timestamped array that holds the samples of a trial
+
+    Parameters
+    ----------
+    trial_index : int or None
+        None for samples recorded before the first trial
+
+    Returns
+    -------
+    A segment name, e.g., ``trial0003``
+    """
+    if trial_index is None:
+        return 'pretrial'
+    return f'trial{trial_index:04}'
+
+
+def get_timestamped_array_trials(key_prefix):
+    """Indices of the trials with samples in a timestamped array, in increasing order
+    """
+    segments = r.smembers(f'{key_prefix}:segments')
+    return sorted(int(s[len(b'trial'):]) for s in segments if s.startswith(b'trial'))
+
+
+def store_timestamped_array_to_redis(key_prefix, time, array, trial_index=None, pipe=None):
+    """Append a timestamped sample to a timestamped array in the redis database
+
+    Each trial is stored as a list at ``<key_prefix>:trial<trial_index>`` (``<key_prefix>:pretrial``
+    before the first trial) with one binary row per sample, the float64 time followed by the
+    array data. ``<key_prefix>:segments`` is the set of segment names. Each segment has its own
+    ``<key_prefix>:<segment>:header`` with the dtype and shape of its samples, set by the first
+    sample stored to the segment.
+
+    Parameters
+    ----------
+    key_prefix : str
+    time : float
+    array : numpy.ndarray
+    trial_index : int or None
+    pipe : redis.client.Pipeline or None
+        If given, the commands are added to this pipeline and not executed
+
+    Returns
+    -------
+    The key of the list the sample was appended to
+    """
+    array = np.ascontiguousarray(array)
+    segment = get_timestamped_array_segment(trial_index)
+    key = f'{key_prefix}:{segment}'
+    header = json.dumps({'dtype': array.dtype.str, 'shape': array.shape})
+
+    execute = pipe is None
+    if execute:
+        pipe = r.pipeline(transaction=False)
+
+    pipe.set(f'{key}:header', header, nx=True)
+    pipe.sadd(f'{key_prefix}:segments', segment)
+    pipe.rpush(key, struct.pack('<d', time) + array.tobytes())
+
+    if execute:
+        pipe.execute()
+
+    return key
+
+
+def load_timestamped_array_from_redis(key_prefix, trials=None):
     """Load a timestamped array from the redis database
 
+    See ``store_timestamped_array_to_redis`` for the storage format. All samples are read with
+    two round trips to the database and decoded without copying each sample.
+
+    Raises
+    ------
+    ValueError
+        If a sample does not match the dtype and shape of its segment, or if the loaded segments
+        have different dtypes or shapes
+
     Parameters
     ----------
     key_prefix : str
+    trials : list of int or None
+        Trials to load. None loads all samples, including those recorded before the first trial
 
     Returns
     -------
     An array of times and an array of data
     """
-    data = []
-    for key in r.scan_iter(key_prefix + ':*'):
-        dat = pickle.loads(r.get(key))
-        data.append(dat)
+    if trials is None:
+        # 'pretrial' sorts before the zero-padded 'trial' segments
+        segments = sorted(s.decode('utf-8') for s in r.smembers(f'{key_prefix}:segments'))
+    else:
+        segments = [get_timestamped_array_segment(trial) for trial in trials]
 
-    if len(data) == 0:
+    pipe = r.pipeline(transaction=False)
+    for segment in segments:
+        pipe.get(f'{key_prefix}:{segment}:header')
+        pipe.lrange(f'{key_prefix}:{segment}', 0, -1)
+    results = pipe.execute()
+
+    samples = []
+    segment_headers = {}
+    for segment, header, rows in zip(segments, results[::2], results[1::2]):
+        if header is None or len(rows) == 0:
+            continue
+
+        header = json.loads(header)
+        row_dtype = np.dtype([('time', '<f8'), ('data', header['dtype'], tuple(header['shape']))])
+        if any(len(row) != row_dtype.itemsize for row in rows):
+            raise ValueError(f'Samples in {key_prefix}:{segment} do not match its header {header}')
+
+        segment_headers[segment] = header
+        samples.append(np.frombuffer(b''.join(rows), dtype=row_dtype))
+
+    if len(samples) == 0:
         raise Exception(f'No data with key prefix {key_prefix}')
 
-    data = sorted(data, key=lambda x: x[0])
-    times, data = zip(*data)
+    if any(s.dtype != samples[0].dtype for s in samples):
+        raise ValueError(f'Segments of {key_prefix} have different dtypes or shapes: '
+                         f'{segment_headers}')
+
+    samples = np.concatenate(samples) if len(samples) > 1 else samples[0]
+    times = samples['time']
+    if np.any(np.diff(times) < 0):
+        samples = samples[np.argsort(times, kind='mergesort')]
+
+    return samples['time'].copy(), samples['data'].copy()
+
+
+def append_to_timeseries_buffer(key, index, values, max_length, pipe=None):
+    """Append a sample to a bounded time series in the redis database
+
+    The series is stored as a list at ``key`` with one binary row per sample, the int64 sample
+    index followed by the float64 values, and keeps only the ``max_length`` most recent samples.
+    ``<key>:length`` is the number of samples appended since the series was started.
+
+    Parameters
+    ----------
+    key : str
+    index : int
+        Index of the sample, counting from 0 when the series is started
+    values : number or array-like
+        Value of each trace of the time series
+    max_length : int
+    pipe : redis.client.Pipeline or None
+        If given, the commands are added to this pipeline and not executed
+    """
+    values = np.asarray(values, dtype='float64').ravel()
+
+    execute = pipe is None
+    if execute:
+        pipe = r.pipeline(transaction=False)
+
+    pipe.rpush(key, struct.pack('<q', index) + values.tobytes())
+    pipe.ltrim(key, -max_length, -1)
+    pipe.set(f'{key}:length', index + 1)
+
+    if execute:
+        pipe.execute()
+
+
+# the length and the samples are read in one atomic call so that an append between reading them
+# cannot shift the range
+READ_TIMESERIES_SCRIPT = """
+local length = tonumber(redis.call('GET', KEYS[1] .. ':length') or '0')
+local start = tonumber(ARGV[1])
+if start > length then
+    start = 0
+end
+if length <= start then
+    return {length, {}}
+end
+return {length, redis.call('LRANGE', KEYS[1], start - length, -1)}
+"""
+read_timeseries_script = r.register_script(READ_TIMESERIES_SCRIPT)
+
 
-    return np.array(times), np.array(data)
+def load_timeseries_buffer(key, start=0):
+    """Load the samples of a bounded time series from the redis database
+
+    See ``append_to_timeseries_buffer`` for the storage format. Only samples from ``start``
+    onwards are read from the database, so a client that already has the earlier samples only
+    transfers the new ones.
+
+    Parameters
+    ----------
+    key : str
+    start : int
+        Index of the first sample to load. If it is past the next sample to be sent, e.g., because
+        the series was restarted, all buffered samples are loaded
+
+    Returns
+    -------
+    An array of sample indices and an array of values with shape (n_samples, n_traces)
+    """
+    length, rows = read_timeseries_script(keys=[key], args=[start])
+    return decode_timeseries_rows(rows)
+
+
+def decode_timeseries_rows(rows):
+    """Decode samples read from a bounded time series buffer
+
+    Parameters
+    ----------
+    rows : list of bytes
+
+    Returns
+    -------
+    An array of sample indices and an array of values with shape (n_samples, n_traces)
+    """
+    if len(rows) == 0:
+        return np.array([], dtype='int64'), np.empty((0, 0))
+
+    # the number of traces can only change when the series is restarted, so keep the samples
+    # with as many traces as the last one
+    row_size = len(rows[-1])
+    rows = [row for row in rows if len(row) == row_size]
+    n_traces = (row_size - 8) // 8
+    dtype = np.dtype([('index', '<i8'), ('values', '<f8', (n_traces,))])
+    samples = np.frombuffer(b''.join(rows), dtype=dtype)
+
+    return samples['index'].copy(), samples['values'].reshape(len(samples), n_traces).copy()
 
 
 def run_command(cmd, raise_errors=True, **kwargs):
@@ -80,26 +335,18 @@ def parse_message(message):
     return topic, sync_time, data
 
 
-def load_run(recording_id):
-    """Load data from a real-time run into a nifti volumes
-    """
-    file_paths = glob(op.join(config.RECORDING_DIR, recording_id, '*.nii'))
-    file_paths = sorted(file_paths)
-    volume = None
-    for i, file_path in enumerate(file_paths):
-        nii = nibload(file_path)
+def load_run(recording_id, max_workers=8):
+    """Open a real-time run as a lazily indexed 4D view (see ``recording.load_run``)
 
-        if volume is None:
-            x, y, z = nii.shape
-            shape = (len(file_paths), x, y, z)
-            volume = np.zeros(shape)
-            affine = nii.affine
-
-        assert nii.affine == affine
-
-        volume[i, ...] = nii.get_data()
-
-    return Nifti1Image(volume, affine)
+    Parameters
+    ----------
+    recording_id : str
+    max_workers : int
+        Number of threads that read volumes
+    """
+    # imported here since recording imports this module
+    from realtimefmri import recording
+    return recording.load_run(recording_id, max_workers=max_workers)
 
 
 def get_temporary_path(directory=None, extension=None):
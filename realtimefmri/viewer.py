@@ -1,4 +1,5 @@
 import pickle
+import threading
 import time
 import warnings
 
@@ -6,7 +7,7 @@ import numpy as np
 import redis
 
 import cortex
-from realtimefmri import config
+from realtimefmri import config, cortex_cache
 from realtimefmri.utils import get_logger
 
 logger = get_logger('viewer', to_console=True, to_network=True)
@@ -15,14 +16,49 @@ r = redis.StrictRedis(config.REDIS_HOST)
 
 
 class PyCortexViewer():
+    """Display incoming volumes in the pycortex WebGL viewer
+
+    The mapping from incoming data to the displayed mosaic is computed once, so each incoming
+    volume is turned into display data with a single gather.
+
+    Volumes are received on a separate thread that only keeps the newest volume that has not been
+    displayed yet. The display loop always shows the most recent volume, so volumes that arrive
+    faster than they can be displayed are dropped instead of queued.
+
+    Parameters
+    ----------
+    surface : str
+    transform : str
+    mask_type : str
+        Mask that was applied to produce the incoming gray matter vectors. An empty string means
+        the incoming data are full (30, 100, 100) volumes
+    vmin : float
+    vmax : float
+
+    Attributes
+    ----------
+    mosaic_pixels : numpy.ndarray
+        Flat indices of the mosaic pixels that display data
+    mosaic_voxels : numpy.ndarray
+        For each of ``mosaic_pixels``, the index of the element of the incoming data it displays
+    background : numpy.ndarray
+        Mosaic values of pixels that do not display data
+    frames_received : int
+        Number of volumes received
+    frames_displayed : int
+        Number of volumes displayed
+    frames_dropped : int
+        Number of volumes replaced by a newer volume before they were displayed
+    """
     bufferlen = 15
 
     def __init__(self, surface, transform, mask_type='thick', vmin=-2., vmax=2.):
         if mask_type == '':
-            data = np.zeros((self.bufferlen, 30, 100, 100), 'float32')
+            data_shape = (30, 100, 100)
         else:
-            npts = cortex.db.get_mask(surface, transform, mask_type).sum()
-            data = np.zeros((self.bufferlen, npts), 'float32')
+            mask_indices, _ = cortex_cache.get_mask_indices(surface, transform, mask_type)
+            data_shape = (len(mask_indices),)
+        data = np.zeros((self.bufferlen,) + data_shape, 'float32')
 
         vol = cortex.Volume(data, surface, transform, vmin=vmin, vmax=vmax)
         logger.debug('Starting pycortex viewer')
@@ -39,40 +75,116 @@ class PyCortexViewer():
         self.active = True
         self.i = 0
 
+        self.frames_received = 0
+        self.frames_displayed = 0
+        self.frames_dropped = 0
+        self._pending = None
+        self._pending_time = None
+        self._lock = threading.Lock()
+        self._frame_available = threading.Event()
+
+        self.build_projection(data_shape)
+
+    def build_projection(self, data_shape):
+        """Precompute the mapping from incoming data to the displayed mosaic
+
+        Runs the same ``cortex.Volume`` and ``cortex.mosaic`` conversion that was previously
+        done for every frame, once on an array of element indices and once on zeros.
+
+        Parameters
+        ----------
+        data_shape : tuple of int
+            Shape of the incoming data
+        """
+        n_elements = int(np.prod(data_shape))
+        # offset by one so that index 0 can't be confused with a zero background
+        index = np.arange(1, n_elements + 1, dtype='float64').reshape(data_shape)
+        index_volume = cortex.Volume(index, self.surface, self.transform)
+        index_mosaic, _ = cortex.mosaic(index_volume.volume[0], show=False)
+
+        zeros_volume = cortex.Volume(np.zeros(data_shape, 'float32'), self.surface, self.transform)
+        background, _ = cortex.mosaic(zeros_volume.volume[0], show=False)
+
+        index_mosaic = np.asarray(index_mosaic).ravel()
+        self.mosaic_pixels = np.flatnonzero(np.isfinite(index_mosaic) & (index_mosaic >= 1))
+        self.mosaic_voxels = np.round(index_mosaic[self.mosaic_pixels]).astype(int) - 1
+        self.background = np.asarray(background, dtype='float32')
+
+    def project(self, volume):
+        """Convert incoming data to a mosaic for display
+
+        Parameters
+        ----------
+        volume : numpy.ndarray
+            Gray matter vector or full volume
+
+        Returns
+        -------
+        A 2D mosaic array
+        """
+        mosaic = self.background.copy()
+        mosaic.flat[self.mosaic_pixels] = volume.ravel()[self.mosaic_voxels]
+        return mosaic
+
     def update_viewer(self, volume):
-        logger.info(f"Updating pycortex viewer")
-        volume = volume.astype('float32')
-        volume = cortex.Volume(volume, self.surface, self.transform)
-        mosaic, _ = cortex.mosaic(volume.volume[0], show=False)
+        """Write a volume to the next frame of the viewer buffer and display it
+        """
+        mosaic = self.project(volume)
         i, = self.view.setFrame()
-        logger.debug("""i, = self.view.setFrame() %f""", i)
 
         if isinstance(i, (int, float)):
-            i = round(i)
-            logger.debug("i = round(i) %f", i)
-            new_frame = (i + 1) % self.bufferlen
-            logger.debug("""new_frame %f""", new_frame)
-
+            new_frame = (round(i) + 1) % self.bufferlen
             self.view.dataviews.data.data[0]._setData(new_frame, mosaic)
-            logger.debug("""self.view.dataviews.data.data[0]._setData(new_frame, mosaic)""")
-
-            logger.debug("Play %f", i)
-            self.view.playpause('play')
-            time.sleep(1)
-            self.view.playpause('pause')
-            self.view.setFrame(i + 0.99)
-            logger.debug("Pause %f", i + 0.99)
+            self.view.setFrame(new_frame)
+            logger.debug('Displayed frame %d', new_frame)
         else:
             warnings.warn(f'setFrame returned {i}')
 
-    def run(self):
+    def receive(self):
+        """Listen for volumes, keeping only the newest one that has not been displayed
+        """
         subscriber = r.pubsub()
         subscriber.subscribe('viewer')
         logger.info('Listening for volumes')
         for message in subscriber.listen():
             if message['type'] == 'message':
-                vol = pickle.loads(message['data'])
-                self.update_viewer(vol)
+                with self._lock:
+                    if self._pending is not None:
+                        self.frames_dropped += 1
+                    self._pending = message['data']
+                    self._pending_time = time.time()
+                    self.frames_received += 1
+                self._frame_available.set()
+
+    def render(self):
+        """Display the newest received volume whenever one is available
+        """
+        while self.active:
+            if not self._frame_available.wait(timeout=1.):
+                continue
+
+            with self._lock:
+                data = self._pending
+                received_time = self._pending_time
+                self._pending = None
+                self._frame_available.clear()
+
+            if data is None:
+                continue
+
+            self.update_viewer(pickle.loads(data))
+            self.frames_displayed += 1
+            logger.info('Displayed volume after %.3f s (received %d, displayed %d, dropped %d)',
+                        time.time() - received_time, self.frames_received,
+                        self.frames_displayed, self.frames_dropped)
+
+    def run(self):
+        receiver = threading.Thread(target=self.receive, daemon=True)
+        receiver.start()
+        try:
+            self.render()
+        finally:
+            self.active = False
 
 
 def serve(surface, transform, mask_type, vmin=-2, vmax=2):
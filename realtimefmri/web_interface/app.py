@@ -1,5 +1,6 @@
 import dash
 import flask
+import json
 import os.path as op
 import pickle
 import redis
@@ -9,6 +10,7 @@ from pathlib import Path
 
 from realtimefmri import config
 from realtimefmri.utils import get_logger
+from realtimefmri.web_interface import jobs
 
 logger = get_logger('app', to_console=True)
 
@@ -34,6 +36,16 @@ def serve_redis(key):
         logger.warning(e)
 
 
+@app.server.route('/job/<job_id>')
+def serve_job(job_id):
+    """Status, progress and result of a background job as JSON"""
+    job = jobs.get_job(job_id)
+    if job is None:
+        return f'No job {job_id}'
+
+    return json.dumps(job)
+
+
 @app.server.route('/static/<path:path>')
 def serve_static_file(path):
     logger.info(path)
@@ -41,3 +53,4 @@ def serve_static_file(path):
 
 
 app.css.append_css({'external_url': ['/static/css/style.css']})
+app.scripts.append_script({'external_url': '/static/js/dashboard.js'})
@@ -1,43 +1,234 @@
 # -*- coding: utf-8 -*-
 import numbers
 import pickle
+import threading
+import time
 import warnings
-from collections import defaultdict
+from uuid import uuid4
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+import flask
 import numpy as np
-import PIL
 import plotly.graph_objs as go
 import redis
 from dash.dependencies import Input, Output, State
 
-from realtimefmri import config
+from realtimefmri import config, utils
 from realtimefmri.utils import get_logger
 from realtimefmri.web_interface.app import app
 
 logger = get_logger('dashboard', to_console=True, to_network=False)
-graphs = defaultdict(list)
 r = redis.StrictRedis(config.REDIS_HOST)
 
+# seconds between keep-alive comments on an idle event stream
+EVENT_KEEPALIVE = 15
+# seconds that what a graph shows is remembered after its last update
+VIEW_EXPIRE = 24 * 60 * 60
+
+# For each of the first ARGV[1] keys, which are data hashes, return its plot type, its version
+# and, if the version differs from the one in ARGV, its payload. The version of an array image is
+# the version of its last encoded frame, and time series have no payload (their samples are read
+# from their buffers). The remaining keys are graph views, which are returned whole
+READ_DATA_SCRIPT = """
+local n_data = tonumber(ARGV[1])
+local result = {}
+for i = 1, n_data do
+    local fields = redis.call('HMGET', KEYS[i], 'type', 'version', 'image_version')
+    local plot_type, version, payload_field = fields[1], fields[2], 'data'
+    if plot_type == 'array_image' then
+        version, payload_field = fields[3], 'image'
+    end
+    local payload = false
+    if version and version ~= ARGV[i + 1] and plot_type ~= 'timeseries' then
+        payload = redis.call('HGET', KEYS[i], payload_field)
+    end
+    result[i] = {plot_type, version, payload}
+end
+for i = n_data + 1, #KEYS do
+    result[i] = redis.call('HGETALL', KEYS[i])
+end
+return result
+"""
+
+# Read the new samples of the time series of an extended graph and move its cursors past them.
+# KEYS are the graph's view and the buffer of each time series, ARGV the expiry of the view, the
+# selection and the data key of each time series. Returns the number of traces and the new samples
+# of each time series, or false if the graph is not extended or has to be redrawn
+EXTEND_SCRIPT = """
+local view = KEYS[1]
+local fields = redis.call('HMGET', view, 'extended', 'selection')
+if fields[1] ~= '1' or fields[2] ~= ARGV[2] then
+    return false
+end
+local result = {}
+for i = 2, #KEYS do
+    local key = ARGV[i + 1]
+    local state = redis.call('HMGET', view, 'traces:' .. key, 'cursor:' .. key)
+    local start = tonumber(state[2] or '-1') + 1
+    local length = tonumber(redis.call('GET', KEYS[i] .. ':length') or '0')
+    if start > length then
+        -- the series was restarted, so have update_graph redraw the figure
+        redis.call('HDEL', view, 'extended')
+        return false
+    end
+    local rows = {}
+    if length > start then
+        rows = redis.call('LRANGE', KEYS[i], start - length, -1)
+        redis.call('HSET', view, 'cursor:' .. key, length - 1)
+    end
+    result[i - 1] = {tonumber(state[1] or '0'), rows}
+end
+redis.call('EXPIRE', view, ARGV[1])
+return result
+"""
+
+
+class DataCache():
+    """Dashboard data shared by the callbacks of all graphs
+
+    The data of every graph, and what the graphs of the page show, are read in a single script
+    call by the first callback of each tick (polling interval or pushed update), and the callbacks
+    of the other graphs on the same tick reuse them. Payloads are only transferred if their
+    version changed since they were last read.
+
+    Parameters
+    ----------
+    redis_client : redis.StrictRedis
+    max_age : float
+        Seconds after which the data are read again even on the same tick
+
+    Attributes
+    ----------
+    entries : dict
+        Maps each data key to its plot type, version and unpickled payload
+    views : dict
+        Maps each view key to the contents of its hash
+    reads : int
+        Number of reads from the database
+    """
+    def __init__(self, redis_client, max_age=0.5):
+        self.read_data = redis_client.register_script(READ_DATA_SCRIPT)
+        self.max_age = max_age
+        self.entries = {}
+        self.views = {}
+        self.lock = threading.Lock()
+        self.tick = None
+        self.read_keys = set()
+        self.read_time = 0.
+        self.reads = 0
+
+    def get(self, keys, tick, all_keys=(), view_keys=()):
+        """Plot type, version and payload of each key, and the contents of each view
+
+        Parameters
+        ----------
+        keys : list of str
+            Keys to return
+        tick : hashable
+            Identifies the event that triggered the callback
+        all_keys : iterable of str
+            Keys selected in other graphs, which are read along with ``keys``
+        view_keys : list of str
+            Views to return
+
+        Returns
+        -------
+        A list with the plot type (bytes or None), version (bytes or None) and payload of each key,
+        and a list with the contents of each view
+        """
+        with self.lock:
+            fresh = (tick == self.tick and time.time() - self.read_time < self.max_age and
+                     self.read_keys.issuperset(keys) and self.views.keys() >= set(view_keys))
+            if not fresh:
+                read_keys = sorted(set(keys).union(all_keys))
+                known_versions = [self.entries.get(key, (None, b'', None))[1] or b''
+                                  for key in read_keys]
+                results = self.read_data(keys=read_keys + list(view_keys),
+                                         args=[len(read_keys)] + known_versions)
+                self.reads += 1
+
+                self.views = {}
+                for view_key, view in zip(view_keys, results[len(read_keys):]):
+                    self.views[view_key] = dict(zip(view[::2], view[1::2]))
+
+                for key, (plot_type, version, payload) in zip(read_keys, results):
+                    cached = self.entries.get(key)
+                    if payload is not None:
+                        if plot_type != b'array_image':
+                            payload = pickle.loads(payload)
+                    elif cached is not None and cached[1] == version:
+                        payload = cached[2]
+                    self.entries[key] = (plot_type, version, payload)
+
+                self.tick = tick
+                self.read_keys = set(read_keys)
+                self.read_time = time.time()
+
+            return ([self.entries[key] for key in keys],
+                    [self.views[view_key] for view_key in view_keys])
+
+
+data_cache = DataCache(r)
+extend_timeseries = r.register_script(EXTEND_SCRIPT)
+
 
 def get_data_options():
-    class_name_key = list(r.scan_iter('pipeline:*:0:class_name'))[0]
-    pipeline_key = class_name_key.rsplit(b':', maxsplit=2)[0]
+    """Data sent to the dashboard by the most recently registered pipeline
+
+    Returns
+    -------
+    A list of dropdown options, in the order of the pipeline's steps
+    """
+    pipeline_key = r.get('pipelines:latest')
+    if pipeline_key is None:
+        return []
+
+    sources = r.hgetall(b'dashboard:sources:' + pipeline_key)
+
+    def step_index(source):
+        return int(source[1].rsplit(b':', maxsplit=1)[1])
 
     data_options = []
-    for key in r.scan_iter(pipeline_key + b':*:class_name'):
-        class_name = pickle.loads(r.get(key))
-        if class_name == 'realtimefmri.preprocess.SendToDashboard':
-            data_name_key = key.replace(b':class_name', b':name')
-            data_name = pickle.loads(r.get(data_name_key))
-            data_options.append({'label': data_name,
-                                 'value': 'dashboard:data:' + data_name})
+    for data_name, _ in sorted(sources.items(), key=step_index):
+        data_name = data_name.decode('utf-8')
+        data_options.append({'label': data_name,
+                             'value': 'dashboard:data:' + data_name})
 
     return data_options
 
 
+def generate_events(keepalive=EVENT_KEEPALIVE):
+    """Server-sent events for each update published on the ``dashboard`` channel
+
+    Each event's data is the name of the data that was updated. A comment is sent after
+    ``keepalive`` seconds without updates so that closed connections are noticed.
+    """
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe('dashboard')
+    try:
+        # ask the browser to reconnect quickly if the stream is interrupted
+        yield 'retry: 1000\n\n'
+        while True:
+            message = pubsub.get_message(timeout=keepalive)
+            if message is None:
+                yield ': keep-alive\n\n'
+            elif message['type'] == 'message':
+                yield 'data: {}\n\n'.format(message['data'].decode('utf-8'))
+    finally:
+        pubsub.close()
+
+
+@app.server.route('/dashboard/events')
+def serve_events():
+    """Stream dashboard updates to the browser as they arrive
+    """
+    return flask.Response(flask.stream_with_context(generate_events()),
+                          mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 def remove_prefix(text, prefix):
     """Remove a prefix from text
     """
@@ -60,35 +251,245 @@ def make_volume_slices(volume, x=None, y=None, z=None):
             go.Heatmap(z=volume[:, :, z], colorscale='Greys')]
 
 
-def generate_update_graph():
+def downsample_minmax(x, y, n_points):
+    """Downsample a trace to at most ``n_points`` points, keeping the extremes
+
+    The x range is split into ``n_points // 2 - 1`` equal buckets and the minimum and maximum of
+    each bucket are kept, along with the first and last samples, so that peaks are drawn as they
+    would be at full resolution. Buckets are
+    fixed in x, so downsampling an already downsampled trace keeps the same points.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Increasing sample indices
+    y : numpy.ndarray
+    n_points : int
+
+    Returns
+    -------
+    The downsampled x and y
+    """
+    if len(x) <= n_points:
+        return x, y
+
+    n_buckets = max(n_points // 2 - 1, 1)
+    span = x[-1] - x[0] + 1
+    buckets = ((x - x[0]) * n_buckets // span).astype('int64')
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+
+    # missing values are never the extremes of a bucket unless the whole bucket is missing
+    missing = np.isnan(y)
+    minimum = np.lexsort((np.where(missing, np.inf, y), buckets))[starts]
+    maximum = np.lexsort((np.where(missing, np.inf, -y), buckets))[starts]
+    # the first and last samples mark where the trace starts and ends
+    keep = np.union1d(np.r_[minimum, maximum], [0, len(x) - 1])
+
+    return x[keep], y[keep]
+
+
+def update_timeseries(key, title, n_points=config.DASHBOARD_PLOT_POINTS):
+    """Traces of all the buffered samples of a time series
+
+    The traces are downsampled to ``n_points``, so the size of the figure does not grow with the
+    length of the session. Later samples are appended by ``extend_graph``.
+
+    Parameters
+    ----------
+    key : str
+    title : str
+    n_points : int
+
+    Returns
+    -------
+    A list of traces and the index of the last sample, or -1 if there are none
+    """
+    indices, values = utils.load_timeseries_buffer(key + ':timeseries')
+
+    traces = []
+    for trace_index in range(values.shape[1]):
+        x, y = downsample_minmax(indices, values[:, trace_index], n_points)
+        traces.append(go.Scatter(x=x, y=y, name=f'{title} {trace_index}',
+                                 uid=f'{key}:{trace_index}'))
+
+    last_index = int(indices[-1]) if len(indices) > 0 else -1
+    return traces, last_index
+
+
+def get_view_key(session, graph_index):
+    """Key of the hash describing what a graph of a dashboard page shows
+
+    The hash has the ``selection`` and ``revision`` of the figure last drawn by
+    ``update_graph``. Figures that are extended by ``extend_graph`` also have an ``extended``
+    flag and, for each time series, the number of traces (``traces:<key>``) and the last sample
+    sent to the browser (``cursor:<key>``).
+    """
+    return f'dashboard:view:{session}:{graph_index}'
+
+
+def encode_selection(selected_values):
+    """Identify the data selected in a graph in a single string
+    """
+    return '\n'.join(selected_values)
+
+
+def store_view(view_key, selected_values, revision, timeseries=None):
+    """Record what a newly drawn figure shows
+
+    Parameters
+    ----------
+    view_key : str
+    selected_values : list of str
+    revision : str
+    timeseries : dict or None
+        If the figure is extended with new samples, maps each time series key to its number of
+        traces and the index of its last sample
+    """
+    pipe = r.pipeline()
+    pipe.delete(view_key)
+    pipe.hset(view_key, 'selection', encode_selection(selected_values))
+    pipe.hset(view_key, 'revision', revision)
+    if timeseries is not None:
+        pipe.hset(view_key, 'extended', 1)
+        for key, (n_traces, last_index) in timeseries.items():
+            pipe.hset(view_key, f'traces:{key}', n_traces)
+            pipe.hset(view_key, f'cursor:{key}', last_index)
+
+    pipe.expire(view_key, VIEW_EXPIRE)
+    pipe.execute()
+
+
+def is_extended(selected_values, view):
+    """Whether a graph shows a figure of ``selected_values`` that ``extend_graph`` keeps up to date
+
+    Figures that only show time series are drawn once by ``update_graph`` when the selection
+    changes and then extended with new samples.
+    """
+    return (view.get(b'extended') == b'1' and
+            view.get(b'selection') == encode_selection(selected_values).encode('utf-8'))
+
+
+def generate_extend_graph(graph_index, max_points=config.DASHBOARD_WINDOW_POINTS):
+    """Return a callback function for extending the time series of a graph
+    """
+    def extend_graph(n, n_pushed, selected_values, session):
+        """Callback to append new samples to the time series of a graph
+
+        Only the samples after the last one sent to the figure are loaded and sent, and each trace
+        keeps at most ``max_points`` points in the browser. The figure itself is not sent to the
+        server, what it shows is recorded by ``update_graph`` when it is drawn. The view of the
+        graph and the new samples are read, and the view's cursors updated, in a single script
+        call.
+
+        Parameters
+        ----------
+        n : int
+            Number of polling intervals
+        n_pushed : int
+            Number of updates pushed by the server
+        selected_values : list of str
+        session : str
+            Identifies the dashboard page
+
+        Returns
+        -------
+        The new samples, the positions of the traces they extend and ``max_points``
+        """
+        if len(selected_values) == 0 or session is None:
+            raise dash.exceptions.PreventUpdate()
+
+        results = extend_timeseries(keys=([get_view_key(session, graph_index)] +
+                                          [key + ':timeseries' for key in selected_values]),
+                                    args=([VIEW_EXPIRE, encode_selection(selected_values)] +
+                                          selected_values))
+        if results is None:
+            raise dash.exceptions.PreventUpdate()
+
+        x, y, positions = [], [], []
+        position = 0
+        for n_traces, rows in results:
+            indices, values = utils.decode_timeseries_rows(rows)
+            if len(indices) > 0:
+                for trace_index in range(min(n_traces, values.shape[1])):
+                    x.append(indices)
+                    y.append(values[:, trace_index])
+                    positions.append(position + trace_index)
+
+            position += n_traces
+
+        if len(positions) == 0:
+            raise dash.exceptions.PreventUpdate()
+
+        return [{'x': x, 'y': y}, positions, max_points]
+
+    return extend_graph
+
+
+def get_all_keys(all_selected_values):
+    """Data keys selected in any graph
+    """
+    return set(key for selected_values in all_selected_values for key in selected_values or [])
+
+
+def get_revision(selected_values, entries):
+    """Revision of a figure, which changes whenever the version of any of its data changes
+    """
+    return '|'.join(f'{key}@{int(version or 0)}'
+                    for key, (_, version, _) in zip(selected_values, entries))
+
+
+def generate_update_graph(graph_index):
     """Return a callback function for updating a graph
     """
-    def update_graph(n, selected_values):
+    def update_graph(n, n_pushed, selected_values, session, *all_selected_values):
         """Callback to update a graph given a list of data names
 
         Parameters
         ----------
         n : int
+            Number of polling intervals
+        n_pushed : int
+            Number of updates pushed by the server
         selected_values: list of str
+        session : str
+            Identifies the dashboard page
+        all_selected_values : lists of str
+            The data selected in every graph, which are read from the database together
         """
 
-        if len(selected_values) == 0:
+        if len(selected_values) == 0 or session is None:
             raise dash.exceptions.PreventUpdate()
 
+        view_key = get_view_key(session, graph_index)
+        # the views of all the graphs of the page are read along with the data
+        view_keys = [get_view_key(session, i) for i in range(1, max_n_graphs + 1)]
+        entries, views = data_cache.get(selected_values, (session, n, n_pushed),
+                                        get_all_keys(all_selected_values), view_keys)
+        view = views[int(graph_index) - 1]
+
+        extended = all(plot_type == b'timeseries' for plot_type, _, _ in entries)
+        if extended:
+            if is_extended(selected_values, view):
+                # new samples are sent by extend_graph
+                raise dash.exceptions.PreventUpdate()
+
+            revision = uuid4().hex
+        else:
+            revision = get_revision(selected_values, entries)
+            if view.get(b'revision') == revision.encode('utf-8'):
+                # none of the data changed since the figure was drawn
+                raise dash.exceptions.PreventUpdate()
+
         traces = []
         images = []
         layout_updates = []
         titles = []
+        timeseries = {}
 
-        for key in selected_values:
-            dat = r.get(key)
+        for key, (plot_type, version, data) in zip(selected_values, entries):
             title = remove_prefix(key, 'dashboard:data:')
             titles.append(title)
-            if dat:
-                logger.debug('dashboard %s', len(dat))
-                data = pickle.loads(dat)
-                plot_type = r.get(key + ':type')
-
+            if version is not None:
                 if plot_type == b'bar':
                     if isinstance(data, numbers.Number):
                         data = [data]
@@ -97,36 +498,14 @@ def generate_update_graph():
                     traces.append(trace)
 
                 elif plot_type == b'timeseries':
-                    update = r.get(key + ':update')
-                    if update == b'true':
-                        logger.debug('Appending to timeseries %s', str(data))
-                        graphs[key].append(data)
-                        r.set(key + ':update', b'false')
-
-                    data = np.array(graphs[key])
-                    if data.ndim == 1:
-                        data = data.reshape(-1, 1)
-
-                    logger.debug('Timeseries shape %s', str(data.shape))
-                    for trace_index in range(data.shape[1]):
-                        trace = go.Scatter(y=data[:, trace_index], name=trace_index)
-                        traces.append(trace)
+                    timeseries_traces, last_index = update_timeseries(key, title)
+                    traces.extend(timeseries_traces)
+                    timeseries[key] = len(timeseries_traces), last_index
 
                 elif plot_type == b'array_image':
-                    data = data[0]
-                    if data.dtype != np.dtype('uint8'):
-                        data = ((data - np.nanmin(data)) / np.nanmax(data))
-                        data[np.isnan(data)] = 0.5
-                        data *= 255
-                        data = data.astype('uint8')
-
-                    if data.shape[0] < data.shape[1]:
-                        data = data.T
-
-                    img = PIL.Image.fromarray(data)
-
+                    # encoded by SendToDashboard
                     traces.append(go.Scatter())
-                    image = {'source': img,
+                    image = {'source': data.decode('ascii'),
                              'xref': 'x', 'yref': 'y',
                              'x': 0, 'y': 1,
                              'sizex': 1, 'sizey': 1,
@@ -173,11 +552,23 @@ def generate_update_graph():
         for layout in layout_updates:
             fig.layout.update(layout)
 
+        fig.layout.update({'datarevision': revision})
+        store_view(view_key, selected_values, revision, timeseries if extended else None)
+
         return fig
 
     return update_graph
 
 
+def toggle_polling(connected_timestamp, disconnected_timestamp):
+    """Poll for updates only while updates are not pushed by the server
+    """
+    if connected_timestamp is None:
+        return False
+
+    return connected_timestamp > (disconnected_timestamp or 0)
+
+
 def generate_refresh_selector():
     def refresh_selector(n):
         if n is not None:
@@ -224,12 +615,27 @@ for graph_index in range(1, max_n_graphs + 1):
     graph_list.append(graph)
 
 
-layout = [html.Button(u'↺', id='refresh-selector-button'),
-          html.Button('+', id='add-graph-button'),
-          html.Div(selector_list, id='data-selector-div'),
-          html.Div(graph_list, id='graph-div'),
-          html.Div('0', id='n-graphs', style={'display': 'none'}),
-          dcc.Interval(id='interval-component', interval=1000, n_intervals=0)]
+def serve_layout():
+    """Layout of a dashboard page, with a new session to record what its graphs show
+    """
+    return [html.Button(u'↺', id='refresh-selector-button'),
+            html.Button('+', id='add-graph-button'),
+            html.Div(selector_list, id='data-selector-div'),
+            html.Div(graph_list, id='graph-div'),
+            html.Div('0', id='n-graphs', style={'display': 'none'}),
+            html.Div(uuid4().hex, id='dashboard-session', style={'display': 'none'}),
+            # clicked by static/js/dashboard.js when the server pushes an update, and to report
+            # whether the push connection is up. Polling is the fallback when it is not
+            html.Div([html.Button(id='dashboard-push'),
+                      html.Button(id='dashboard-push-connected'),
+                      html.Button(id='dashboard-push-disconnected')],
+                     style={'display': 'none'}),
+            dcc.Interval(id='interval-component', interval=1000, n_intervals=0)]
+
+
+app.callback(Output('interval-component', 'disabled'),
+             [Input('dashboard-push-connected', 'n_clicks_timestamp'),
+              Input('dashboard-push-disconnected', 'n_clicks_timestamp')])(toggle_polling)
 
 
 @app.callback(Output('n-graphs', 'children'),
@@ -247,14 +653,30 @@ def increment_graph_count(n, n_graphs):
         return n_graphs
 
 
+# every graph callback gets the selections of all graphs, so that the first callback of a tick
+# reads the data of all graphs at once
+all_selectors = [State(f'data-selector{graph_index}', 'value')
+                 for graph_index in range(1, max_n_graphs + 1)]
+
 for graph_index in range(1, max_n_graphs + 1):
     graph_index = str(graph_index)
     app.callback(Output(f'data-selector{graph_index}', 'options'),
                  [Input('refresh-selector-button', 'n_clicks')])(generate_refresh_selector())
 
+    # the figures are not sent back to the server, what each graph shows is recorded in the
+    # database under the page's session
     app.callback(Output(f'graph{graph_index}', 'figure'),
                  [Input('interval-component', 'n_intervals'),
-                  Input(f'data-selector{graph_index}', 'value')])(generate_update_graph())
+                  Input('dashboard-push', 'n_clicks'),
+                  Input(f'data-selector{graph_index}', 'value')],
+                 [State('dashboard-session', 'children')] + all_selectors)(
+                     generate_update_graph(graph_index))
+
+    app.callback(Output(f'graph{graph_index}', 'extendData'),
+                 [Input('interval-component', 'n_intervals'),
+                  Input('dashboard-push', 'n_clicks')],
+                 [State(f'data-selector{graph_index}', 'value'),
+                  State('dashboard-session', 'children')])(generate_extend_graph(graph_index))
 
     # make new graph (reveal existing graph)
     app.callback(Output(f'data-selector{graph_index}', 'style'),
@@ -9,12 +9,17 @@ import redis
 from flask import render_template, request, Response, send_from_directory
 
 from realtimefmri import config, utils
+from realtimefmri.features import StimulusLibrary
+from realtimefmri.web_interface import jobs
 from realtimefmri.web_interface.app import app
-from realtimefmri.web_interface.apps.model import detrend_responses
+from realtimefmri.web_interface.apps.model import detrend_responses, feature_store
+from realtimefmri.web_interface.model_registry import registry
 
 
 logger = utils.get_logger(__name__)
 r = redis.StrictRedis(config.REDIS_HOST)
+# feature name -> (version, library) of the libraries loaded from the database
+stimulus_libraries = {}
 
 
 @app.server.route('/experiment/run/<path:path>')
@@ -54,9 +59,56 @@ def serve_append_random_stimulus_trial():
     return f'Appending {n} random trials'
 
 
+def append_top_n(model_name, trial_index, responses_name='graymatter', n=5,
+                 detrend_type='whitematterdetrend', progress=jobs.no_progress):
+    """Decode the responses to a trial and append a trial showing the top n results
+
+    Parameters
+    ----------
+    model_name : str
+    trial_index : int
+        Trial to decode
+    responses_name : str
+    n : int
+    detrend_type : str
+    progress : callable
+
+    Returns
+    -------
+    A description of the appended trial
+    """
+    model = registry.load(model_name)
+
+    progress(0.1, 'Loading responses')
+    key_prefix = f'responses:{responses_name}'
+    _, responses = detrend_responses(key_prefix, detrend_type=detrend_type, trials=[trial_index])
+
+    progress(0.8, 'Decoding')
+    responses = np.nan_to_num(responses.mean(0, keepdims=True))
+    probabilities = model.predict_proba(responses).ravel()
+
+    top_indices = probabilities.argsort()[-n:][::-1]
+    top_sizes = 10 + np.arange(n) * 10
+    top_class_names = [model.class_names[i] for i in top_indices]
+
+    stimulus = ''
+    for size, class_name in zip(top_sizes[::-1], top_class_names[::-1]):
+        stimulus += f"<p style='font-size:{size}px'>{class_name}</p>"
+
+    trial = {'type': 'html-keyboard-response',
+             'stimulus': stimulus,
+             'stimulus_duration': 2000,
+             'trial_duration': 2000}
+
+    r.lpush('experiment:trials', pickle.dumps(trial))
+
+    return f'Appending top {n} trial'
+
+
 @app.server.route('/experiment/trial/append/top_n', methods=['POST'])
 def serve_append_top_n():
-    """Add the top n most likely decoding results
+    """Add the top n most likely decoding results of the current trial. Decoding runs in the
+    background, see ``append_top_n``
 
     parameters:
       - name: model_name
@@ -74,49 +126,96 @@ def serve_append_top_n():
         in: query
         type: string
         description: Type of detrending to apply
+
+    Returns a JSON object with the ``job_id``, see ``/job/<job_id>``
     """
     model_name = request.args.get('model_name')
-    responses_name = request.args.get('responses_name', 'graymatter')
-    n = int(request.args.get('n', '5'))
-    detrend_type = request.args.get('detrend_type', 'whitematterdetrend')
-
-    model = pickle.loads(r.get(f'model:{model_name}'))
     trial_index = pickle.loads(r.get('experiment:trial:current'))['index']
+    job_id = jobs.queue.submit(f'top {model_name}', append_top_n, model_name, trial_index,
+                               responses_name=request.args.get('responses_name', 'graymatter'),
+                               n=int(request.args.get('n', '5')),
+                               detrend_type=request.args.get('detrend_type',
+                                                             'whitematterdetrend'))
 
-    key_prefix = f'responses:{responses_name}'
-    _, responses = detrend_responses(key_prefix, detrend_type=detrend_type, trials=[trial_index])
+    return json.dumps({'job_id': job_id})
 
-    responses = np.nan_to_num(responses.mean(0, keepdims=True))
-    probabilities = model.predict_proba(responses).ravel()
 
-    top_indices = probabilities.argsort()[-n:][::-1]
-    top_sizes = 10 + np.arange(n) * 10
-    top_class_names = [model.class_names[i] for i in top_indices]
+def build_stimulus_library(feature_name, progress=jobs.no_progress):
+    """Build the library of all stimuli with features in ``feature_name`` and store it to the
+    database at ``stimulus_library:<feature_name>``, incrementing
+    ``stimulus_library_version:<feature_name>``
 
-    stimulus = ''
-    for size, class_name in zip(top_sizes[::-1], top_class_names[::-1]):
-        stimulus += f"<p style='font-size:{size}px'>{class_name}</p>"
+    Returns
+    -------
+    A description of the library
+    """
+    progress(0.1, f'Loading {feature_name} features')
+    library = StimulusLibrary(feature_store, feature_name)
+    pipe = r.pipeline()
+    pipe.set(f'stimulus_library:{feature_name}', pickle.dumps(library))
+    pipe.incr(f'stimulus_library_version:{feature_name}')
+    pipe.execute()
 
-    trial = {'type': 'html-keyboard-response',
-             'stimulus': stimulus,
-             'stimulus_duration': 2000,
-             'trial_duration': 2000}
+    return f'Built {feature_name} library of {len(library.stimulus_names)} stimuli'
 
-    r.lpush('experiment:trials', pickle.dumps(trial))
 
-    return f'Appending top {n} trial'
+def get_stimulus_library(feature_name):
+    """Library of all stimuli with features in ``feature_name``
+
+    Libraries are built by a background job, see ``build_stimulus_library``, the first time they
+    are requested. Once built they are loaded from the database and kept in memory until a new
+    version is stored.
+
+    Returns
+    -------
+    The library, or None if it is not built yet, and the id of the job building it
+    """
+    version_key = f'stimulus_library_version:{feature_name}'
+    cached = stimulus_libraries.get(feature_name)
+    if cached is not None and cached[0] == r.get(version_key):
+        return cached[1], None
+
+    pipe = r.pipeline()
+    pipe.get(version_key)
+    pipe.get(f'stimulus_library:{feature_name}')
+    version, pickled_library = pipe.execute()
+    if pickled_library is not None:
+        library = pickle.loads(pickled_library)
+        stimulus_libraries[feature_name] = (version, library)
+        return library, None
+
+    job_key = f'stimulus_library_job:{feature_name}'
+    job_id = r.get(job_key)
+    job = None if job_id is None else jobs.get_job(job_id.decode('utf-8'))
+    if job is None or job['status'] == 'failed':
+        job_id = jobs.queue.submit(f'library {feature_name}', build_stimulus_library,
+                                   feature_name)
+        r.set(job_key, job_id)
+    else:
+        job_id = job['job_id']
+
+    return None, job_id
 
 
 @app.server.route('/experiment/trial/append/optimal_stimuli', methods=['POST'])
 def serve_append_optimal_stimulus_trial():
     """Predict the optimal (and minimal) stimuli
 
+    Every stimulus in the library is scored with the model. Scores are cached until a new version
+    of the model is stored. The first request for a feature space starts building its library
+    in the background. Until it is built, requests get a 503 response with a JSON object with the
+    ``job_id``, see ``/job/<job_id>``.
+
     parameters:
       - name: model_name
         in: query
         type: string
         required: true
         description: Name of a pre-trained model
+      - name: feature_name
+        in: query
+        type: string
+        description: Features the model was fit on
       - name: n_optimal
         in: query
         type: integer
@@ -134,25 +233,35 @@ def serve_append_optimal_stimulus_trial():
     if model_name is None:
         return 'Must provide model_name in query string.'
 
-    n_optimal = request.args.get('n_optimal', 3)
-    n_minimal = request.args.get('n_minimal', 3)
-    n_random = request.args.get('n_random', 3)
+    feature_name = request.args.get('feature_name', 'motion_energy')
+    n_optimal = int(request.args.get('n_optimal', 3))
+    n_minimal = int(request.args.get('n_minimal', 3))
+    n_random = int(request.args.get('n_random', 3))
+
+    version = registry.get_version(model_name)
+    model = registry.load(model_name)
+    if model is None:
+        return f'No model named {model_name}', 404
 
-    X = np.random.randn(5, 10).astype('float32')
-    model = r.get(f'model:{model_name}')
-    model = pickle.loads(model)
-    y_hat = model.predict(X)
+    library, job_id = get_stimulus_library(feature_name)
+    if library is None:
+        return Response(json.dumps({'job_id': job_id}), status=503, mimetype='application/json',
+                        headers={'Retry-After': '5'})
 
-    optimal_indices = y_hat.argpartition(-n_optimal)[-n_optimal:]
-    minimal_indices = y_hat.argpartition(n_minimal)[:n_minimal]
+    scores = library.score(model, model_name=model_name, version=version)
 
-    for i in range(1, 5):
+    optimal_indices, minimal_indices = library.select(scores, n_optimal, n_minimal)
+    remaining = np.setdiff1d(np.arange(len(scores)), np.r_[optimal_indices, minimal_indices])
+    random_indices = np.random.choice(remaining, min(n_random, len(remaining)), replace=False)
+
+    indices = np.r_[optimal_indices, minimal_indices, random_indices].astype(int)
+    for i in indices:
         trial = {'type': 'video',
-                 'sources': [f'/static/videos/{i:02}.mp4'],
+                 'sources': [f'/static/videos/{library.stimulus_names[i]}.mp4'],
                  'width': 400, 'height': 400, 'autoplay': True}
         r.lpush('experiment:trials', pickle.dumps(trial))
 
-    return f'Predicting {model_name} {len(y_hat)}'
+    return f'Appending {len(indices)} trials predicted by {model_name}'
 
 
 @app.server.route('/experiment/trial/next', methods=['POST'])
@@ -233,8 +342,8 @@ def serve_reset_trial():
 def serve_experiment_logs():
     """Reset the trial count"""
     logs = []
-    for key in r.scan_iter('experiment:log:*'):
-        log = pickle.loads(r.get(key))
+    for key, log in utils.scan_and_get('experiment:log:*').items():
+        log = pickle.loads(log)
         logs.append({'name': key.decode('utf-8').split(':')[-1], 'length': len(log)})
 
     return render_template('logs.html', logs=logs)
@@ -1,18 +1,24 @@
+import json
 import pickle
 from pathlib import Path
 
 import numpy as np
 import redis
 from flask import render_template, request
-from scipy import stats
-from sklearn import linear_model
 
-from realtimefmri import config, detrend, utils
+from realtimefmri import config, detrend, ridge, utils
+from realtimefmri.features import FeatureStore, align_features_and_responses
+from realtimefmri.web_interface import jobs
 from realtimefmri.web_interface.app import app
+from realtimefmri.web_interface.model_registry import registry
 
 
 logger = utils.get_logger(__name__)
 r = redis.StrictRedis(config.REDIS_HOST)
+feature_store = FeatureStore(str(Path(config.STATIC_PATH) / 'features'))
+
+# seconds after which the lock on a model being fit is released even if its job never finished
+FIT_LOCK_TIMEOUT = 60 * 60
 
 
 def load_responses(key_prefix, trials=None):
@@ -28,26 +34,52 @@ def load_responses(key_prefix, trials=None):
     -------
     An array of response times and an array of responses
     """
-    if trials is None:
-        response_times, responses = utils.load_timestamped_array_from_redis(key_prefix)
+    response_times, responses = utils.load_timestamped_array_from_redis(key_prefix, trials=trials)
+
+    return response_times, responses
+
+
+def fit_normalization(gm_responses, wm_responses, detrend_type):
+    """Fit the detrending and scaling of responses
+
+    Parameters
+    ----------
+    gm_responses : numpy.ndarray
+    wm_responses : numpy.ndarray
+    detrend_type : str
+
+    Returns
+    -------
+    A dict with the ``detrend_type``, the fit ``detrender`` and the ``mean`` and ``std`` of the
+    detrended responses
+    """
+    if detrend_type == 'whitematterdetrend':
+        detrender = detrend.WhiteMatterDetrend()
+        detrender.fit(gm_responses, wm_responses)
+
+        gm_detrended = detrender.detrend(gm_responses, wm_responses)
 
     else:
-        responses, response_times = [], []
-        for trial in trials:
-            trial_key_prefix = f'{key_prefix}:trial{trial:04}'
-            trial_response_times, trial_responses = load_responses(trial_key_prefix)
-            response_times.append(trial_response_times)
-            responses.append(trial_responses)
+        raise NotImplementedError(f'{detrend_type} not implemented.')
 
-        response_times = np.concatenate(response_times, axis=0)
-        responses = np.concatenate(responses, axis=0)
+    return {'detrend_type': detrend_type,
+            'detrender': detrender,
+            'mean': np.nanmean(gm_detrended, 0, keepdims=True),
+            'std': np.nanstd(gm_detrended, 0, keepdims=True)}
 
-    return response_times, responses
+
+def normalize_responses(gm_responses, wm_responses, normalization):
+    """Detrend and scale responses with a normalization from ``fit_normalization``
+    """
+    gm_detrended = normalization['detrender'].detrend(gm_responses, wm_responses)
+    return (gm_detrended - normalization['mean']) / normalization['std']
 
 
 def detrend_responses(key_prefix, detrend_type, trials=None):
     """Load and detrend responses
 
+    The detrending and scaling are fit on all responses.
+
     Parameters
     ----------
     key_prefix : str
@@ -58,37 +90,39 @@ def detrend_responses(key_prefix, detrend_type, trials=None):
     -------
     An array with size (number of samples, number of voxels) of detrended responses
     """
-    if detrend_type == 'whitematterdetrend':
-        response_times, gm_responses = load_responses(key_prefix)
-        _, wm_responses = load_responses('responses:whitematterdetrend')
+    response_times, gm_responses = load_responses(key_prefix, trials=trials)
+    _, wm_responses = load_responses('responses:whitematterdetrend', trials=trials)
 
-        detrender = detrend.WhiteMatterDetrend()
-        detrender.fit(gm_responses, wm_responses)
-
-        gm_detrended = detrender.detrend(gm_responses, wm_responses)
-
-        gm_mean = np.nanmean(gm_detrended, 0, keepdims=True)
-        gm_std = np.nanstd(gm_detrended, 0, keepdims=True)
+    if trials is None:
+        normalization = fit_normalization(gm_responses, wm_responses, detrend_type)
+    else:
+        _, all_gm_responses = load_responses(key_prefix)
+        _, all_wm_responses = load_responses('responses:whitematterdetrend')
+        normalization = fit_normalization(all_gm_responses, all_wm_responses, detrend_type)
 
-        if trials is not None:
-            response_times, gm_responses = load_responses(key_prefix, trials=trials)
-            _, wm_responses = load_responses('responses:whitematterdetrend', trials=trials)
+    return response_times, normalize_responses(gm_responses, wm_responses, normalization)
 
-        gm_detrended = detrender.detrend(gm_responses, wm_responses)
 
-    else:
-        raise NotImplementedError(f'{detrend_type} not implemented.')
+def get_open_trial():
+    """Index of the trial that is being recorded, or None if no trial is open
+    """
+    current_trial = r.get('experiment:trial:current')
+    if current_trial is None:
+        return None
 
-    gm_detrended = (gm_detrended - gm_mean) / gm_std
+    current_trial = pickle.loads(current_trial)
+    if current_trial.get('end_time') is not None:
+        return None
 
-    return response_times, gm_detrended
+    return current_trial['index']
 
 
 def load_features(feature_name):
     """Load features for stimuli presented during the course of the experiment
 
     Read log entries posted to the database by the experiment client to find out which stimuli
-    were presented and their start times. Load precomputed features for the stimuli.
+    were presented and their start times. Load precomputed features for the stimuli from the
+    memory-mapped feature store.
 
     Parameters
     ----------
@@ -96,19 +130,20 @@ def load_features(feature_name):
 
     Returns
     -------
-    A list of arrays of feature times and a list of arrays of features
+    A list of arrays of feature times and a list of arrays of features, ordered by stimulus start
+    time
     """
+    messages = utils.scan_and_get('log:stimulus:*:message')
+    time_keys = [key.rsplit(b':', maxsplit=1)[0] + b':time' for key in messages.keys()]
+    start_times = [float(start_time) for start_time in utils.get_many(time_keys)]
+
     features = []
     feature_times = []
-    for key in r.scan_iter('log:stimulus:*'):
-        start_time = r.get(key + ':time')
-        message = r.get(key + ':message')
-        stimulus_name = message.split('start ')[1]
-        feature_path = (Path(config.STATIC_PATH) / 'features' / feature_name /
-                        Path(stimulus_name).with_suffix('.npy'))
-
-        feat = np.load(feature_path)
-        feat_times = np.arange(0, len(feat), dtype='float32') + start_time
+    for start_time, message in sorted(zip(start_times, messages.values())):
+        stimulus_name = message.decode('utf-8').split('start ')[1]
+        feat = feature_store.load(feature_name, stimulus_name)
+        # epoch times need float64 precision
+        feat_times = np.arange(0, len(feat), dtype='float64') + start_time
 
         features.append(feat)
         feature_times.append(feat_times)
@@ -116,10 +151,6 @@ def load_features(feature_name):
     return feature_times, features
 
 
-def align_features_and_responses(feature_times, features, response_times, responses):
-    return features, responses
-
-
 @app.server.route('/models', methods=['GET'])
 def serve_models():
     """List all stored models, both those stored in the redis database and those stored on the
@@ -141,9 +172,8 @@ def serve_models():
 def serve_model(model_name):
     if request.method == 'GET':
         key = 'model:' + model_name
-        model = r.get(key)
+        model = registry.load(model_name)
         if model is not None:
-            model = pickle.loads(model)
             return f'{key} {str(model)}'
         else:
             return f'No model at {key}'
@@ -152,73 +182,203 @@ def serve_model(model_name):
 @app.server.route('/model/<model_name>/store', methods=['POST'])
 def serve_store_model(model_name):
     with open(Path(config.DATASTORE_DIR) / f'models/{model_name}.pkl', 'rb') as f:
-        r.set(f'model:{model_name}', f.read())
+        version = registry.store_pickled(model_name, f.read())
+
+    return f'Stored model {model_name} version {version}'
+
+
+@app.server.route('/models/cache', methods=['GET'])
+def serve_model_cache():
+    """Hits, misses, evictions and contents of the model cache"""
+    return json.dumps(registry.stats())
+
+
+def fit_model(model_name, responses_name='graymatter', detrend_type=None, model_type='ridge',
+              reset=False, feature_name=None, delays=(2., 4., 6.), progress=jobs.no_progress):
+    """Fit a model and store it to the database
+
+    Ridge models are fit incrementally: only trials that were not used in a previous fit are
+    loaded, and their statistics are added to those of the stored model before refitting. The
+    trial that is still being recorded is left for a later fit. Detrending and scaling are fit
+    on the first trials and stored with the model, so that all accumulated statistics are
+    normalized the same way. Fits of the same model are serialized by a lock in the database.
+
+    Parameters
+    ----------
+    model_name : str
+    responses_name : str
+    detrend_type : str or None
+    model_type : str
+    reset : bool
+        Discard previously fit trials and fit from scratch
+    feature_name : str
+        Stimulus features to fit from (required)
+    delays : sequence of float
+        Delays (seconds) of the features relative to the responses
+    progress : callable
+        Called with the fraction of the work completed and a message
 
-    return f'Stored model {model_name}'
+    Returns
+    -------
+    A description of the fit
+    """
+    if model_type != 'ridge':
+        raise NotImplementedError(f'Model type {model_type} not implemented')
+    if feature_name is None:
+        raise ValueError('Models must be fit on stimulus features, feature_name is required')
+
+    with r.lock(f'model_lock:{model_name}', timeout=FIT_LOCK_TIMEOUT):
+        trials_key = f'model_trials:{model_name}'
+        model = registry.load(model_name)
+        if reset or not isinstance(model, ridge.IncrementalRidge):
+            model = ridge.IncrementalRidge()
+            r.delete(trials_key)
+
+        fitted_trials = {int(trial) for trial in r.smembers(trials_key)}
+        open_trial = get_open_trial()
+        key_prefix = f'responses:{responses_name}'
+        trials = [trial for trial in utils.get_timestamped_array_trials(key_prefix)
+                  if trial not in fitted_trials and trial != open_trial]
+        if len(trials) == 0:
+            return f'No new trials to fit {model_name}'
+
+        progress(0.1, f'Loading trials {trials}')
+        response_times, responses = load_responses(key_prefix, trials=trials)
+        normalization = getattr(model, 'response_normalization_', None)
+        if detrend_type is not None:
+            _, wm_responses = load_responses('responses:whitematterdetrend', trials=trials)
+            if normalization is None:
+                normalization = fit_normalization(responses, wm_responses, detrend_type)
+                model.response_normalization_ = normalization
+            elif normalization['detrend_type'] != detrend_type:
+                raise ValueError(f'{model_name} was fit on {normalization["detrend_type"]} '
+                                 f'responses, not {detrend_type}')
+            responses = normalize_responses(responses, wm_responses, normalization)
+        elif normalization is not None:
+            raise ValueError(f'{model_name} was fit on {normalization["detrend_type"]} '
+                             'responses, not raw responses')
+
+        progress(0.3, f'Aligning {feature_name} features')
+        feature_times, features = load_features(feature_name)
+        X, responses = align_features_and_responses(feature_times, features, response_times,
+                                                    responses, delays=delays)
+
+        progress(0.5, 'Fitting')
+        model.partial_fit(X, np.nan_to_num(responses)).solve()
+        registry.store(model_name, model)
+        r.sadd(trials_key, *trials)
+
+        return f'Fit {model_name} on trials {trials} ({model.n_samples_} samples)'
+
+
+def decode_model(model_name, responses_name='graymatter', trials=None,
+                 progress=jobs.no_progress):
+    """Generate predictions from a model
+
+    Parameters
+    ----------
+    model_name : str
+    responses_name : str
+    trials : list of int or None
+        Trials to decode from, None for all trials
+    progress : callable
+
+    Returns
+    -------
+    A description of the predictions
+    """
+    # # get feature times
+    # feature_times, features = load_features('motion_energy')
+    progress(0.1, 'Loading responses')
+    response_times, responses = load_responses(f'responses:{responses_name}', trials=trials)
+
+    X = np.random.randn(20, 10).astype('float32')
+    model = registry.load(model_name)
+    y_hat = model.predict(X)
+
+    return f'Predicting {model_name} {len(y_hat)}'
+
+
+def parse_trials(trials):
+    """Parse a comma-separated list of trial indices from a query string
+    """
+    if trials is None:
+        return None
+    return [int(trial) for trial in trials.split(',')]
 
 
 @app.server.route('/model/<model_name>/fit', methods=['GET', 'POST'])
 def serve_fit_model(model_name):
-    """Fit a model
+    """Fit a model in the background. See ``fit_model``
 
     parameters:
       - name: model_name
         in: path
         type: string
         description: Key for model in the database
-      - name: mask_type
+      - name: responses_name
         in: query
         type: string
-        description: Mask for responses
-    """
-    detrend_type = request.args.get('detrend_type', None)
-    model_type = request.args.get('model_type', None)
-    mask_type = request.args.get('mask_type', None)
-    load_responses('responses:', )
-
-    # # get feature times
-    # feature_times, features = load_features('motion_energy')
-    # X, y = align_features_and_responses(feature_times, features, response_times, responses)
+        description: Name of the responses to fit
+      - name: detrend_type
+        in: query
+        type: string
+        description: Type of detrending to apply
+      - name: model_type
+        in: query
+        type: string
+        description: Type of model, only ridge is available
+      - name: reset
+        in: query
+        type: boolean
+        description: Discard previously fit trials and fit from scratch
+      - name: feature_name
+        in: query
+        type: string
+        required: true
+        description: Stimulus features to fit from
 
-    y = stats.zscore(responses, axis=0)
-    X = np.random.randn(len(y), 10).astype('float32')
+    Returns a JSON object with the ``job_id``, see ``/job/<job_id>``
+    """
+    feature_name = request.args.get('feature_name', None)
+    if feature_name is None:
+        return 'Must provide feature_name in query string.', 400
 
-    if model_type == 'ridge':
-        model = linear_model.LinearRegression()
-        _ = model.fit(X, y)
-        r.set(f'model:{model_name}', pickle.dumps(model))
+    job_id = jobs.queue.submit(f'fit {model_name}', fit_model, model_name,
+                               responses_name=request.args.get('responses_name', 'graymatter'),
+                               detrend_type=request.args.get('detrend_type', None),
+                               model_type=request.args.get('model_type', 'ridge'),
+                               reset=request.args.get('reset', 'false').lower() == 'true',
+                               feature_name=feature_name)
 
-    return f'Fitting {model_name} {responses.shape}'
+    return json.dumps({'job_id': job_id})
 
 
 @app.server.route('/model/<model_name>/decode', methods=['GET'])
 def serve_decode_model(model_name):
-    """Generate predictions from a model
+    """Generate predictions from a model in the background. See ``decode_model``
 
     parameters:
       - name: model_name
         in: path
         type: string
         description: Key for model in the database
+      - name: responses_name
+        in: query
+        type: string
+        description: Name of the responses to decode from
       - name: trials
         in: query
         type: list of integers
-        description: Trials to decode from
-    """
-    # # get feature times
-    # feature_times, features = load_features('motion_energy')
-    trials = request.args.get('trials', None)
+        description: Comma-separated trials to decode from
 
-    load_responses()
-    if trials is None:
-        response_times, responses = utils.load_timestamped_array_from_redis('responses')
-
-    X = np.random.randn(20, 10).astype('float32')
-    model = r.get(f'model:{model_name}')
-    model = pickle.loads(model)
-    y_hat = model.predict(X)
+    Returns a JSON object with the ``job_id``, see ``/job/<job_id>``
+    """
+    job_id = jobs.queue.submit(f'decode {model_name}', decode_model, model_name,
+                               responses_name=request.args.get('responses_name', 'graymatter'),
+                               trials=parse_trials(request.args.get('trials', None)))
 
-    return f'Predicting {model_name} {len(y_hat)}'
+    return json.dumps({'job_id': job_id})
 
 
 @app.server.route('/model/<model_name>/predict', methods=['GET'])
@@ -239,8 +399,7 @@ def serve_predict_model(model_name):
     # feature_times, features = load_features('motion_energy')
 
     X = np.random.randn(20, 10).astype('float32')
-    model = r.get(f'model:{model_name}')
-    model = pickle.loads(model)
+    model = registry.load(model_name)
     y_hat = model.predict(X)
 
     return f'Predicting {model_name} {len(y_hat)}'
@@ -14,8 +14,10 @@ r = redis.StrictRedis(config.REDIS_HOST)
 
 def create_interface():
     logger.debug('Create interface')
-    class_name_key = list(r.scan_iter('pipeline:*:0:class_name'))[0]
-    pipeline_key = class_name_key.rsplit(b':', maxsplit=2)[0]
+    pipeline_key = r.get('pipelines:latest')
+    if pipeline_key is None:
+        return []
+
     interface = preprocess.Pipeline.create_interface(pipeline_key)
     logger.debug('%s', str(interface))
     return interface
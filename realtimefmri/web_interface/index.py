@@ -23,7 +23,7 @@ def display_page(pathname):
         content = controls.layout
 
     elif pathname == '/dashboard':
-        content = dashboard.layout
+        content = dashboard.serve_layout()
 
     elif pathname == '/pipeline':
         content = pipeline.layout
@@ -0,0 +1,136 @@
+"""Run slow web requests as background jobs
+
+Jobs run in a pool of worker processes so that fitting or decoding does not hold up the server
+that is serving experiment trials. Submitting a job returns a job id immediately. The state of
+each job is stored in the database at ``job:<job_id>`` and every change is published as JSON on
+the ``jobs`` channel.
+"""
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from uuid import uuid4
+
+import redis
+
+from realtimefmri import config, utils
+
+
+logger = utils.get_logger(__name__)
+r = redis.StrictRedis(config.REDIS_HOST)
+
+# finished jobs are removed from the database after this many seconds
+JOB_EXPIRE = 24 * 60 * 60
+
+
+def no_progress(fraction, message=''):
+    """Progress callback for job functions that are called directly
+    """
+    pass
+
+
+def update_job(job_id, **fields):
+    """Update the state of a job in the database and publish the change
+
+    Parameters
+    ----------
+    job_id : str
+    fields
+        Any of ``name``, ``status`` (queued, running, done or failed), ``progress`` (a fraction
+        between 0 and 1), ``message``, ``result``, ``submit_time``, ``start_time`` and
+        ``end_time``
+    """
+    key = f'job:{job_id}'
+    pipe = r.pipeline()
+    for name, value in fields.items():
+        pipe.hset(key, name, json.dumps(value))
+    if fields.get('status') in ('done', 'failed'):
+        pipe.expire(key, JOB_EXPIRE)
+    pipe.publish('jobs', json.dumps(dict(fields, job_id=job_id)))
+    pipe.execute()
+
+
+def get_job(job_id):
+    """State of a job
+
+    Returns
+    -------
+    A dict of the job's fields, or None if there is no such job
+    """
+    fields = r.hgetall(f'job:{job_id}')
+    if len(fields) == 0:
+        return None
+
+    job = {k.decode('utf-8'): json.loads(v) for k, v in fields.items()}
+    job['job_id'] = job_id
+    return job
+
+
+def run_job(job_id, function, args, kwargs):
+    """Run a job in a worker process, recording its state
+
+    ``function`` is called with a ``progress`` keyword argument, a function that takes a fraction
+    of completion and an optional message. Its return value must be JSON serializable.
+    """
+    def progress(fraction, message=''):
+        update_job(job_id, progress=fraction, message=message)
+
+    update_job(job_id, status='running', start_time=time.time())
+    try:
+        result = function(*args, progress=progress, **kwargs)
+    except Exception as e:
+        logger.error('Job %s failed\n%s', job_id, traceback.format_exc())
+        update_job(job_id, status='failed', message=repr(e), end_time=time.time())
+        return
+
+    update_job(job_id, status='done', progress=1., result=result, end_time=time.time())
+
+
+class JobQueue():
+    """Pool of worker processes that run jobs
+
+    Parameters
+    ----------
+    max_workers : int
+        Maximum number of jobs that run at the same time. Other jobs wait in the queue
+    """
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = None
+
+    def submit(self, name, function, *args, **kwargs):
+        """Queue a job
+
+        Parameters
+        ----------
+        name : str
+            Description of the job
+        function : callable
+            Module-level function to run. It must accept a ``progress`` keyword argument
+        args, kwargs
+            Arguments to ``function``
+
+        Returns
+        -------
+        The job id
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+        job_id = uuid4().hex
+        update_job(job_id, name=name, status='queued', progress=0., submit_time=time.time())
+        future = self.executor.submit(run_job, job_id, function, args, kwargs)
+        future.add_done_callback(lambda f: self._check_worker(job_id, f))
+        logger.info('Submitted job %s %s', job_id, name)
+        return job_id
+
+    def _check_worker(self, job_id, future):
+        """Record jobs whose worker process died, which ``run_job`` can't record itself
+        """
+        exception = future.exception()
+        if exception is not None:
+            update_job(job_id, status='failed', message=repr(exception), end_time=time.time())
+            self.executor = None
+
+
+queue = JobQueue(config.JOB_WORKERS)
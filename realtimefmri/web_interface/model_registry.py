@@ -0,0 +1,148 @@
+"""Versioned storage of pickled models in the database with an in-process cache
+
+Models are stored as pickles at ``model:<name>``, with a counter at ``model_version:<name>`` that
+is incremented whenever the model is stored. Deserialized models are kept in a least recently
+used cache, so a request only unpickles a model if it changed since it was last loaded.
+"""
+import pickle
+import threading
+from collections import OrderedDict
+
+import redis
+
+from realtimefmri import config, utils
+
+
+logger = utils.get_logger(__name__)
+r = redis.StrictRedis(config.REDIS_HOST)
+
+
+class ModelRegistry():
+    """Load and store versioned models
+
+    Parameters
+    ----------
+    redis_client : redis.StrictRedis
+    max_bytes : int
+        Upper limit on the total size of cached models, estimated by the size of their pickles.
+        Least recently used models are evicted above this limit
+
+    Attributes
+    ----------
+    hits : int
+        Number of loads served from the cache
+    misses : int
+        Number of loads that had to unpickle the model
+    evictions : int
+        Number of models evicted to stay under ``max_bytes``
+    """
+    def __init__(self, redis_client, max_bytes):
+        self.redis_client = redis_client
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()  # name -> (version, model, size)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def model_key(model_name):
+        return f'model:{model_name}'
+
+    @staticmethod
+    def version_key(model_name):
+        return f'model_version:{model_name}'
+
+    def store_pickled(self, model_name, pickled_model):
+        """Store a pickled model and increment its version
+
+        Returns
+        -------
+        The new version of the model
+        """
+        pipe = self.redis_client.pipeline()
+        pipe.set(self.model_key(model_name), pickled_model)
+        pipe.incr(self.version_key(model_name))
+        _, version = pipe.execute()
+        logger.info('Stored %s version %d', model_name, version)
+        return version
+
+    def store(self, model_name, model):
+        """Pickle and store a model
+
+        Returns
+        -------
+        The new version of the model
+        """
+        return self.store_pickled(model_name, pickle.dumps(model))
+
+    def get_version(self, model_name):
+        """Current version of a model, 0 for models stored without a version
+        """
+        version = self.redis_client.get(self.version_key(model_name))
+        return 0 if version is None else int(version)
+
+    def load(self, model_name):
+        """Load a model, unpickling it only if its version changed since it was cached
+
+        Returns
+        -------
+        The model, or None if there is no model named ``model_name``
+        """
+        version = self.get_version(model_name)
+        with self.lock:
+            cached = self.cache.get(model_name)
+            if cached is not None and cached[0] == version:
+                self.cache.move_to_end(model_name)
+                self.hits += 1
+                return cached[1]
+
+        pipe = self.redis_client.pipeline()
+        pipe.get(self.version_key(model_name))
+        pipe.get(self.model_key(model_name))
+        version, pickled_model = pipe.execute()
+        if pickled_model is None:
+            return None
+
+        version = 0 if version is None else int(version)
+        model = pickle.loads(pickled_model)
+
+        with self.lock:
+            self.misses += 1
+            self.cache[model_name] = (version, model, len(pickled_model))
+            self.cache.move_to_end(model_name)
+            self.evict()
+
+        return model
+
+    def evict(self):
+        """Remove the least recently used models until the cache is below its size limit. The most
+        recently used model is always kept
+        """
+        size = sum(size for _, _, size in self.cache.values())
+        while size > self.max_bytes and len(self.cache) > 1:
+            model_name, (_, _, model_size) = self.cache.popitem(last=False)
+            size -= model_size
+            self.evictions += 1
+            logger.debug('Evicted %s from the model cache', model_name)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        """Cache metrics
+
+        Returns
+        -------
+        A dict of hit, miss and eviction counts, and the cached models and their total size
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'models': {name: version for name, (version, _, _) in self.cache.items()},
+                    'bytes': sum(size for _, _, size in self.cache.values())}
+
+
+registry = ModelRegistry(r, config.MODEL_CACHE_SIZE)
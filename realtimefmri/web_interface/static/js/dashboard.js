@@ -0,0 +1,69 @@
+// Push dashboard updates from the server
+//
+// While the dashboard is shown, listens to /dashboard/events, which sends an event whenever the
+// pipeline sends new data to the dashboard, and clicks the hidden #dashboard-push button so that
+// the graphs update. Events that arrive close together, e.g., from several SendToDashboard steps
+// in the same TR, are coalesced into one update. The connection state is reported by clicking
+// #dashboard-push-connected or #dashboard-push-disconnected, which turns interval polling off
+// while the stream is connected and back on if it fails.
+
+(function () {
+  if (typeof EventSource === 'undefined') {
+    return;  // keep polling
+  }
+
+  var coalesceMs = 50;
+  var source = null;
+  var pending = null;
+  var connected = false;
+  var reported = null;
+
+  function click(id) {
+    var element = document.getElementById(id);
+    if (element !== null) {
+      element.click();
+    }
+  }
+
+  function connect() {
+    source = new EventSource('/dashboard/events');
+
+    source.onopen = function () {
+      connected = true;
+    };
+
+    source.onerror = function () {
+      // EventSource reconnects by itself after the retry interval sent by the server
+      connected = false;
+    };
+
+    source.onmessage = function () {
+      if (pending === null) {
+        pending = setTimeout(function () {
+          pending = null;
+          click('dashboard-push');
+        }, coalesceMs);
+      }
+    };
+  }
+
+  // the dashboard layout is rendered by a callback and replaced when navigating to other pages,
+  // so connect only while it is shown and report the connection state whenever it changes
+  setInterval(function () {
+    var shown = document.getElementById('dashboard-push') !== null;
+    if (shown && source === null) {
+      connect();
+    } else if (!shown && source !== null) {
+      source.close();
+      source = null;
+      connected = false;
+    }
+
+    if (!shown) {
+      reported = null;
+    } else if (reported !== connected) {
+      reported = connected;
+      click(connected ? 'dashboard-push-connected' : 'dashboard-push-disconnected');
+    }
+  }, 250);
+})();
@@ -11,6 +11,7 @@ def main():
           author_email='robertg@berkeley.edu',
           packages=find_packages(),
           install_requires=["numpy",
+                            "scipy",
                             "redis",
                             "nibabel",
                             "pydicom",
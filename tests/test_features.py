@@ -0,0 +1,156 @@
+import numpy as np
+import pytest
+from sklearn.linear_model import Ridge
+
+from realtimefmri import features
+
+
+def make_stimuli():
+    """Two stimuli with one feature sample per second, at 0-4 s and 10-12 s
+    """
+    feature_times = [np.arange(5.), np.arange(10., 13.)]
+    stimulus_features = [np.arange(10.).reshape(5, 2), 100 + np.arange(6.).reshape(3, 2)]
+    return feature_times, stimulus_features
+
+
+def test_align_previous():
+    feature_times, stimulus_features = make_stimuli()
+    response_times = np.array([-1., 0.5, 3.9, 4.5, 7., 10., 12.5])
+    responses = np.arange(7.)
+
+    design, aligned_responses = features.align_features_and_responses(
+        feature_times, stimulus_features, response_times, responses)
+    assert design.dtype == np.dtype('float32')
+    assert aligned_responses is responses
+    # before the first stimulus and between stimuli the features are zero
+    np.testing.assert_array_equal(design, [[0, 0], [0, 1], [6, 7], [8, 9], [0, 0],
+                                           [100, 101], [104, 105]])
+
+
+def test_align_delays():
+    feature_times, stimulus_features = make_stimuli()
+    design, _ = features.align_features_and_responses(
+        feature_times, stimulus_features, [2., 12.], None, delays=(0, 2))
+    np.testing.assert_array_equal(design, [[4, 5, 0, 1], [104, 105, 100, 101]])
+
+
+def test_align_linear():
+    feature_times, stimulus_features = make_stimuli()
+    design, _ = features.align_features_and_responses(
+        feature_times, stimulus_features, [0.25, 3.5, 4.5, 11.75], None, method='linear')
+    # the last sample of a stimulus is held, not interpolated towards the next stimulus
+    np.testing.assert_allclose(design, [[0.5, 1.5], [7, 8], [8, 9], [103.5, 104.5]])
+
+
+def test_align_max_gap():
+    feature_times, stimulus_features = make_stimuli()
+    response_times = [4.5, 7., 9.]
+
+    design, _ = features.align_features_and_responses(
+        feature_times, stimulus_features, response_times, None, max_gap=0.25)
+    np.testing.assert_array_equal(design, np.zeros((3, 2)))
+
+    design, _ = features.align_features_and_responses(
+        feature_times, stimulus_features, response_times, None, max_gap=3.)
+    np.testing.assert_array_equal(design, [[8, 9], [8, 9], [0, 0]])
+
+    # with a gap larger than the time between stimuli, linear interpolation spans the stimuli
+    design, _ = features.align_features_and_responses(
+        feature_times, stimulus_features, response_times, None, method='linear', max_gap=6.)
+    np.testing.assert_allclose(design, [[8 + 92 / 12, 9 + 92 / 12], [54, 55],
+                                         [8 + 92 * 5 / 6, 9 + 92 * 5 / 6]], rtol=1e-6)
+
+
+def test_align_unsorted_stimuli():
+    feature_times, stimulus_features = make_stimuli()
+    response_times = np.linspace(-1, 14, 31)
+    expected, _ = features.align_features_and_responses(
+        feature_times, stimulus_features, response_times, None, method='linear')
+    design, _ = features.align_features_and_responses(
+        feature_times[::-1], stimulus_features[::-1], response_times, None, method='linear')
+    np.testing.assert_array_equal(design, expected)
+
+
+def test_align_unknown_method():
+    feature_times, stimulus_features = make_stimuli()
+    with pytest.raises(NotImplementedError):
+        features.align_features_and_responses(feature_times, stimulus_features, [1.], None,
+                                              method='cubic')
+
+
+class PredictOnly():
+    """A model without coefficients, scored with its predict method
+    """
+    def __init__(self, model):
+        self.model = model
+        self.n_features_in_ = model.coef_.shape[-1]
+
+    def predict(self, X):
+        return self.model.predict(X)
+
+
+def make_library(tmpdir, n_stimuli=12, n_features=3):
+    random_state = np.random.RandomState(0)
+    tmpdir.mkdir('features').mkdir('empty')
+    directory = tmpdir.join('features').mkdir('feature')
+    for i in range(n_stimuli):
+        np.save(str(directory.join(f'stimulus{i:02}.npy')), random_state.randn(10, n_features))
+
+    return features.FeatureStore(str(tmpdir.join('features')))
+
+
+def test_stimulus_library(tmpdir):
+    feature_store = make_library(tmpdir)
+    library = features.StimulusLibrary(feature_store, 'feature')
+    assert library.stimulus_names == [f'stimulus{i:02}' for i in range(12)]
+    assert library.features.shape == (12, 3)
+    np.testing.assert_allclose(library.features[5],
+                               feature_store.load('feature', 'stimulus05').mean(0), rtol=1e-6)
+
+    library = features.StimulusLibrary(feature_store, 'feature', ['stimulus03', 'stimulus01'])
+    assert library.features.shape == (2, 3)
+
+    with pytest.raises(ValueError):
+        features.StimulusLibrary(feature_store, 'empty')
+
+
+@pytest.mark.parametrize('n_targets', [1, 4])
+def test_stimulus_library_score(tmpdir, n_targets):
+    """Linear models are scored with their coefficients, like predicting the steady state
+    response to each stimulus with their predict method
+    """
+    library = features.StimulusLibrary(make_library(tmpdir), 'feature')
+    random_state = np.random.RandomState(1)
+    X = random_state.randn(50, 2 * 3)  # two delays
+    Y = random_state.randn(50, n_targets)
+    model = Ridge().fit(X, Y[:, 0] if n_targets == 1 else Y)
+
+    expected = model.predict(np.tile(library.features, 2)).reshape(12, -1).mean(1)
+    np.testing.assert_allclose(library.score(model), expected, rtol=1e-5)
+    np.testing.assert_allclose(library.score(PredictOnly(model), chunk_size=5), expected,
+                               rtol=1e-5)
+
+
+def test_stimulus_library_score_cache(tmpdir):
+    library = features.StimulusLibrary(make_library(tmpdir), 'feature')
+    random_state = np.random.RandomState(1)
+    X = random_state.randn(50, 3)
+    model = Ridge().fit(X, random_state.randn(50))
+    scores = library.score(model, model_name='model', version=1)
+    assert library.score(model, model_name='model', version=1) is scores
+
+    model.fit(X, random_state.randn(50))
+    new_scores = library.score(model, model_name='model', version=2)
+    assert not np.allclose(new_scores, scores)
+    assert library.scores['model'][0] == 2
+
+
+def test_stimulus_library_select():
+    scores = np.array([0.5, -2., 3., 1., -1., 2.])
+    optimal, minimal = features.StimulusLibrary.select(scores, 2, 3)
+    np.testing.assert_array_equal(optimal, [2, 5])
+    np.testing.assert_array_equal(minimal, [1, 4, 0])
+
+    optimal, minimal = features.StimulusLibrary.select(scores, 10, 0)
+    np.testing.assert_array_equal(optimal, [2, 5, 3, 0, 4, 1])
+    assert len(minimal) == 0
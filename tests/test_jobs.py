@@ -0,0 +1,87 @@
+import json
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import fakeredis
+import pytest
+
+from realtimefmri.web_interface import jobs
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(jobs, 'r', client)
+    return client
+
+
+def published_statuses(pubsub, job_id):
+    statuses = []
+    message = pubsub.get_message()
+    while message is not None:
+        if message['type'] == 'message':
+            fields = json.loads(message['data'])
+            assert fields['job_id'] == job_id
+            if 'status' in fields:
+                statuses.append(fields['status'])
+        message = pubsub.get_message()
+    return statuses
+
+
+def add(a, b, progress):
+    progress(0.5, 'adding')
+    return a + b
+
+
+def fail(progress):
+    raise RuntimeError('no convergence')
+
+
+def test_job_done(redis_client):
+    pubsub = redis_client.pubsub()
+    pubsub.subscribe('jobs')
+
+    queue = jobs.JobQueue(max_workers=1)
+    queue.executor = ThreadPoolExecutor(max_workers=1)
+    job_id = queue.submit('add', add, 1, b=2)
+    queue.executor.shutdown(wait=True)
+
+    assert published_statuses(pubsub, job_id) == ['queued', 'running', 'done']
+    job = jobs.get_job(job_id)
+    assert job['name'] == 'add'
+    assert job['status'] == 'done'
+    assert job['result'] == 3
+    assert job['progress'] == 1.
+    assert job['message'] == 'adding'
+    assert job['submit_time'] <= job['start_time'] <= job['end_time']
+    assert 0 < redis_client.ttl(f'job:{job_id}') <= jobs.JOB_EXPIRE
+
+
+def test_job_failed(redis_client):
+    pubsub = redis_client.pubsub()
+    pubsub.subscribe('jobs')
+
+    jobs.update_job('job', name='fail', status='queued')
+    jobs.run_job('job', fail, (), {})
+
+    assert published_statuses(pubsub, 'job') == ['queued', 'running', 'failed']
+    job = jobs.get_job('job')
+    assert job['status'] == 'failed'
+    assert 'no convergence' in job['message']
+    assert 'result' not in job
+    assert redis_client.ttl('job:job') > 0
+
+
+def test_worker_died(redis_client):
+    """A job whose worker process died is failed and the next job starts a new pool
+    """
+    queue = jobs.JobQueue(max_workers=1)
+    queue.executor = ThreadPoolExecutor(max_workers=1)
+    jobs.update_job('job', name='crash', status='running')
+
+    future = Future()
+    future.set_exception(OSError('worker died'))
+    queue._check_worker('job', future)
+
+    assert jobs.get_job('job')['status'] == 'failed'
+    assert queue.executor is None
+    assert jobs.get_job('missing') is None
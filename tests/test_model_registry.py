@@ -0,0 +1,62 @@
+import pickle
+
+import fakeredis
+
+from realtimefmri.web_interface.model_registry import ModelRegistry
+
+
+def test_reload_when_version_changes():
+    registry = ModelRegistry(fakeredis.FakeStrictRedis(), max_bytes=10 ** 6)
+    assert registry.load('model') is None
+    assert registry.get_version('model') == 0
+
+    assert registry.store('model', {'weights': [1, 2]}) == 1
+    assert registry.load('model') == {'weights': [1, 2]}
+    assert registry.load('model') is registry.load('model')
+    assert (registry.hits, registry.misses) == (2, 1)
+
+    assert registry.store('model', {'weights': [3, 4]}) == 2
+    assert registry.get_version('model') == 2
+    assert registry.load('model') == {'weights': [3, 4]}
+    assert registry.misses == 2
+    assert registry.stats()['models'] == {'model': 2}
+
+
+def test_models_stored_without_version():
+    """Models pickled to the database directly are loaded as version 0
+    """
+    redis_client = fakeredis.FakeStrictRedis()
+    redis_client.set('model:model', pickle.dumps('unversioned'))
+    registry = ModelRegistry(redis_client, max_bytes=10 ** 6)
+    assert registry.load('model') == 'unversioned'
+    assert registry.stats()['models'] == {'model': 0}
+
+
+def test_least_recently_used_models_are_evicted():
+    registry = ModelRegistry(fakeredis.FakeStrictRedis(), max_bytes=0)
+    model_size = len(pickle.dumps('a' * 1000))
+    registry.max_bytes = 2 * model_size
+    for name in 'abc':
+        registry.store(name, name * 1000)
+
+    registry.load('a')
+    registry.load('b')
+    registry.load('a')
+    registry.load('c')
+    assert list(registry.stats()['models']) == ['a', 'c']
+    assert registry.evictions == 1
+    assert registry.stats()['bytes'] == 2 * model_size
+
+    registry.load('b')
+    assert list(registry.stats()['models']) == ['c', 'b']
+    assert (registry.hits, registry.misses, registry.evictions) == (1, 4, 2)
+
+
+def test_most_recent_model_is_kept():
+    """A model larger than the cache is still cached until another model is loaded
+    """
+    registry = ModelRegistry(fakeredis.FakeStrictRedis(), max_bytes=1)
+    registry.store('large', 'a' * 1000)
+    model = registry.load('large')
+    assert registry.load('large') is model
+    assert registry.hits == 1
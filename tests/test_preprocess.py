@@ -0,0 +1,66 @@
+import pickle
+
+import numpy as np
+import pytest
+from sklearn import linear_model, svm
+
+from realtimefmri import preprocess
+
+N_FEATURES = 20
+
+
+def make_predictor_step(tmpdir, monkeypatch, predictor, **kwargs):
+    with open(str(tmpdir.join('predictor.pkl')), 'wb') as f:
+        pickle.dump(predictor, f)
+    monkeypatch.setattr(preprocess.config, 'get_subject_directory', lambda subject: str(tmpdir))
+    return preprocess.SklearnPredictor('subject', 'predictor.pkl', **kwargs)
+
+
+def fit_predictors():
+    random_state = np.random.RandomState(0)
+    X = random_state.randn(100, N_FEATURES)
+    w = random_state.randn(N_FEATURES, 3)
+    Y = X.dot(w)
+    binary = Y[:, 0] > 0
+    multiclass = Y.argmax(1)
+
+    return [linear_model.LogisticRegression(solver='lbfgs').fit(X, binary),
+            linear_model.LogisticRegression(solver='lbfgs').fit(X, multiclass),
+            linear_model.RidgeClassifier().fit(X, multiclass),
+            svm.LinearSVC().fit(X, binary),
+            linear_model.Ridge().fit(X, Y[:, 0]),
+            linear_model.Ridge().fit(X, Y)]
+
+
+@pytest.mark.parametrize('predictor', fit_predictors(), ids=lambda p: type(p).__name__)
+def test_linear_fast_path_matches_predict(tmpdir, monkeypatch, predictor):
+    """The extracted coefficients give exactly the predictions of predict
+    """
+    step = make_predictor_step(tmpdir, monkeypatch, predictor)
+    assert step.coef is not None
+
+    random_state = np.random.RandomState(1)
+    for _ in range(50):
+        activity = random_state.randn(N_FEATURES).astype('float32')
+        np.testing.assert_array_equal(step.run(activity), predictor.predict(activity[None])[0])
+
+
+def test_non_finite_activity(tmpdir, monkeypatch):
+    predictor = fit_predictors()[0]
+    step = make_predictor_step(tmpdir, monkeypatch, predictor)
+
+    activity = np.random.RandomState(1).randn(N_FEATURES)
+    activity[:3] = [np.nan, np.inf, -np.inf]
+    expected = predictor.predict(np.nan_to_num(activity)[None])[0]
+    assert step.run(activity) == expected
+
+
+def test_non_linear_predictor_uses_predict(tmpdir, monkeypatch):
+    random_state = np.random.RandomState(0)
+    X = random_state.randn(100, N_FEATURES)
+    predictor = svm.SVC(gamma='scale').fit(X, X[:, 0] > 0)
+    step = make_predictor_step(tmpdir, monkeypatch, predictor)
+    assert step.coef is None
+
+    activity = random_state.randn(N_FEATURES)
+    assert step.run(activity) == predictor.predict(activity[None])[0]
@@ -0,0 +1,112 @@
+import os
+import os.path as op
+
+import numpy as np
+import pytest
+from nibabel import Nifti1Image
+
+from realtimefmri import recording
+
+SHAPE = (4, 5, 6)
+
+
+def make_volume(i):
+    return np.full(SHAPE, i, dtype='float32')
+
+
+def write_volumes(directory, image_numbers):
+    writer = recording.RecordingWriter(directory, fsync_interval=0.)
+    for image_number in image_numbers:
+        writer.append(image_number, make_volume(image_number), affine=np.eye(4))
+    writer.close()
+
+
+def test_write_and_read(tmpdir):
+    directory = str(tmpdir.join('volumes'))
+    write_volumes(directory, range(5))
+
+    run = recording.Recording(directory)
+    assert len(run) == 5
+    assert run.volumes.dtype == np.dtype('float32')
+    np.testing.assert_array_equal(run.image_numbers, np.arange(5))
+    for i in range(5):
+        np.testing.assert_array_equal(run.volumes[i], make_volume(i))
+
+    nii = run.to_nifti()
+    assert nii.shape == SHAPE + (5,)
+    np.testing.assert_array_equal(nii.affine, np.eye(4))
+
+
+def test_resume_truncates_to_index(tmpdir):
+    """A restarted pipeline resumes the recording after the last indexed volume
+    """
+    directory = str(tmpdir.join('volumes'))
+    write_volumes(directory, range(3))
+
+    # a crash after writing a volume but before it was added to the index, and while writing an
+    # index record
+    with open(op.join(directory, 'volumes.dat'), 'ab') as f:
+        f.write(make_volume(99).tobytes())
+    with open(op.join(directory, 'index.dat'), 'ab') as f:
+        f.write(b'\x01\x02\x03')
+
+    assert len(recording.Recording(directory)) == 3
+
+    write_volumes(directory, [3, 4])
+
+    run = recording.Recording(directory)
+    np.testing.assert_array_equal(run.image_numbers, np.arange(5))
+    for i in range(5):
+        np.testing.assert_array_equal(run.volumes[i], make_volume(i))
+
+    volume_size = make_volume(0).nbytes
+    assert os.path.getsize(op.join(directory, 'volumes.dat')) == 5 * volume_size
+    assert os.path.getsize(op.join(directory, 'index.dat')) == 5 * recording.INDEX_RECORD.size
+
+
+def check_lazy_run(run):
+    volumes = np.stack([make_volume(i) for i in range(6)])
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[1, 2:4, 3] = True
+
+    assert len(run) == 6
+    assert run.shape == (6,) + SHAPE
+    assert run.dtype == np.dtype('float32')
+    np.testing.assert_array_equal(run[2], volumes[2])
+    np.testing.assert_array_equal(run[-2:], volumes[-2:])
+    np.testing.assert_array_equal(run[[4, 0]], volumes[[4, 0]])
+    np.testing.assert_array_equal(run[1:5, :, 2, 1:3], volumes[1:5, :, 2, 1:3])
+    np.testing.assert_array_equal(run[3, 0], volumes[3, 0])
+    np.testing.assert_array_equal(run.masked(mask), volumes[:, mask])
+    np.testing.assert_array_equal(run.masked(mask, slice(4, None)), volumes[4:, mask])
+    with pytest.raises(ValueError):
+        run.masked(mask[:2])
+
+    nii = run.to_nifti()
+    assert nii.shape == SHAPE + (6,)
+    np.testing.assert_array_equal(nii.get_fdata(), np.moveaxis(volumes, 0, -1))
+
+
+def test_load_recorded_run(tmpdir, monkeypatch):
+    monkeypatch.setattr(recording.config, 'RECORDING_DIR', str(tmpdir))
+    write_volumes(str(tmpdir.join('run', 'volumes')), range(6))
+
+    run = recording.load_run('run', max_workers=3)
+    assert isinstance(run.volumes, np.memmap)
+    check_lazy_run(run)
+
+
+def test_load_nifti_run(tmpdir, monkeypatch):
+    """Runs saved as one nifti file per volume are read as a LazyRun
+    """
+    monkeypatch.setattr(recording.config, 'RECORDING_DIR', str(tmpdir))
+    directory = tmpdir.mkdir('run').mkdir('nifti')
+    for i in range(6):
+        Nifti1Image(make_volume(i), np.eye(4)).to_filename(str(directory.join(f'{i:04}.nii')))
+
+    run = recording.load_run('run', max_workers=3)
+    np.testing.assert_array_equal(run.affine, np.eye(4))
+    check_lazy_run(run)
+
+    with pytest.raises(ValueError):
+        recording.load_run('missing')
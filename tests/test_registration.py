@@ -0,0 +1,23 @@
+import os.path as op
+
+import nibabel as nib
+import numpy as np
+
+from realtimefmri import registration
+
+DATA_DIR = op.join(op.dirname(__file__), 'data')
+
+
+def test_transform_matches_3dvolreg():
+    """The native engine saves the same matrix as ``3dvolreg -1Dmatrix_save``
+    """
+    reference = nib.load(op.join(DATA_DIR, 'img.nii'))
+    volume = nib.load(op.join(DATA_DIR, 'img_rot.nii'))
+    afni_matrix = np.loadtxt(op.join(DATA_DIR, 'rotmat.aff12.1D')).reshape(3, 4)
+
+    rigid = registration.RigidRegistration(np.asanyarray(reference.dataobj), reference.affine)
+    _, matrix = rigid.register(volume)
+
+    np.testing.assert_allclose(matrix[:3, :3], afni_matrix[:, :3], atol=1e-3)
+    np.testing.assert_allclose(matrix[:3, 3], afni_matrix[:, 3], atol=0.1)
+    np.testing.assert_array_equal(matrix[3], [0, 0, 0, 1])
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from sklearn.linear_model import Ridge, RidgeCV
+
+from realtimefmri.ridge import IncrementalRidge
+
+
+def make_data(n_samples=200, n_features=10, scales=(1., 1., 1.), seed=0):
+    random_state = np.random.RandomState(seed)
+    X = random_state.randn(n_samples, n_features)
+    weights = random_state.randn(n_features, len(scales)) * scales
+    Y = X.dot(weights) + random_state.randn(n_samples, len(scales)) + 5
+    return X, Y
+
+
+@pytest.mark.parametrize('fit_intercept', [True, False])
+@pytest.mark.parametrize('n_targets', [1, 3])
+def test_matches_ridge(fit_intercept, n_targets):
+    """Accumulating chunks of samples gives the coefficients of Ridge fit on all samples
+    """
+    X, Y = make_data()
+    Y = Y[:, 0] if n_targets == 1 else Y
+
+    model = IncrementalRidge(alphas=[10.], fit_intercept=fit_intercept, chunk_size=2,
+                             dtype='float64')
+    for start in range(0, len(X), 30):
+        model.partial_fit(X[start:start + 30], Y[start:start + 30])
+    model.solve()
+
+    reference = Ridge(alpha=10., fit_intercept=fit_intercept).fit(X, Y)
+    assert model.n_samples_ == len(X)
+    assert model.coef_.shape == reference.coef_.shape
+    np.testing.assert_allclose(model.coef_, reference.coef_, atol=1e-10)
+    np.testing.assert_allclose(model.intercept_, reference.intercept_, atol=1e-10)
+    np.testing.assert_allclose(model.predict(X), reference.predict(X), atol=1e-9)
+
+
+def test_alpha_matches_ridge_cv():
+    """Generalized cross-validation chooses the penalty of RidgeCV's leave-one-out errors, which
+    are close but not identical, on a coarse grid
+    """
+    alphas = [1e-2, 1e1, 1e4]
+    X, Y = make_data()
+
+    model = IncrementalRidge(alphas=alphas, dtype='float64').fit(X, Y)
+    reference = RidgeCV(alphas=alphas).fit(X, Y)
+    assert model.alpha_ == reference.alpha_
+    np.testing.assert_allclose(model.coef_, reference.coef_, atol=1e-10)
+
+
+def test_alpha_per_target_matches_ridge_cv():
+    alphas = [1e-2, 1e1, 1e4]
+    X, Y = make_data(scales=(1., 0.2, 0.))
+
+    model = IncrementalRidge(alphas=alphas, alpha_per_target=True, dtype='float64').fit(X, Y)
+    for target in range(Y.shape[1]):
+        reference = RidgeCV(alphas=alphas).fit(X, Y[:, target])
+        assert model.alpha_[target] == reference.alpha_
+        np.testing.assert_allclose(model.coef_[target], reference.coef_, atol=1e-10)
+    assert len(set(model.alpha_)) > 1
+
+
+def test_refit_after_more_samples():
+    X, Y = make_data()
+    model = IncrementalRidge(alphas=[1., 100.], dtype='float64')
+    model.partial_fit(X[:100], Y[:100]).solve()
+    model.partial_fit(X[100:], Y[100:]).solve()
+
+    reference = IncrementalRidge(alphas=[1., 100.], dtype='float64').fit(X, Y)
+    np.testing.assert_allclose(model.coef_, reference.coef_, atol=1e-12)
+    assert model.alpha_ == reference.alpha_
+
+    model.fit(X[:50], Y[:50])
+    assert model.n_samples_ == 50
@@ -0,0 +1,124 @@
+import fakeredis
+import numpy as np
+import pytest
+
+from realtimefmri import utils
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(utils, 'r', client)
+    monkeypatch.setattr(utils, 'read_timeseries_script',
+                        client.register_script(utils.READ_TIMESERIES_SCRIPT))
+    return client
+
+
+def store_samples(key_prefix, samples):
+    for time, array, trial_index in samples:
+        utils.store_timestamped_array_to_redis(key_prefix, time, array, trial_index=trial_index)
+
+
+def test_timestamped_array_round_trip(redis_client):
+    arrays = np.arange(24, dtype='float32').reshape(6, 2, 2)
+    trial_indices = [None, 0, 0, 1, 1, 10]
+    store_samples('responses:test', zip(np.arange(6.), arrays, trial_indices))
+
+    times, data = utils.load_timestamped_array_from_redis('responses:test')
+    np.testing.assert_array_equal(times, np.arange(6.))
+    np.testing.assert_array_equal(data, arrays)
+    assert data.dtype == np.dtype('float32')
+    assert utils.get_timestamped_array_trials('responses:test') == [0, 1, 10]
+
+
+def test_timestamped_array_trials(redis_client):
+    """Loading trials reads only their samples, in time order
+    """
+    arrays = np.arange(5.)[:, None] * np.ones(3)
+    trial_indices = [None, 2, 1, 1, 2]
+    store_samples('responses:test', zip([0., 3., 1., 2., 4.], arrays, trial_indices))
+
+    times, data = utils.load_timestamped_array_from_redis('responses:test', trials=[2, 1])
+    np.testing.assert_array_equal(times, [1., 2., 3., 4.])
+    np.testing.assert_array_equal(data, arrays[[2, 3, 1, 4]])
+
+    times, data = utils.load_timestamped_array_from_redis('responses:test', trials=[1, 5])
+    np.testing.assert_array_equal(times, [1., 2.])
+
+    with pytest.raises(Exception):
+        utils.load_timestamped_array_from_redis('responses:test', trials=[5])
+    with pytest.raises(Exception):
+        utils.load_timestamped_array_from_redis('responses:missing')
+
+
+def test_timestamped_array_shape_change(redis_client):
+    """Segments keep the shape they were stored with when a later segment has another shape
+    """
+    store_samples('responses:test', [(0., np.zeros(4), 0), (1., np.ones(3, dtype='int16'), 1)])
+
+    times, data = utils.load_timestamped_array_from_redis('responses:test', trials=[0])
+    np.testing.assert_array_equal(data, np.zeros((1, 4)))
+    times, data = utils.load_timestamped_array_from_redis('responses:test', trials=[1])
+    np.testing.assert_array_equal(data, np.ones((1, 3), dtype='int16'))
+
+    with pytest.raises(ValueError):
+        utils.load_timestamped_array_from_redis('responses:test')
+
+    store_samples('responses:test', [(2., np.zeros(5), 0)])
+    with pytest.raises(ValueError):
+        utils.load_timestamped_array_from_redis('responses:test', trials=[0])
+
+
+def test_scan_and_get(redis_client):
+    for i in range(25):
+        redis_client.set(f'experiment:log:{i}', i)
+    redis_client.set('experiment:trial:current', 'other')
+
+    keys = utils.scan_keys('experiment:log:*', chunk_size=4)
+    assert sorted(keys) == sorted(f'experiment:log:{i}'.encode('utf-8') for i in range(25))
+
+    values = utils.get_many(['experiment:log:3', 'missing', 'experiment:log:20'], chunk_size=2)
+    assert values == [b'3', None, b'20']
+    assert utils.get_many([]) == []
+
+    logs = utils.scan_and_get('experiment:log:*', chunk_size=4)
+    assert logs == {f'experiment:log:{i}'.encode('utf-8'): str(i).encode('utf-8')
+                    for i in range(25)}
+
+
+def test_timeseries_buffer(redis_client):
+    for index in range(10):
+        utils.append_to_timeseries_buffer('dashboard:data:test:timeseries', index,
+                                          [index, -index], max_length=4)
+
+    indices, values = utils.load_timeseries_buffer('dashboard:data:test:timeseries')
+    np.testing.assert_array_equal(indices, [6, 7, 8, 9])
+    np.testing.assert_array_equal(values, [[6, -6], [7, -7], [8, -8], [9, -9]])
+
+    indices, values = utils.load_timeseries_buffer('dashboard:data:test:timeseries', start=8)
+    np.testing.assert_array_equal(indices, [8, 9])
+
+    indices, values = utils.load_timeseries_buffer('dashboard:data:test:timeseries', start=10)
+    assert len(indices) == 0 and values.shape == (0, 0)
+
+    # a client that is ahead of a restarted series gets all buffered samples
+    redis_client.delete('dashboard:data:test:timeseries', 'dashboard:data:test:timeseries:length')
+    for index in range(2):
+        utils.append_to_timeseries_buffer('dashboard:data:test:timeseries', index, index,
+                                          max_length=4)
+    indices, values = utils.load_timeseries_buffer('dashboard:data:test:timeseries', start=10)
+    np.testing.assert_array_equal(indices, [0, 1])
+    np.testing.assert_array_equal(values, [[0], [1]])
+
+
+def test_decode_timeseries_rows_after_restart(redis_client):
+    """Samples with a different number of traces than the last sample are dropped
+    """
+    pipe = redis_client.pipeline()
+    utils.append_to_timeseries_buffer('series', 0, [0., 0.], max_length=10, pipe=pipe)
+    utils.append_to_timeseries_buffer('series', 0, [1., 1., 1.], max_length=10, pipe=pipe)
+    pipe.execute()
+
+    indices, values = utils.decode_timeseries_rows(redis_client.lrange('series', 0, -1))
+    np.testing.assert_array_equal(indices, [0])
+    np.testing.assert_array_equal(values, [[1., 1., 1.]])